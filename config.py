@@ -17,12 +17,18 @@ CONFIG_FILE = os.path.join(DATA_DIR, 'servers.json')
 SUBS_FILE = os.path.join(DATA_DIR, 'subscriptions.json')
 NODES_CACHE_FILE = os.path.join(DATA_DIR, 'nodes_cache.json')
 ADMIN_CONFIG_FILE = os.path.join(DATA_DIR, 'admin_config.json')
+DB_FILE = os.path.join(DATA_DIR, 'xfusion.db')
 GLOBAL_SSH_KEY_FILE = os.path.join(DATA_DIR, 'global_ssh_key')
+IP_GEO_CACHE_FILE = os.path.join(DATA_DIR, 'ip_geo_cache.json')
+GEOIP_MMDB_FILE = os.path.join(DATA_DIR, 'GeoLite2-Country.mmdb')
+GEOIP_CSV_FILE = os.path.join(DATA_DIR, 'geoip.csv')
+GEOIP_BIN_FILE = os.path.join(DATA_DIR, 'geoip.bin')
 
 # 环境变量默认值
 AUTO_REGISTER_SECRET = os.getenv('XUI_SECRET_KEY', 'sijuly_secret_key_default')
 ADMIN_USER = os.getenv('XUI_USERNAME', 'admin')
 ADMIN_PASS = os.getenv('XUI_PASSWORD', 'admin')
+STORAGE_BACKEND = os.getenv('XUI_STORAGE', 'json').lower()  # json | sqlite
 
 # ================= 全局辅助：超级坐标库 =================
 LOCATION_COORDS = {
@@ -352,13 +358,19 @@ fi
 
 # 3. 写入 Python 脚本
 cat > /root/x_fusion_agent.py << "PYTHON_EOF"
-import time, json, os, socket, sys, subprocess, re, platform, sqlite3
-import urllib.request, urllib.error
-import ssl
+import time, json, os, socket, sys, subprocess, re, platform, sqlite3, hashlib
+import urllib.request, urllib.error, http.client
+import ssl, threading, http.server, gzip, struct, base64
+from urllib.parse import urlsplit
 
 MANAGER_URL = "__MANAGER_URL__/api/probe/push"
+BATCH_URL = "__MANAGER_URL__/api/probe/push_batch"
 TOKEN = "__TOKEN__"
 SERVER_URL = "__SERVER_URL__"
+# 中继模式：填写端口后本机同时监听该端口，汇聚同机房探针的推送并批量转发给面板
+RELAY_PORT = "__RELAY_PORT__"
+# 紧凑模式：gzip 压缩请求体 + 二进制指标帧 (填 1 开启)
+COMPACT = "__PROBE_COMPACT__" == "1"
 
 PING_TARGETS = {
 "电信": "__PING_CT__",
@@ -410,16 +422,36 @@ try:
     v = subprocess.check_output("systemd-detect-virt", shell=True).decode().strip()
     if v and v != "none": STATIC_CACHE["virt"] = v
 except: pass
+STATIC_REV = hashlib.md5(json.dumps(STATIC_CACHE, sort_keys=True).encode("utf-8")).hexdigest()
 
-def get_ping(target):
-    try:
-        ip = target.split("://")[-1].split(":")[0]
-        cmd = "ping -c 1 -W 1 " + ip
-        res = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if res.returncode == 0:
-            match = re.search(r"time=([\d.]+)", res.stdout.decode())
-            if match: return int(float(match.group(1)))
-    except: pass
+# 推送协议 v2：面板已确认收到的版本，内容未变时只发增量帧
+SENT_REVS = {"static": None, "xui": None}
+
+# 延迟测速：每个目标一个常驻 ping 进程，后台线程读取结果，采集时直接取最近一次值 (不再每轮 fork)
+PING_INTERVAL = 5
+PING_STATE = {}
+
+def pinger(name, target):
+    ip = target.split("://")[-1].split(":")[0]
+    while True:
+        try:
+            p = subprocess.Popen(["ping", "-n", "-i", str(PING_INTERVAL), "-W", "1", ip],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            for line in p.stdout:
+                match = re.search(rb"time=([\d.]+)", line)
+                if match: PING_STATE[name] = (int(float(match.group(1))), time.time())
+            p.wait()
+        except: pass
+        time.sleep(PING_INTERVAL)
+
+def start_pingers():
+    for name, target in PING_TARGETS.items():
+        threading.Thread(target=pinger, args=(name, target), daemon=True).start()
+
+def get_ping(name):
+    rec = PING_STATE.get(name)
+    # 连续丢包超过两个周期视为不通
+    if rec and time.time() - rec[1] < PING_INTERVAL * 3: return rec[0]
     return -1
 
 def get_network_bytes():
@@ -473,9 +505,19 @@ def get_xui_rows():
     except:
         return None
 
+# 节点配置指纹 (与面板 routes._xui_signature 算法一致，流量计数不参与)
+XUI_REV_FIELDS = ("id", "remark", "enable", "protocol", "port", "settings", "streamSettings", "expiryTime", "listen")
+
+def get_xui_rev(inbounds):
+    rows = [[n.get(k) for k in XUI_REV_FIELDS] for n in inbounds]
+    return hashlib.md5(json.dumps(rows, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+LAST_SAMPLE = {}
+
 def get_info():
     global SERVER_URL
-    data = {"token": TOKEN, "static": STATIC_CACHE}
+    data = {"token": TOKEN, "v": 2, "static_rev": STATIC_REV}
+    if SENT_REVS["static"] != STATIC_REV: data["static"] = STATIC_CACHE
 
     if not SERVER_URL:
         try:
@@ -486,24 +528,27 @@ def get_info():
     data["server_url"] = SERVER_URL
 
     try:
-        net_in_1, net_out_1 = get_network_bytes()
-        with open("/proc/stat") as f:
-            fs = [float(x) for x in f.readline().split()[1:5]]
-            tot1, idle1 = sum(fs), fs[3]
-
-        # 采集等待
-        time.sleep(1)
-
+        # 滚动计数：与上一轮采样做差，无需 sleep 等待
+        now = time.monotonic()
         net_in_2, net_out_2 = get_network_bytes()
         with open("/proc/stat") as f:
             fs = [float(x) for x in f.readline().split()[1:5]]
             tot2, idle2 = sum(fs), fs[3]
 
-        data["cpu_usage"] = round((1 - (idle2-idle1)/(tot2-tot1)) * 100, 1)
+        prev = LAST_SAMPLE.get("v")
+        LAST_SAMPLE["v"] = (now, tot2, idle2, net_in_2, net_out_2)
+        if prev:
+            ts1, tot1, idle1, net_in_1, net_out_1 = prev
+            elapsed = max(now - ts1, 0.001)
+        else:
+            # 首轮没有上一次采样：CPU 取开机以来均值，网速记 0
+            tot1, idle1, net_in_1, net_out_1, elapsed = 0.0, 0.0, net_in_2, net_out_2, 1.0
+
+        data["cpu_usage"] = round((1 - (idle2-idle1)/(tot2-tot1)) * 100, 1) if tot2 > tot1 else 0.0
         data["cpu_cores"] = os.cpu_count() or 1
 
-        data["net_speed_in"] = net_in_2 - net_in_1
-        data["net_speed_out"] = net_out_2 - net_out_1
+        data["net_speed_in"] = max(int((net_in_2 - net_in_1) / elapsed), 0)
+        data["net_speed_out"] = max(int((net_out_2 - net_out_1) / elapsed), 0)
         data["net_total_in"] = net_in_2
         data["net_total_out"] = net_out_2
 
@@ -531,28 +576,172 @@ def get_info():
         with open("/proc/uptime") as f: u = float(f.read().split()[0])
         d = int(u // 86400); h = int((u % 86400) // 3600); m = int((u % 3600) // 60)
         data["uptime"] = "%d天 %d时 %d分" % (d, h, m)
+        data["uptime_s"] = int(u)
 
-        data["pings"] = {k: get_ping(v) for k, v in PING_TARGETS.items()}
+        data["pings"] = {k: get_ping(k) for k in PING_TARGETS}
 
         # ✨✨✨ 获取 X-UI 本地数据并随包推送 ✨✨✨
         # 只要读到了数据，就放进去。如果没装面板，这里是 None
         xui = get_xui_rows()
         if xui is not None:
-            data["xui_data"] = xui
+            rev = get_xui_rev(xui)
+            data["xui_rev"] = rev
+            if SENT_REVS["xui"] != rev:
+                data["xui_data"] = xui
+            else:
+                data["xui_traffic"] = [[n["id"], n["up"], n["down"], n["total"]] for n in xui]
 
     except: pass
     return data
 
+# 二进制指标帧 (与面板 routes._METRICS_FMT 保持一致)
+METRICS_FMT = "<BfHfffffffqqqqIhhh"
+METRICS_KEYS = ("cpu_usage", "cpu_cores", "load_1", "mem_total", "mem_usage", "swap_total", "swap_free",
+                "disk_total", "disk_usage", "net_speed_in", "net_speed_out", "net_total_in", "net_total_out", "uptime_s")
+
+def pack_metrics(data):
+    if any(k not in data for k in METRICS_KEYS): return data
+    p = data.get("pings", {})
+    vals = [data.pop(k) for k in METRICS_KEYS]
+    raw = struct.pack(METRICS_FMT, 1, *vals, p.get("电信", -1), p.get("联通", -1), p.get("移动", -1))
+    data.pop("uptime", None); data.pop("pings", None)
+    data["mb"] = base64.b64encode(raw).decode()
+    return data
+
+def encode_body(obj):
+    js = json.dumps(obj).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if COMPACT:
+        js = gzip.compress(js)
+        headers["Content-Encoding"] = "gzip"
+    return js, headers
+
+# 长连接：复用同一条 HTTP/1.1 keep-alive 连接推送，断开后自动重连
+class KeepAliveConn:
+    def __init__(self, url, timeout=10):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.timeout = timeout
+        self.conn = None
+
+    def close(self):
+        try:
+            if self.conn: self.conn.close()
+        except: pass
+        self.conn = None
+
+    def post(self, body, headers):
+        for attempt in (0, 1):
+            try:
+                if self.conn is None:
+                    if self.https:
+                        self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=ssl_ctx)
+                    else:
+                        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self.conn.request("POST", self.path, body=body, headers=headers)
+                r = self.conn.getresponse()
+                data = r.read()
+                if (r.getheader("Connection") or "").lower() == "close": self.close()
+                return r.status, data
+            except (http.client.HTTPException, OSError):
+                # 服务端关闭了空闲连接等情况：重连后重试一次
+                self.close()
+                if attempt: raise
+
+# ================= 中继模式 =================
+RELAY_BUFFER = {}
+RELAY_RESYNC = set()
+RELAY_LOCK = threading.Lock()
+
+class RelayHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if (self.headers.get("Content-Encoding") or "").lower() == "gzip": body = gzip.decompress(body)
+            frame = json.loads(body.decode("utf-8"))
+            # 中继对外监听：只接受携带本机 TOKEN 的帧，其余一律拒绝
+            if not isinstance(frame, dict) or frame.get("token") != TOKEN:
+                code, msg = 403, b"Forbidden"
+            else:
+                key = frame.get("server_url") or self.client_address[0]
+                with RELAY_LOCK:
+                    resync = key in RELAY_RESYNC
+                    RELAY_RESYNC.discard(key)
+                    if not resync:
+                        # 同一台只保留最新一帧；旧帧中尚未转发的全量内容并入新帧
+                        old = RELAY_BUFFER.get(key)
+                        if old:
+                            if "static" in old and "static" not in frame and old.get("static_rev") == frame.get("static_rev"):
+                                frame["static"] = old["static"]
+                            if "xui_data" in old and "xui_data" not in frame and old.get("xui_rev") == frame.get("xui_rev"):
+                                frame["xui_data"] = old["xui_data"]
+                        RELAY_BUFFER[key] = frame
+                code, msg = (409, b"RESYNC") if resync else (200, b"OK")
+        except:
+            code, msg = 400, b"Bad Request"
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(msg)))
+        self.end_headers()
+        self.wfile.write(msg)
+
+    def log_message(self, *args): pass
+
+def relay_flush():
+    conn = KeepAliveConn(BATCH_URL, timeout=15)
+    while True:
+        time.sleep(5)
+        with RELAY_LOCK:
+            keys = list(RELAY_BUFFER.keys())
+            frames = [RELAY_BUFFER.pop(k) for k in keys]
+        if not frames: continue
+        try:
+            js, headers = encode_body({"token": TOKEN, "frames": frames})
+            status, body = conn.post(js, headers)
+            if status != 200: raise ValueError(status)
+            results = json.loads(body.decode("utf-8")).get("results", [])
+            with RELAY_LOCK:
+                for k, res in zip(keys, results):
+                    if res == "RESYNC": RELAY_RESYNC.add(k)
+        except:
+            # 转发失败，这批帧可能含全量内容，让子探针下一帧全量重发
+            with RELAY_LOCK:
+                RELAY_RESYNC.update(keys)
+
+def start_relay():
+    if not RELAY_PORT.isdigit(): return
+    srv = http.server.ThreadingHTTPServer(("0.0.0.0", int(RELAY_PORT)), RelayHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    threading.Thread(target=relay_flush, daemon=True).start()
+
 def push():
+    conn = KeepAliveConn(MANAGER_URL)
+    next_ts = time.monotonic()
     while True:
         try:
-            js = json.dumps(get_info()).encode("utf-8")
-            req = urllib.request.Request(MANAGER_URL, data=js, headers={"Content-Type": "application/json"})
-            with urllib.request.urlopen(req, timeout=10, context=ssl_ctx) as r: pass
+            info = get_info()
+            js, headers = encode_body(pack_metrics(dict(info)) if COMPACT else info)
+            status, _ = conn.post(js, headers)
+            if status == 200:
+                # 推送成功后记录面板已持有的版本
+                if "static" in info: SENT_REVS["static"] = info["static_rev"]
+                if "xui_data" in info: SENT_REVS["xui"] = info["xui_rev"]
+            elif status == 409:
+                # 面板版本不一致 (如面板重启)，立即全量重发
+                SENT_REVS["static"] = None; SENT_REVS["xui"] = None
+                continue
         except: pass
-        time.sleep(5) # 降低频率，5秒推送一次
+        # 固定 5 秒节拍推送 (扣除本轮采集与发送耗时)
+        next_ts += 5
+        delay = next_ts - time.monotonic()
+        if delay < 0: next_ts = time.monotonic(); delay = 0
+        time.sleep(delay)
 
 if __name__ == "__main__":
+    start_pingers()
+    start_relay()
     push()
 PYTHON_EOF
 
@@ -892,6 +1081,46 @@ MATCH_MAP = {
     '🇳🇬': 'Nigeria', 'NIGERIA': 'Nigeria', 'NGA': 'Nigeria'
 }
 
+# ================= 地图数据 (Dashboard / Status 页面共用) =================
+MAP_FLAG_TO_NAME = {
+    '🇨🇳': 'China', '🇭🇰': 'China', '🇲🇴': 'China', '🇹🇼': 'China',
+    '🇺🇸': 'United States', '🇨🇦': 'Canada', '🇲🇽': 'Mexico',
+    '🇬🇧': 'United Kingdom', '🇩🇪': 'Germany', '🇫🇷': 'France', '🇳🇱': 'Netherlands',
+    '🇷🇺': 'Russia', '🇯🇵': 'Japan', '🇰🇷': 'South Korea', '🇸🇬': 'Singapore',
+    '🇮🇳': 'India', '🇦🇺': 'Australia', '🇧🇷': 'Brazil', '🇦🇷': 'Argentina',
+    '🇹🇷': 'Turkey', '🇮🇹': 'Italy', '🇪🇸': 'Spain', '🇵🇹': 'Portugal',
+    '🇨🇭': 'Switzerland', '🇸🇪': 'Sweden', '🇳🇴': 'Norway', '🇫🇮': 'Finland',
+    '🇵🇱': 'Poland', '🇺🇦': 'Ukraine', '🇮🇪': 'Ireland', '🇦🇹': 'Austria',
+    '🇧🇪': 'Belgium', '🇩🇰': 'Denmark', '🇨🇿': 'Czech Republic', '🇬🇷': 'Greece',
+    '🇿🇦': 'South Africa', '🇪🇬': 'Egypt', '🇸🇦': 'Saudi Arabia', '🇦🇪': 'United Arab Emirates',
+    '🇮🇱': 'Israel', '🇮🇷': 'Iran', '🇮🇩': 'Indonesia', '🇲🇾': 'Malaysia',
+    '🇹🇭': 'Thailand', '🇻🇳': 'Vietnam', '🇵🇭': 'Philippines', '🇨🇱': 'Chile',
+    '🇨🇴': 'Colombia', '🇵🇪': 'Peru'
+}
+
+MAP_NAME_ALIASES = {
+    'United States': ['United States of America', 'USA'],
+    'United Kingdom': ['United Kingdom', 'UK', 'Great Britain'],
+    'China': ['People\'s Republic of China'],
+    'Russia': ['Russian Federation'],
+    'South Korea': ['Korea', 'Republic of Korea'],
+    'Vietnam': ['Viet Nam']
+}
+
+COUNTRY_CENTROIDS = {
+    'China': [104.19, 35.86], 'United States': [-95.71, 37.09], 'United Kingdom': [-3.43, 55.37],
+    'Germany': [10.45, 51.16], 'France': [2.21, 46.22], 'Netherlands': [5.29, 52.13],
+    'Russia': [105.31, 61.52], 'Canada': [-106.34, 56.13], 'Brazil': [-51.92, -14.23],
+    'Australia': [133.77, -25.27], 'India': [78.96, 20.59], 'Japan': [138.25, 36.20],
+    'South Korea': [127.76, 35.90], 'Singapore': [103.81, 1.35], 'Turkey': [35.24, 38.96]
+}
+
+CITY_COORDS_FIX = {
+    'Dubai': (25.20, 55.27), 'Frankfurt': (50.11, 8.68), 'Amsterdam': (52.36, 4.90),
+    'San Jose': (37.33, -121.88), 'Phoenix': (33.44, -112.07), 'Tokyo': (35.68, 139.76),
+    'Seoul': (37.56, 126.97), 'London': (51.50, -0.12), 'Singapore': (1.35, 103.81)
+}
+
 # ================= 全局布局定义区域 (全响应式版) =================
 
 # 1. 带延迟 (9列) - 用于: 区域分组(如显示Ping时)
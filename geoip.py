@@ -0,0 +1,220 @@
+# geoip.py
+"""
+离线 IP 归属地查询
+- 数据源 (按优先级)：data/GeoLite2-Country.mmdb (需安装 maxminddb) > data/geoip.bin > data/geoip.csv
+- geoip.csv 每行: 起始IP,结束IP,国家代码[,...]，IP 可为点分或整数 (兼容 db-ip / IP2Location LITE 的 IPv4 表)
+  首次载入时编译为紧凑的 geoip.bin (有序数组)，之后启动直接读二进制
+- 查询：LRU -> 持久化答案 (state.IP_GEO_CACHE) -> 离线库 -> ip-api.com 兜底
+"""
+import os
+import csv
+import array
+import bisect
+import socket
+import tempfile
+import logging
+import functools
+import threading
+
+import requests
+
+import config
+import state
+
+try:
+    import maxminddb  # 可选依赖：MaxMind 官方 MMDB 读取库
+except ImportError:
+    maxminddb = None
+
+logger = logging.getLogger("XUI_GeoIP")
+
+_BIN_MAGIC = b'XFGEO1\0\0'
+
+
+def _ip_to_int(value):
+    value = value.strip().strip('"')
+    if value.isdigit(): return int(value)
+    return int.from_bytes(socket.inet_aton(value), 'big')
+
+
+class RangeTable:
+    """IPv4 段表：starts / ends 为有序 uint32 数组，codes 为国家代码下标，bisect 查找"""
+
+    def __init__(self, starts, ends, codes, names):
+        self.starts, self.ends, self.codes, self.names = starts, ends, codes, names
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_csv(cls, path):
+        rows = []
+        with open(path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or ':' in row[0]: continue  # 跳过表头与 IPv6 行
+                cc = row[2].strip().strip('"').upper()
+                if len(cc) != 2 or not cc.isalpha(): continue  # 保留地址等用 '-' / 'ZZ' 占位的段
+                try:
+                    rows.append((_ip_to_int(row[0]), _ip_to_int(row[1]), cc))
+                except (OSError, ValueError):
+                    continue
+        rows.sort()
+        names = sorted({cc for _, _, cc in rows})
+        index = {cc: i for i, cc in enumerate(names)}
+        return cls(array.array('I', (r[0] for r in rows)), array.array('I', (r[1] for r in rows)),
+                   array.array('H', (index[r[2]] for r in rows)), names)
+
+    @classmethod
+    def load_bin(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(_BIN_MAGIC)) != _BIN_MAGIC: raise ValueError("geoip.bin 格式不符")
+            n, n_names = array.array('I'), array.array('I')
+            n.fromfile(f, 1); n_names.fromfile(f, 1)
+            raw_names = f.read(2 * n_names[0]).decode('ascii')
+            names = [raw_names[i:i + 2] for i in range(0, len(raw_names), 2)]
+            starts, ends, codes = array.array('I'), array.array('I'), array.array('H')
+            starts.fromfile(f, n[0]); ends.fromfile(f, n[0]); codes.fromfile(f, n[0])
+        return cls(starts, ends, codes, names)
+
+    def save_bin(self, path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_BIN_MAGIC)
+                array.array('I', [len(self.starts), len(self.names)]).tofile(f)
+                f.write(''.join(cc[:2].ljust(2) for cc in self.names).encode('ascii'))
+                self.starts.tofile(f); self.ends.tofile(f); self.codes.tofile(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+
+    def lookup(self, ip):
+        try:
+            num = _ip_to_int(ip)
+        except (OSError, ValueError):
+            return None
+        i = bisect.bisect_right(self.starts, num) - 1
+        if i >= 0 and num <= self.ends[i]:
+            return self.names[self.codes[i]]
+        return None
+
+
+class MMDBTable:
+    def __init__(self, path):
+        self.reader = maxminddb.open_database(path)
+
+    def lookup(self, ip):
+        try:
+            rec = self.reader.get(ip) or {}
+        except ValueError:
+            return None
+        return (rec.get('country') or rec.get('registered_country') or {}).get('iso_code')
+
+
+_DB = None
+_DB_LOADED = False
+_DB_LOCK = threading.Lock()
+
+
+def _open_db():
+    if maxminddb is not None and os.path.isfile(config.GEOIP_MMDB_FILE):
+        return MMDBTable(config.GEOIP_MMDB_FILE)
+    csv_file, bin_file = config.GEOIP_CSV_FILE, config.GEOIP_BIN_FILE
+    has_csv, has_bin = os.path.isfile(csv_file), os.path.isfile(bin_file)
+    if has_bin and (not has_csv or os.path.getmtime(bin_file) >= os.path.getmtime(csv_file)):
+        try:
+            return RangeTable.load_bin(bin_file)
+        except Exception as e:
+            logger.warning(f"geoip.bin 读取失败，改用 CSV 重建: {e}")
+    if has_csv:
+        table = RangeTable.from_csv(csv_file)
+        try:
+            table.save_bin(bin_file)
+        except OSError as e:
+            logger.warning(f"geoip.bin 写入失败: {e}")
+        return table
+    return None
+
+
+def get_db():
+    """首次查询时载入离线库 (只载入一次)；没有离线库时返回 None"""
+    global _DB, _DB_LOADED
+    if _DB_LOADED: return _DB
+    with _DB_LOCK:
+        if not _DB_LOADED:
+            try:
+                _DB = _open_db()
+                if _DB is not None:
+                    logger.info(f"🌍 离线 GeoIP 库已载入 ({type(_DB).__name__}{f', {len(_DB)} 段' if isinstance(_DB, RangeTable) else ''})")
+            except Exception as e:
+                logger.error(f"离线 GeoIP 库载入失败: {e}")
+                _DB = None
+            _DB_LOADED = True
+    return _DB
+
+
+def reload_db():
+    """替换离线库文件后调用 (如恢复备份)；同时清空 LRU，让答案回到新的缓存 / 库"""
+    global _DB_LOADED
+    with _DB_LOCK:
+        _DB_LOADED = False
+    _lookup.cache_clear()
+    return get_db()
+
+
+def _lookup_online(ip):
+    try:
+        resp = requests.get(f"http://ip-api.com/json/{ip}?fields=status,countryCode,lat,lon", timeout=3)
+        if resp.status_code == 200:
+            data = resp.json()
+            if data.get('countryCode'):
+                return data.get('lat'), data.get('lon'), data['countryCode']
+    except Exception:
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _lookup(ip):
+    cached = state.IP_GEO_CACHE.get(ip)
+    if cached: return cached[2]
+
+    db = get_db()
+    cc = db.lookup(ip) if db is not None else None
+    if cc:
+        state.IP_GEO_CACHE[ip] = (None, None, cc)
+        return cc
+
+    found = _lookup_online(ip)
+    if found:
+        state.IP_GEO_CACHE[ip] = found
+        return found[2]
+    # 用异常跳过 LRU：查询失败不缓存，下次重试
+    raise LookupError(ip)
+
+
+def _resolve(host):
+    """域名先解析成 IP，LRU / 持久化缓存只以 IP 为键；IPv6 字面量原样返回"""
+    host = (host or '').strip().strip('[]')
+    if not host or ':' in host: return host
+    try:
+        socket.inet_aton(host)
+        return host
+    except OSError:
+        pass
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return None
+
+
+def lookup_country(ip):
+    """返回国家代码 (如 'US')，查不到返回 None；参数可以是域名；新答案写入 state.IP_GEO_CACHE 供落盘"""
+    ip = _resolve(ip)
+    if not ip: return None
+    try:
+        return _lookup(ip)
+    except LookupError:
+        return None
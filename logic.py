@@ -8,41 +8,84 @@ import datetime
 import zipfile
 import io
 import shutil
+import tempfile
 import socket
 import re
+import hashlib
+import functools
+import bisect
+import threading
 import requests
+import httpx
+from collections import Counter, OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 
 import config
 import state
 import utils
+import storage
+import geoip
+
+try:
+    import orjson  # 可选依赖：更快的 JSON 编解码
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger("XUI_Manager")
 
 # ================= 0. 顶层同步函数 (用于多进程调用) =================
 # 必须定义在最外层，否则 ProcessPoolExecutor 无法 Pickle (报错)
 
-def _save_json_sync(file_path, data):
-    """同步写入 JSON 文件"""
+def _atomic_dump_json(file_path, data, indent=None):
+    """先写临时文件再 rename，进程中途被杀也不会留下半截 JSON"""
     # 确保目录存在
     parent = os.path.dirname(file_path)
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    raw = None
+    if orjson is not None:
+        try:
+            raw = orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+        except TypeError:
+            raw = None  # orjson 不支持的数据 (如超长整数)，回退标准库
+    if raw is None:
+        raw = json.dumps(data, indent=indent, ensure_ascii=False).encode('utf-8')
+
+    # 临时文件名唯一，多个写入方并发写同一文件时互不覆盖
+    fd, tmp_path = tempfile.mkstemp(dir=parent, prefix=os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(file_path): shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
     return True
 
 
+def _save_json_sync(file_path, data):
+    """同步写入 JSON 文件"""
+    return _atomic_dump_json(file_path, data, indent=2)
+
+
 def _save_nodes_sync(file_path, data):
     """同步写入节点缓存 (紧凑格式)"""
-    parent = os.path.dirname(file_path)
-    if not os.path.exists(parent):
-        os.makedirs(parent)
+    return _atomic_dump_json(file_path, data)
 
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False)
-    return True
+
+def _timed_call(func, args):
+    """在线程 / 子进程中执行并记录起止时间，异常也原样带回"""
+    start = time.time()
+    try:
+        result, ok = func(*args), True
+    except Exception as e:
+        result, ok = e, False
+    return start, time.time(), ok, result
 
 
 def _zip_backup_sync(data_dir, zip_filename):
@@ -74,45 +117,92 @@ def _unzip_backup_sync(content_bytes, data_dir):
 
 # ================= 1. 数据初始化与保存 =================
 
-def init_data():
-    """初始化数据目录和加载缓存"""
+def _load_json_file(file_path):
+    """读取 JSON 文件，装了 orjson 时用 orjson 解码 (大文件快数倍)"""
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def init_data(lazy_nodes=False):
+    """
+    初始化数据目录和加载缓存
+    lazy_nodes=True 时节点缓存留给 load_nodes_cache_background 在后台加载，
+    服务器列表就绪后面板即可启动
+    """
+    t0 = time.perf_counter()
+    timings = []
     # 1. 确保数据目录存在
     if not os.path.exists(config.DATA_DIR):
         os.makedirs(config.DATA_DIR)
         logger.info(f"创建数据目录: {config.DATA_DIR}")
 
+    # 2~5. 加载服务器 / 订阅 / 管理员配置 (节点缓存按需延后)
+    store = storage.open_store()
+    timings.append(('打开存储', time.perf_counter() - t0))
+    state.NODES_CACHE_READY.clear()
+    if store:
+        _load_from_store(store, timings)
+    else:
+        _load_from_json(timings)
+
+    # 初始化默认配置
+    if 'probe_enabled' not in state.ADMIN_CONFIG:
+        state.ADMIN_CONFIG['probe_enabled'] = True
+    if 'probe_token' not in state.ADMIN_CONFIG:
+        import uuid
+        state.ADMIN_CONFIG['probe_token'] = uuid.uuid4().hex
+
+    if not lazy_nodes:
+        t = time.perf_counter()
+        _apply_nodes_cache(_read_nodes_cache())
+        timings.append(('节点缓存', time.perf_counter() - t))
+
+    detail = ', '.join(f"{k} {v * 1000:.0f}ms" for k, v in timings)
+    logger.info(f"⏱️ 数据加载耗时 {(time.perf_counter() - t0) * 1000:.0f}ms ({detail})"
+                f"{'，节点缓存后台加载中' if lazy_nodes else ''}")
+
+
+def _load_from_store(store, timings):
+    """SQLite 后端：按表读取"""
+    try:
+        t = time.perf_counter()
+        state.SERVERS_CACHE = store.load_servers()
+        timings.append(('服务器', time.perf_counter() - t))
+        t = time.perf_counter()
+        state.SUBS_CACHE = store.load_subs()
+        state.ADMIN_CONFIG.update(store.load_kv('admin_config', {}))
+        state.PING_TREND_CACHE.update(store.load_ping_history())
+        state.IP_GEO_CACHE.update(store.load_kv('ip_geo_cache', {}))
+        timings.append(('订阅/配置/Ping', time.perf_counter() - t))
+        logger.info(f"✅ 从 SQLite 加载: 服务器 {len(state.SERVERS_CACHE)} 台, 订阅 {len(state.SUBS_CACHE)} 个")
+    except Exception as e:
+        logger.error(f"❌ 读取 SQLite 数据库失败: {e}")
+
+
+def _load_from_json(timings):
     # 2. 加载服务器列表
+    t = time.perf_counter()
     if os.path.exists(config.CONFIG_FILE):
         try:
-            with open(config.CONFIG_FILE, 'r', encoding='utf-8') as f:
-                state.SERVERS_CACHE = json.load(f)
+            state.SERVERS_CACHE = _load_json_file(config.CONFIG_FILE)
             logger.info(f"✅ 成功加载服务器: {len(state.SERVERS_CACHE)} 台")
         except Exception as e:
             logger.error(f"❌ 读取 servers.json 失败: {e}")
             state.SERVERS_CACHE = []
     else:
         logger.warning(f"⚠️ 未找到服务器配置文件: {config.CONFIG_FILE}")
+    timings.append(('服务器', time.perf_counter() - t))
 
-    # 3. 加载节点缓存
-    if os.path.exists(config.NODES_CACHE_FILE):
-        if os.path.isdir(config.NODES_CACHE_FILE):
-            shutil.rmtree(config.NODES_CACHE_FILE)
-            state.NODES_DATA = {}
-        else:
-            try:
-                with open(config.NODES_CACHE_FILE, 'r', encoding='utf-8') as f:
-                    state.NODES_DATA = json.load(f)
-                total_nodes = sum(len(nodes) for nodes in state.NODES_DATA.values())
-                logger.info(f"✅ 加载缓存节点: {total_nodes} 个")
-            except Exception as e:
-                logger.error(f"加载节点缓存失败: {e}")
-                state.NODES_DATA = {}
+    # 3. 节点缓存见 _read_nodes_cache
 
     # 4. 加载订阅
+    t = time.perf_counter()
     if os.path.exists(config.SUBS_FILE):
         try:
-            with open(config.SUBS_FILE, 'r', encoding='utf-8') as f:
-                state.SUBS_CACHE = json.load(f)
+            state.SUBS_CACHE = _load_json_file(config.SUBS_FILE)
             logger.info(f"✅ 加载订阅: {len(state.SUBS_CACHE)} 个")
         except:
             state.SUBS_CACHE = []
@@ -120,44 +210,243 @@ def init_data():
     # 5. 加载管理员配置
     if os.path.exists(config.ADMIN_CONFIG_FILE):
         try:
-            with open(config.ADMIN_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                saved_conf = json.load(f)
-                state.ADMIN_CONFIG.update(saved_conf)
+            state.ADMIN_CONFIG.update(_load_json_file(config.ADMIN_CONFIG_FILE))
         except:
             pass
 
-    # 初始化默认配置
-    if 'probe_enabled' not in state.ADMIN_CONFIG:
-        state.ADMIN_CONFIG['probe_enabled'] = True
-    if 'probe_token' not in state.ADMIN_CONFIG:
-        import uuid
-        state.ADMIN_CONFIG['probe_token'] = uuid.uuid4().hex
+    # 6. 加载 IP 归属地缓存
+    if os.path.exists(config.IP_GEO_CACHE_FILE):
+        try:
+            state.IP_GEO_CACHE.update(_load_json_file(config.IP_GEO_CACHE_FILE))
+        except:
+            pass
+    timings.append(('订阅/配置', time.perf_counter() - t))
 
 
-async def save_servers():
-    global GLOBAL_UI_VERSION
+def _read_nodes_cache():
+    """读取节点缓存 (纯 I/O + 解码，可在线程中执行)"""
+    if storage.STORE:
+        try:
+            return storage.STORE.load_nodes()
+        except Exception as e:
+            logger.error(f"加载节点缓存失败: {e}")
+            return {}
+
+    if not os.path.exists(config.NODES_CACHE_FILE): return {}
+    if os.path.isdir(config.NODES_CACHE_FILE):
+        shutil.rmtree(config.NODES_CACHE_FILE)
+        return {}
     try:
-        await run_in_bg_executor(_save_json_sync, config.CONFIG_FILE, state.SERVERS_CACHE)
-        state.GLOBAL_UI_VERSION = time.time()
-        # 触发 UI 刷新钩子
-        if state.refresh_dashboard_ui_func:
+        return _load_json_file(config.NODES_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"加载节点缓存失败: {e}")
+        return {}
+
+
+def _reset_nodes_data():
+    """清空内存中的节点 (恢复备份等整体重载前)；旧 url 的版本号递增，已缓存的订阅随之失效"""
+    old_urls = list(state.NODES_DATA)
+    state.NODES_DATA.clear()
+    state.NODE_MODELS.clear()
+    state.NODE_MODEL_KEYS.clear()
+    state.PROBE_XUI_REVS.clear()
+    for url in old_urls: bump_nodes_rev(url)
+
+
+def _apply_nodes_cache(loaded, merge=False):
+    """
+    节点缓存载入内存
+    merge=True (启动时后台加载)：加载期间探针 / API 已写入的新数据优先；否则整体替换
+    """
+    try:
+        if merge:
+            for url in state.NODES_DATA: loaded.pop(url, None)
+        else:
+            _reset_nodes_data()
+        for url, nodes in loaded.items():
+            store_nodes(url, nodes)  # 走统一入口递增版本号，启动期间已缓存的订阅随之失效
+        state.DATA_REV['nodes'] += 1
+        DASHBOARD.invalidate()
+    finally:
+        # 出错也要置位，否则订阅接口一直 503、节点缓存永不落盘
+        state.NODES_CACHE_READY.set()
+    total_nodes = sum(len(nodes) for nodes in state.NODES_DATA.values())
+    logger.info(f"✅ 加载缓存节点: {total_nodes} 个")
+
+
+async def load_nodes_cache_background():
+    """启动后在线程池里读取节点缓存，不阻塞端口绑定"""
+    t = time.perf_counter()
+    try:
+        loaded = await run_in_bg_executor(_read_nodes_cache)
+    except Exception as e:
+        logger.error(f"加载节点缓存失败: {e}")
+        loaded = {}
+    _apply_nodes_cache(loaded, merge=True)
+    logger.info(f"⏱️ 节点缓存后台加载耗时 {(time.perf_counter() - t) * 1000:.0f}ms")
+    if state.refresh_dashboard_ui_func:
+        try:
             await state.refresh_dashboard_ui_func()
+        except Exception:
+            pass
+
+
+# ---------------- 合并写 (servers.json / nodes_cache.json) ----------------
+SAVE_FLUSH_INTERVAL = 0.5  # 秒：同一文件两次落盘的最小间隔
+
+
+class CoalescingWriter:
+    """
+    合并写入器：save_* 只标记为脏，后台任务每 SAVE_FLUSH_INTERVAL 最多落盘一次，
+    期间的多次保存合并为一次写入，并且每次落盘只触发一次 UI 刷新
+    """
+    def __init__(self, name, file_path, get_data, sync_func, on_flush=None, ready=None):
+        self.name = name
+        self.file_path = file_path
+        self.get_data = get_data
+        self.sync_func = sync_func
+        self.on_flush = on_flush
+        self.ready = ready  # 数据未加载完成前不落盘，避免用半截数据覆盖文件
+        self._dirty = False
+        self._task = None
+        self._paused = False
+        self._lock = asyncio.Lock()  # 串行化落盘，pause() 借此等待进行中的写入
+
+    def mark_dirty(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _write(self):
+        self._dirty = False
+        try:
+            await run_in_bg_executor(self.sync_func, self.file_path, self.get_data())
+            return True
+        except Exception as e:
+            logger.error(f"❌ 保存{self.name}失败: {e}")
+            self._dirty = True  # 下个周期重试
+            return False
+
+    async def _run(self):
+        while self._dirty:
+            await asyncio.sleep(SAVE_FLUSH_INTERVAL)
+            if self._paused or (self.ready and not self.ready()): continue
+            async with self._lock:
+                if self._paused or not self._dirty: continue
+                ok = await self._write()
+            if not ok: continue
+            if self.on_flush:
+                try:
+                    await self.on_flush()
+                except Exception as e:
+                    logger.warning(f"{self.name}落盘后刷新 UI 失败: {e}")
+
+    async def pause(self):
+        """立即落盘尚未写出的数据并暂停写入 (等待进行中的写入完成)，恢复备份等替换数据目录前调用"""
+        self._paused = True
+        async with self._lock:
+            if self._dirty and not (self.ready and not self.ready()):
+                await self._write()
+
+    def resume(self, discard=False):
+        """恢复写入；discard=True 时丢弃暂停期间的脏标记 (内存数据已从新目录重新加载)"""
+        self._paused = False
+        if discard: self._dirty = False
+        elif self._dirty: self.mark_dirty()
+
+    def flush_sync(self):
+        """关闭时调用：直接在当前线程写完尚未落盘的数据"""
+        if not self._dirty or (self.ready and not self.ready()): return
+        self._dirty = False
+        try:
+            self.sync_func(self.file_path, self.get_data())
+        except Exception as e:
+            logger.error(f"❌ 保存{self.name}失败: {e}")
+
+
+# 落盘函数：启用 SQLite 时按行写库，否则整文件写 JSON (均在线程池执行)
+def _write_servers(file_path, data):
+    if storage.STORE: return storage.STORE.save_servers(data)
+    return _save_json_sync(file_path, data)
+
+
+def _write_nodes(file_path, data):
+    if storage.STORE: return storage.STORE.save_nodes(data)
+    return _save_nodes_sync(file_path, data)
+
+
+def _write_subs(file_path, data):
+    if storage.STORE: return storage.STORE.save_subs(data)
+    return _save_json_sync(file_path, data)
+
+
+def _write_admin_config(file_path, data):
+    if storage.STORE: return storage.STORE.save_kv('admin_config', data)
+    return _save_json_sync(file_path, data)
+
+
+def _write_geo_cache(file_path, data):
+    if storage.STORE: return storage.STORE.save_kv('ip_geo_cache', data)
+    return _save_nodes_sync(file_path, data)
+
+
+async def _after_servers_flush():
+    state.GLOBAL_UI_VERSION = time.time()
+    # 触发 UI 刷新钩子
+    if state.refresh_dashboard_ui_func:
+        await state.refresh_dashboard_ui_func()
+
+
+async def _after_nodes_flush():
+    if state.refresh_dashboard_ui_func:
+        await state.refresh_dashboard_ui_func()
+
+
+# get_data 在事件循环线程执行：先浅拷贝，线程池编码期间主线程增删条目不会触发 "changed size during iteration"
+SERVERS_WRITER = CoalescingWriter('服务器', config.CONFIG_FILE, lambda: list(state.SERVERS_CACHE),
+                                  _write_servers, _after_servers_flush)
+NODES_WRITER = CoalescingWriter('节点缓存', config.NODES_CACHE_FILE, lambda: dict(state.NODES_DATA),
+                                _write_nodes, _after_nodes_flush, ready=state.NODES_CACHE_READY.is_set)
+
+
+GEO_WRITER = CoalescingWriter('IP 归属地缓存', config.IP_GEO_CACHE_FILE, lambda: dict(state.IP_GEO_CACHE),
+                              _write_geo_cache)
+
+
+# 后台任务 (如 SSH 用户名提示) 写管理员配置：合并写入且不触发全局 UI 刷新
+ADMIN_WRITER = CoalescingWriter('管理员配置', config.ADMIN_CONFIG_FILE, lambda: dict(state.ADMIN_CONFIG),
+                                _write_admin_config)
+
+
+def flush_pending_saves():
+    """关闭前把合并写队列里的数据落盘"""
+    SERVERS_WRITER.flush_sync()
+    NODES_WRITER.flush_sync()
+    GEO_WRITER.flush_sync()
+    ADMIN_WRITER.flush_sync()
+
+
+async def save_servers():
+    try:
+        # 索引由增删改处 (add / remove / replace / reindex) 增量维护，保存时不再重建
+        state.DATA_REV['servers'] += 1
+        SERVERS_WRITER.mark_dirty()
     except Exception as e:
         logger.error(f"❌ 保存服务器失败: {e}")
 
 
 async def save_subs():
     try:
-        await run_in_bg_executor(_save_json_sync, config.SUBS_FILE, state.SUBS_CACHE)
+        state.DATA_REV['subs'] += 1
+        await run_in_bg_executor(_write_subs, config.SUBS_FILE, state.SUBS_CACHE)
     except Exception as e:
         logger.error(f"❌ 保存订阅失败: {e}")
 
 
 async def save_nodes_cache():
     try:
-        await run_in_bg_executor(_save_nodes_sync, config.NODES_CACHE_FILE, state.NODES_DATA)
-        if state.refresh_dashboard_ui_func:
-            await state.refresh_dashboard_ui_func()
+        state.DATA_REV['nodes'] += 1
+        NODES_WRITER.mark_dirty()
     except Exception as e:
         logger.error(f"❌ 保存节点缓存失败: {e}")
 
@@ -165,89 +454,269 @@ async def save_nodes_cache():
 async def save_admin_config():
     global GLOBAL_UI_VERSION
     try:
-        await run_in_bg_executor(_save_json_sync, config.ADMIN_CONFIG_FILE, state.ADMIN_CONFIG)
+        await run_in_bg_executor(_write_admin_config, config.ADMIN_CONFIG_FILE, state.ADMIN_CONFIG)
         state.GLOBAL_UI_VERSION = time.time()
     except Exception as e:
         logger.error(f"❌ 配置保存失败: {e}")
 
 
-# ================= 2. 核心业务逻辑 (Dashboard & Maps) =================
+# ================= 1.1 订阅渲染缓存 =================
+SUB_CACHE_LIMIT = 2000
 
-def calculate_dashboard_data():
-    """计算仪表盘统计数据 (完整还原原版逻辑)"""
+
+def bump_nodes_rev(url):
+    """某台服务器的节点配置发生变化 (探针全量帧 / API 同步)"""
+    state.NODES_REV[url] = state.NODES_REV.get(url, 0) + 1
+
+
+def store_nodes(url, nodes):
+    """节点列表入库的统一入口：预解析节点模型 + 递增版本号"""
+    state.NODES_DATA[url] = nodes
+    utils.index_nodes(url, nodes)
+    bump_nodes_rev(url)
+    DASHBOARD.mark_dirty(url)
+
+
+def _sub_deps(urls, extra):
+    """只依赖所引用服务器：节点版本号 + 该 url 下的服务器对象 (编辑时整体替换)"""
+    return extra, tuple((state.NODES_REV.get(u, 0), tuple(id(s) for s in state.SERVER_REGISTRY.get_all_by_url(u)))
+                        for u in urls)
+
+
+def get_cached_sub(key, extra=()):
+    """命中条件：所引用服务器的节点 / 配置未变化，且调用方给出的 extra (订阅自身内容等) 相同"""
+    entry = state.SUB_RENDER_CACHE.get(key)
+    if entry and entry['deps'] == _sub_deps(entry['urls'], extra):
+        return entry
+    return None
+
+
+def make_etag(body):
+    """强 ETag：内容摘要"""
+    if isinstance(body, str): body = body.encode('utf-8')
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def put_cached_sub(key, urls, body, extra=()):
+    urls = tuple(urls)
+    etag = make_etag(body)
+    old = state.SUB_RENDER_CACHE.pop(key, None)
+    # 内容没变时沿用旧的修改时间，Last-Modified 才有意义
+    ts = old['ts'] if old and old.get('etag') == etag else time.time()
+    entry = {'urls': urls, 'deps': _sub_deps(urls, extra), 'body': body, 'etag': etag, 'ts': ts}
+    state.SUB_RENDER_CACHE[key] = entry
+    # 分组名来自客户端，限制条目数防止被刷爆
+    while len(state.SUB_RENDER_CACHE) > SUB_CACHE_LIMIT:
+        state.SUB_RENDER_CACHE.pop(next(iter(state.SUB_RENDER_CACHE)))
+    return entry
+
+
+# ================= 1.2 SubConverter 转换客户端 =================
+SUBCONVERTER_API = "http://subconverter:25500/sub"
+CONVERTER_CACHE_TTL = 300
+CONVERTER_CACHE_SIZE = 256
+
+_converter_client = None
+_converter_cache = OrderedDict()  # key -> {'body', 'etag', 'ts'}
+_converter_inflight = {}  # key -> Future，相同转换合并为一次请求
+
+
+def _get_converter_client():
+    """SubConverter 专用异步客户端 (keep-alive 连接池)"""
+    global _converter_client
+    if _converter_client is None:
+        _converter_client = httpx.AsyncClient(
+            timeout=10, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+    return _converter_client
+
+
+async def close_converter_client():
+    global _converter_client
+    if _converter_client is not None:
+        await _converter_client.aclose()
+        _converter_client = None
+
+
+async def fetch_subconverter(params, source_rev):
+    """
+    调用 SubConverter 转换订阅，返回 (entry, status_code)
+    结果按 (源订阅版本, 参数) 缓存；并发的相同请求只发出一次
+    """
+    key = (source_rev, tuple(sorted(params.items())))
+    now = time.time()
+
+    hit = _converter_cache.get(key)
+    if hit and now - hit['ts'] < CONVERTER_CACHE_TTL:
+        _converter_cache.move_to_end(key)
+        return hit, 200
+
+    pending = _converter_inflight.get(key)
+    if pending:
+        return await asyncio.shield(pending)
+
+    fut = asyncio.get_running_loop().create_future()
+    _converter_inflight[key] = fut
+    result = (None, None)
     try:
-        total_servers = len(state.SERVERS_CACHE)
-        online_servers = 0
-        total_nodes = 0
-        total_traffic_bytes = 0
-        server_traffic_map = {}
-        
-        from collections import Counter
-        country_counter = Counter()
-        now_ts = time.time()
+        resp = await _get_converter_client().get(SUBCONVERTER_API, params=params)
+        if resp.status_code == 200:
+            entry = {'body': resp.content, 'etag': make_etag(resp.content), 'ts': now}
+            _converter_cache[key] = entry
+            while len(_converter_cache) > CONVERTER_CACHE_SIZE:
+                _converter_cache.popitem(last=False)
+            result = (entry, 200)
+        else:
+            result = (None, resp.status_code)
+    except Exception as e:
+        logger.warning(f"SubConverter 请求失败: {e}")
+    finally:
+        _converter_inflight.pop(key, None)
+        fut.set_result(result)
+    return result
 
-        for s in state.SERVERS_CACHE:
-            url = s.get('url')
-            # 获取各类数据
-            res = state.NODES_DATA.get(url, []) or []
-            custom = s.get('custom_nodes', []) or []
-            probe_data = state.PROBE_DATA_CACHE.get(url)
-            
-            name = s.get('name', '未命名')
 
-            # 统计区域
-            try:
-                region_str = detect_country_group(name, s)
-                if not region_str or region_str.strip() == "🏳️":
-                    region_str = "🏳️ 未知区域"
-            except:
-                region_str = "🏳️ 未知区域"
-            country_counter[region_str] += 1
-
-            # 计算流量 (优先探针)
-            srv_traffic = 0
-            use_probe_traffic = False
-
-            if s.get('probe_installed') and probe_data:
-                t_in = probe_data.get('net_total_in', 0)
-                t_out = probe_data.get('net_total_out', 0)
-                if t_in > 0 or t_out > 0:
-                    srv_traffic = t_in + t_out
-                    use_probe_traffic = True
-            
-            # 兜底：累加 X-UI 节点流量
-            if not use_probe_traffic and res:
-                for n in res:
-                    srv_traffic += int(n.get('up', 0)) + int(n.get('down', 0))
-
-            total_traffic_bytes += srv_traffic
-            server_traffic_map[name] = srv_traffic
-
-            # 判断在线状态 (优先探针心跳)
-            is_online = False
-            if s.get('probe_installed') and probe_data:
-                if now_ts - probe_data.get('last_updated', 0) < 60:
-                    is_online = True
-            
-            # X-UI 判定
-            if not is_online:
-                if res or s.get('_status') == 'online':
-                    is_online = True
-            
-            if is_online:
-                online_servers += 1
+# ================= 2. 核心业务逻辑 (Dashboard & Maps) =================
 
-            # 统计节点数
-            if res: total_nodes += len(res)
-            if custom: total_nodes += len(custom)
+def _server_dashboard_contrib(s):
+    """单台服务器对仪表盘的贡献 (与原版统计口径一致)"""
+    url = s.get('url')
+    res = state.NODES_DATA.get(url, []) or []
+    custom = s.get('custom_nodes', []) or []
+    probe_data = state.PROBE_DATA_CACHE.get(url)
+    name = s.get('name', '未命名')
+
+    # 统计区域
+    try:
+        region_str = detect_country_group(name, s)
+        if not region_str or region_str.strip() == "🏳️":
+            region_str = "🏳️ 未知区域"
+    except:
+        region_str = "🏳️ 未知区域"
+
+    # 计算流量 (优先探针)
+    srv_traffic = 0
+    use_probe_traffic = False
+    if s.get('probe_installed') and probe_data:
+        t_in = probe_data.get('net_total_in', 0)
+        t_out = probe_data.get('net_total_out', 0)
+        if t_in > 0 or t_out > 0:
+            srv_traffic = t_in + t_out
+            use_probe_traffic = True
+
+    # 兜底：累加 X-UI 节点流量
+    if not use_probe_traffic and res:
+        for n in res:
+            srv_traffic += int(n.get('up', 0)) + int(n.get('down', 0))
+
+    return {
+        'name': name,
+        'region': region_str,
+        'traffic': srv_traffic,
+        'nodes': len(res) + len(custom),
+        # X-UI 判定：有节点或已标记在线；探针判定依赖心跳时间，读取时再比较
+        'xui_online': bool(res) or s.get('_status') == 'online',
+        'probe_ts': probe_data.get('last_updated', 0) if s.get('probe_installed') and probe_data else None,
+    }
+
+
+class DashboardAggregator:
+    """
+    仪表盘统计的增量版本：每台服务器的贡献单独记账，
+    探针推送 / 节点同步只把对应服务器标脏，读取时重算脏服务器即可；
+    服务器列表保存 (增删改) 后整体重建一次
+    """
+    TOP_N = 15
+    ONLINE_WINDOW = 60
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # 按服务器对象记账 (key = id(s))：url 为空 (纯 SSH) 或重复的服务器各算一台
+        self.contrib = {}  # key -> 贡献
+        self.seq = {}  # key -> 在服务器列表中的顺序 (流量并列时保持原顺序)
+        self.servers = {}  # key -> 服务器对象
+        self.by_url = {}  # url -> [key, ...]，按 url 标脏时找到对应服务器
+        self.dirty = set()
+        self.servers_rev = None
+        self.list_ref = None
+        self.traffic_total = 0
+        self.nodes_total = 0
+        self.xui_online = 0
+        self.regions = Counter()
+        self.top = []  # [(−traffic, seq, key)] 升序 = 流量降序
+        self.probe_ts = []  # [(last_updated, key)]，仅统计 X-UI 判定不在线的探针服务器
+
+    def mark_dirty(self, url):
+        self.dirty.add(url or '')
+
+    def invalidate(self):
+        self.servers_rev = None
+
+    def _remove(self, key):
+        c = self.contrib.pop(key, None)
+        if not c: return
+        self.traffic_total -= c['traffic']
+        self.nodes_total -= c['nodes']
+        self.regions[c['region']] -= 1
+        if not self.regions[c['region']]: del self.regions[c['region']]
+        if c['xui_online']:
+            self.xui_online -= 1
+        elif c['probe_ts'] is not None:
+            self._discard(self.probe_ts, (c['probe_ts'], key))
+        self._discard(self.top, (-c['traffic'], self.seq[key], key))
+
+    def _add(self, key, c):
+        self.contrib[key] = c
+        self.traffic_total += c['traffic']
+        self.nodes_total += c['nodes']
+        self.regions[c['region']] += 1
+        if c['xui_online']:
+            self.xui_online += 1
+        elif c['probe_ts'] is not None:
+            bisect.insort(self.probe_ts, (c['probe_ts'], key))
+        bisect.insort(self.top, (-c['traffic'], self.seq[key], key))
+
+    @staticmethod
+    def _discard(sorted_list, item):
+        i = bisect.bisect_left(sorted_list, item)
+        if i < len(sorted_list) and sorted_list[i] == item: del sorted_list[i]
+
+    def _rebuild(self):
+        self._reset()
+        for i, s in enumerate(state.SERVERS_CACHE):
+            key = id(s)
+            self.seq[key] = i
+            self.servers[key] = s
+            self.by_url.setdefault(s.get('url') or '', []).append(key)
+            self._add(key, _server_dashboard_contrib(s))
+        self.servers_rev = state.DATA_REV['servers']
+        self.list_ref = (id(state.SERVERS_CACHE), len(state.SERVERS_CACHE))
+
+    def _refresh(self):
+        if (self.servers_rev != state.DATA_REV['servers']
+                or self.list_ref != (id(state.SERVERS_CACHE), len(state.SERVERS_CACHE))):
+            self._rebuild()
+            return
+        dirty, self.dirty = self.dirty, set()
+        for url in dirty:
+            for key in self.by_url.get(url, ()):
+                self._remove(key)
+                self._add(key, _server_dashboard_contrib(self.servers[key]))
+
+    def snapshot(self):
+        self._refresh()
+        now_ts = time.time()
+        probe_online = len(self.probe_ts) - bisect.bisect_left(self.probe_ts, (now_ts - self.ONLINE_WINDOW,))
+        online_servers = self.xui_online + probe_online
 
         # 构建图表数据
-        sorted_traffic = sorted(server_traffic_map.items(), key=lambda x: x[1], reverse=True)[:15]
-        bar_names = [x[0] for x in sorted_traffic]
-        bar_values = [round(x[1]/(1024**3), 2) for x in sorted_traffic]
+        top = self.top[:self.TOP_N]
+        bar_names = [self.contrib[key]['name'] for _, _, key in top]
+        bar_values = [round(-neg / (1024 ** 3), 2) for neg, _, _ in top]
 
         chart_data = []
-        sorted_regions = country_counter.most_common()
+        sorted_regions = self.regions.most_common()
         if len(sorted_regions) > 5:
             top_5 = sorted_regions[:5]
             others_count = sum(item[1] for item in sorted_regions[5:])
@@ -259,137 +728,259 @@ def calculate_dashboard_data():
         if not chart_data: chart_data = [{'name': '暂无数据', 'value': 0}]
 
         return {
-            "servers": f"{online_servers}/{total_servers}",
-            "nodes": str(total_nodes),
-            "traffic": f"{total_traffic_bytes/(1024**3):.2f} GB",
+            "servers": f"{online_servers}/{len(self.contrib)}",
+            "nodes": str(self.nodes_total),
+            "traffic": f"{self.traffic_total / (1024 ** 3):.2f} GB",
             "subs": str(len(state.SUBS_CACHE)),
             "bar_chart": {"names": bar_names, "values": bar_values},
             "pie_chart": chart_data
         }
+
+
+DASHBOARD = DashboardAggregator()
+
+
+def calculate_dashboard_data():
+    """计算仪表盘统计数据 (增量聚合，见 DashboardAggregator)"""
+    try:
+        return DASHBOARD.snapshot()
     except Exception as e:
         logger.error(f"仪表盘数据计算错误: {e}")
+        DASHBOARD.invalidate()
         return None
 
 
-def detect_country_group(name, server_obj=None):
-    """智能分组核心"""
+# ---------------- 国家/地区识别 (预编译匹配器 + 记忆化) ----------------
+_GENERIC_GROUPS = frozenset(['默认分组', '自动注册', '未分组', '自动导入', '🏳️ 其他地区', '其他地区'])
+
+
+def _trie_regex(words):
+    """把关键字列表压成前缀树正则 (共享前缀只匹配一次)，同一位置总是先尝试更长的关键字"""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(sub) for ch, sub in sorted(node.items()) if ch]
+        if not branches: return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            body = (body if len(branches) > 1 else '(?:' + body + ')') + '?'
+        return body
+
+    return build(trie)
+
+
+def _build_country_matchers():
+    """
+    把 AUTO_COUNTRY_MAP 的全部关键字编译成两个前缀树正则：
+    短字母缩写 (如 US, SG) 带边界检查，其余关键字直接匹配；外层零宽前瞻让每个位置都能命中
+    """
+    keys = sorted(config.AUTO_COUNTRY_MAP.keys(), key=len, reverse=True)
+    bounded = [k for k in keys if len(k) <= 3 and k.isalpha()]
+    plain = [k for k in keys if not (len(k) <= 3 and k.isalpha())]
+    matchers = (
+        re.compile(r'(?=(?<![A-Z0-9])(' + _trie_regex(bounded) + r')(?![A-Z0-9]))'),
+        re.compile('(?=(' + _trie_regex(plain) + '))'),
+    )
+    return matchers, {k: i for i, k in enumerate(keys)}
+
+
+_COUNTRY_MATCHERS, _COUNTRY_RANK = _build_country_matchers()
+_DETECTED_KEYS = [(key.upper(), val) for key, val in config.AUTO_COUNTRY_MAP.items()]
+
+
+def _match_country_keyword(name_upper):
+    """返回优先级最高 (最长) 的命中关键字对应的地区"""
+    best = None
+    for matcher in _COUNTRY_MATCHERS:
+        for m in matcher.finditer(name_upper):
+            key = m.group(1)
+            if best is None or _COUNTRY_RANK[key] < _COUNTRY_RANK[best]:
+                best = key
+    return config.AUTO_COUNTRY_MAP[best] if best is not None else None
+
+
+@functools.lru_cache(maxsize=8192)
+def _classify_country(name, saved_group, detected):
     # 1. 优先手动分组
-    if server_obj:
-        saved_group = server_obj.get('group')
-        if saved_group and saved_group not in ['默认分组', '自动注册', '未分组', '自动导入', '🏳️ 其他地区', '其他地区']:
-            # 尝试标准化
-            for v in config.AUTO_COUNTRY_MAP.values():
-                if saved_group in v or v in saved_group:
-                    return v
-            return saved_group
+    if saved_group and saved_group not in _GENERIC_GROUPS:
+        # 尝试标准化
+        for v in config.AUTO_COUNTRY_MAP.values():
+            if saved_group in v or v in saved_group:
+                return v
+        return saved_group
 
     # 2. 关键字匹配
-    name_upper = name.upper()
-    sorted_keys = sorted(config.AUTO_COUNTRY_MAP.keys(), key=len, reverse=True)
-    
-    for key in sorted_keys:
-        val = config.AUTO_COUNTRY_MAP[key]
-        if key in name_upper:
-            # 针对短字母缩写(如 US, SG)做边界检查
-            if len(key) <= 3 and key.isalpha():
-                pattern = r'(?<![A-Z0-9])' + re.escape(key) + r'(?![A-Z0-9])'
-                if re.search(pattern, name_upper):
-                    return val
-            else:
-                return val
+    hit = _match_country_keyword(name.upper())
+    if hit: return hit
 
     # 3. IP 检测字段兜底
-    if server_obj and server_obj.get('_detected_region'):
-        detected = server_obj['_detected_region'].upper()
-        for key, val in config.AUTO_COUNTRY_MAP.items():
-            if key.upper() == detected or key.upper() in detected:
+    if detected:
+        detected = detected.upper()
+        for key, val in _DETECTED_KEYS:
+            if key == detected or key in detected:
                 return val
-            
+
     return '🏳️ 其他地区'
 
 
-def prepare_map_data():
-    """准备地图和区域统计数据"""
+def detect_country_group(name, server_obj=None):
+    """智能分组核心 (结果按 名称/分组/探测地区 记忆化，服务器任一字段变化即换新键)"""
+    if server_obj:
+        return _classify_country(name, server_obj.get('group'), server_obj.get('_detected_region'))
+    return _classify_country(name, None, None)
+
+
+# ---------------- 地图数据 (Dashboard / Status 页面共用，全部客户端共享一份结果) ----------------
+MAP_DATA_TTL = 5  # 秒：在线状态随心跳变化，结果最多复用这么久
+_MAP_STATIC = {'key': None, 'data': None}
+_MAP_RESULT = {'key': None, 'ts': 0, 'result': None}
+
+
+def _map_server_entry(s):
+    """单台服务器的国旗 / 地图标准名 / 中文名 / 坐标 (只依赖服务器配置，按服务器列表版本缓存)"""
+    s_name = s.get('name', '')
+    flag_icon = "📍"
+    map_name_standard = None
+
+    for f, m_name in config.MAP_FLAG_TO_NAME.items():
+        if f in s_name:
+            flag_icon = f
+            map_name_standard = m_name
+            break
+
     try:
-        city_points_map = {}
-        flag_points_map = {}
-        active_regions_for_highlight = set()
-        region_stats = {}
-        country_centroids = config.COUNTRY_CENTROIDS.copy()
-        
-        snapshot = list(state.SERVERS_CACHE)
-        now_ts = time.time()
-        temp_stats_storage = {}
+        group_str = detect_country_group(s_name, s)
+    except:
+        group_str = None
+
+    if not map_name_standard and group_str:
+        flag_part = group_str.split(' ')[0]
+        if flag_part in config.MAP_FLAG_TO_NAME:
+            flag_icon = flag_part
+            map_name_standard = config.MAP_FLAG_TO_NAME[flag_part]
+
+    lat, lon = None, None
+    for city_key, (c_lat, c_lon) in config.CITY_COORDS_FIX.items():
+        if city_key.lower() in s_name.lower(): lat, lon = c_lat, c_lon; break
+    if not lat:
+        if 'lat' in s and 'lon' in s:
+            lat, lon = s['lat'], s['lon']
+        else:
+            coords = utils.get_coords_from_name(s_name)
+            if coords: lat, lon = coords[0], coords[1]
+
+    cn_name = group_str.split(' ')[1] if group_str and ' ' in group_str else map_name_standard
+    return s_name, group_str, flag_icon, map_name_standard, cn_name, lat, lon
+
+
+def _build_map_static():
+    """与在线状态无关的部分：城市点、国旗点、饼图、国家质心，以及每个地区下的服务器"""
+    city_points_map = {}
+    flag_points_map = {}
+    country_centroids = dict(config.COUNTRY_CENTROIDS)
+    country_counter = Counter()
+    regions = {}  # 标准名 -> {'flag', 'cn', 'servers': [(server, name)]}
+
+    for s in list(state.SERVERS_CACHE):
+        s_name, group_str, flag_icon, map_name, cn_name, lat, lon = _map_server_entry(s)
+        if group_str: country_counter[group_str] += 1
+
+        if lat and lon and map_name:
+            coord_key = f"{lat},{lon}"
+            if coord_key not in city_points_map:
+                city_points_map[coord_key] = {'name': s_name, 'value': [lon, lat], 'country_key': map_name}
+            if flag_icon != "📍" and flag_icon not in flag_points_map:
+                flag_points_map[flag_icon] = {'name': flag_icon, 'value': [lon, lat], 'country_key': map_name}
+
+        if map_name:
+            if map_name not in regions:
+                regions[map_name] = {'flag': flag_icon, 'cn': cn_name, 'servers': []}
+            regions[map_name]['servers'].append((s, s_name))
+            if map_name not in country_centroids and lat and lon:
+                country_centroids[map_name] = [lon, lat]
+
+    active_regions = set()
+    for std_name in regions:
+        active_regions.add(std_name)
+        active_regions.update(config.MAP_NAME_ALIASES.get(std_name, []))
+
+    pie_data = []
+    if country_counter:
+        sorted_counts = country_counter.most_common(5)
+        for k, v in sorted_counts: pie_data.append({'name': f"{k} ({v})", 'value': v})
+        others = sum(country_counter.values()) - sum(x[1] for x in sorted_counts)
+        if others > 0: pie_data.append({'name': f"🏳️ 其他 ({others})", 'value': others})
+    else:
+        pie_data.append({'name': '暂无数据', 'value': 0})
+
+    return {
+        'map_json': json.dumps({'cities': list(city_points_map.values()), 'flags': list(flag_points_map.values()),
+                                'regions': list(active_regions)}, ensure_ascii=False),
+        'pie_data': pie_data,
+        'region_count': len(regions),
+        'regions': regions,
+        'centroids_json': json.dumps(country_centroids, ensure_ascii=False),
+    }
 
-        for s in snapshot:
-            s_name = s.get('name', '')
-            
-            # --- A. 确定国旗与标准名 ---
-            flag_icon = "📍"
-            map_name_standard = None
-            
-            # 简单的匹配逻辑，实际项目中可以复用原版更复杂的 FLAG_TO_MAP_NAME
-            # 这里简化演示，复用 detect_country_group
-            try:
-                group_str = detect_country_group(s_name, s)
-                if group_str and " " in group_str:
-                    flag_icon = group_str.split(' ')[0]
-                    # 尝试从 MATCH_MAP 反推地图名
-                    for k, v in config.MATCH_MAP.items():
-                        if k == flag_icon:
-                            map_name_standard = v
-                            break
-            except: pass
 
-            # --- B. 确定坐标 ---
-            lat, lon = None, None
-            if 'lat' in s and 'lon' in s:
-                lat, lon = s['lat'], s['lon']
-            else:
-                c = utils.get_coords_from_name(s_name)
-                if c: lat, lon = c[0], c[1]
-            
-            # --- C. 生成数据点 ---
-            if lat and lon:
-                city_points_map[f"{lat},{lon}"] = {'name': s_name, 'value': [lon, lat]}
-                
-                # --- D. 聚合统计 ---
-                if not map_name_standard: map_name_standard = "Unknown"
-                
-                if map_name_standard not in temp_stats_storage:
-                    cn_name = map_name_standard
-                    try:
-                        if group_str and ' ' in group_str: cn_name = group_str.split(' ')[1]
-                    except: pass
-                    
-                    temp_stats_storage[map_name_standard] = {
-                        'flag': flag_icon, 'cn': cn_name, 'total': 0, 'online': 0, 'servers': []
-                    }
-                
-                rs = temp_stats_storage[map_name_standard]
-                rs['total'] += 1
-                
-                # 在线判断
-                is_on = False
-                probe = state.PROBE_DATA_CACHE.get(s['url'])
-                if probe and (now_ts - probe.get('last_updated', 0) < 20): is_on = True
-                elif s.get('_status') == 'online': is_on = True
-                
-                if is_on: rs['online'] += 1
-                rs['servers'].append({'name': s_name, 'status': 'online' if is_on else 'offline'})
-                
-                active_regions_for_highlight.add(map_name_standard)
-
-        return (
-            json.dumps({'cities': list(city_points_map.values()), 'flags': [], 'regions': list(active_regions_for_highlight)}, ensure_ascii=False),
-            [], # pie data 已在 calculate_dashboard 中处理
-            len(temp_stats_storage),
-            json.dumps(temp_stats_storage, ensure_ascii=False),
-            json.dumps(country_centroids, ensure_ascii=False)
-        )
+def _build_region_stats(regions):
+    """按当前心跳 / 状态统计每个地区的在线数"""
+    now_ts = time.time()
+    region_stats = {}
+    for std_name, info in regions.items():
+        servers = []
+        online = 0
+        for s, s_name in info['servers']:
+            # 直接用手里的服务器对象：SSH-only (url 为空) 或 url 重复的服务器不能回查 url 索引
+            probe_cache = state.PROBE_DATA_CACHE.get(s.get('url')) if s.get('url') else None
+            is_on = bool(probe_cache) and now_ts - probe_cache.get('last_updated', 0) < 20
+            if not is_on: is_on = s.get('_status') == 'online'
+            if is_on: online += 1
+            servers.append({'name': s_name, 'status': 'online' if is_on else 'offline'})
+        servers.sort(key=lambda x: 0 if x['status'] == 'online' else 1)
+
+        stats = {'flag': info['flag'], 'cn': info['cn'], 'total': len(servers), 'online': online, 'servers': servers}
+        region_stats[std_name] = stats
+        for alias in config.MAP_NAME_ALIASES.get(std_name, []):
+            region_stats[alias] = stats
+    return json.dumps(region_stats, ensure_ascii=False)
+
+
+def prepare_map_data():
+    """
+    准备地图和区域统计数据，返回 (地图点 JSON, 饼图, 地区数, 地区统计 JSON, 国家质心 JSON)
+    服务器列表不变时复用静态部分；完整结果在 MAP_DATA_TTL 内被所有页面 / 客户端共享
+    """
+    try:
+        key = (state.DATA_REV['servers'], id(state.SERVERS_CACHE), len(state.SERVERS_CACHE))
+        now = time.time()
+        if _MAP_RESULT['key'] == key and now - _MAP_RESULT['ts'] < MAP_DATA_TTL:
+            return _MAP_RESULT['result']
+
+        if _MAP_STATIC['key'] != key:
+            _MAP_STATIC['data'] = _build_map_static()
+            _MAP_STATIC['key'] = key
+        static = _MAP_STATIC['data']
+
+        result = (static['map_json'], static['pie_data'], static['region_count'],
+                  _build_region_stats(static['regions']), static['centroids_json'])
+        _MAP_RESULT.update(key=key, ts=now, result=result)
+        return result
     except Exception as e:
         logger.error(f"Map data error: {e}")
-        return ("{}", [], 0, "{}", "{}")
+        return (json.dumps({'cities': [], 'flags': [], 'regions': []}), [], 0, "{}", "{}")
+
+
+async def lookup_ip_flag(host):
+    """IP/域名 -> 国旗 (离线库 + 缓存)；新查到的归属地合并落盘"""
+    known = len(state.IP_GEO_CACHE)
+    flag = await run_in_bg_executor(utils.get_flag_from_ip, host)
+    if len(state.IP_GEO_CACHE) != known: GEO_WRITER.mark_dirty()
+    return flag
 
 
 async def generate_smart_name(server_conf):
@@ -407,7 +998,7 @@ async def generate_smart_name(server_conf):
                         url = server_conf['url']
                         host = server_conf.get('ssh_host') or url.split('://')[-1].split(':')[0]
                         # 查 IP 
-                        flag = await run_in_bg_executor(utils.get_flag_from_ip, host)
+                        flag = await lookup_ip_flag(host)
                         if flag and flag not in raw_name:
                             return f"{flag} {raw_name}"
                         return raw_name
@@ -420,7 +1011,7 @@ async def generate_smart_name(server_conf):
         if not host and url: host = url.replace('http://', '').replace('https://', '').split(':')[0]
         
         if host:
-            flag = await run_in_bg_executor(utils.get_flag_from_ip, host)
+            flag = await lookup_ip_flag(host)
             # 查找国家名
             country = "Server"
             for f, c in config.AUTO_COUNTRY_MAP.items():
@@ -441,13 +1032,69 @@ async def generate_smart_name(server_conf):
 
 # ================= 3. 任务调度与后台执行 =================
 
-async def run_in_bg_executor(func, *args):
-    """通用后台线程池调用"""
+def _record_job(pool, func, submit_ts, start_ts, end_ts):
+    name = getattr(func, '__name__', 'job')
+    m = state.EXECUTOR_METRICS.setdefault((pool, name), {
+        'count': 0, 'queue_total': 0.0, 'run_total': 0.0, 'queue_max': 0.0, 'run_max': 0.0})
+    queue_t, run_t = max(start_ts - submit_ts, 0.0), max(end_ts - start_ts, 0.0)
+    m['count'] += 1
+    m['queue_total'] += queue_t
+    m['run_total'] += run_t
+    m['queue_max'] = max(m['queue_max'], queue_t)
+    m['run_max'] = max(m['run_max'], run_t)
+
+
+async def _run_timed(pool_name, executor, func, *args):
     loop = asyncio.get_running_loop()
+    submit_ts = time.time()
+    start_ts, end_ts, ok, result = await loop.run_in_executor(executor, _timed_call, func, args)
+    _record_job(pool_name, func, submit_ts, start_ts, end_ts)
+    if not ok: raise result
+    return result
+
+
+async def run_in_bg_executor(func, *args):
+    """I/O 类任务 (文件写入 / HTTP / SSH / DNS)：线程池执行，可传 lambda 和绑定方法"""
+    return await _run_timed('io', state.BG_EXECUTOR, func, *args)
+
+
+async def run_in_process_pool(func, *args):
+    """CPU 密集任务 (压缩 / 解压备份等)：进程池执行，func 和参数必须可 pickle"""
     if state.PROCESS_POOL is None:
-        # 如果进程池未初始化，回退到默认线程池
-        return await loop.run_in_executor(None, func, *args)
-    return await loop.run_in_executor(state.PROCESS_POOL, func, *args)
+        # 如果进程池未初始化，回退到线程池
+        return await _run_timed('io', state.BG_EXECUTOR, func, *args)
+    return await _run_timed('cpu', state.PROCESS_POOL, func, *args)
+
+
+async def run_in_ssh_executor(func, *args):
+    """批量 SSH 长命令：独立线程池，避免挤占文件写入等短任务"""
+    return await _run_timed('ssh', state.SSH_EXECUTOR, func, *args)
+
+
+def get_executor_metrics():
+    """各后台任务的排队 / 执行耗时统计 (秒)"""
+    result = {}
+    for (pool, name), m in state.EXECUTOR_METRICS.items():
+        n = m['count'] or 1
+        result[f"{pool}:{name}"] = {
+            'count': m['count'],
+            'queue_avg': round(m['queue_total'] / n, 4), 'queue_max': round(m['queue_max'], 4),
+            'run_avg': round(m['run_total'] / n, 4), 'run_max': round(m['run_max'], 4),
+        }
+    return result
+
+
+EXECUTOR_METRICS_TOP = 10
+
+
+async def job_log_executor_metrics():
+    """定时任务：输出执行耗时最长的后台任务，便于排查线程池排队"""
+    metrics = get_executor_metrics()
+    if not metrics: return
+    top = sorted(metrics.items(), key=lambda kv: kv[1]['run_avg'] * kv[1]['count'], reverse=True)[:EXECUTOR_METRICS_TOP]
+    lines = [f"{k}: n={m['count']} queue={m['queue_avg']}/{m['queue_max']}s run={m['run_avg']}/{m['run_max']}s"
+             for k, m in top]
+    logger.info("📊 后台任务耗时 (avg/max):\n  " + "\n  ".join(lines))
 
 
 async def get_server_status(server_conf):
@@ -479,6 +1126,90 @@ async def get_server_status(server_conf):
     return {'status': 'offline', 'msg': '未连接'}
 
 
+# ---------------- /status 公共页状态广播 ----------------
+STATUS_TICK_INTERVAL = 2.5
+# 卡片用得到的字段；static / last_updated 等不参与 diff
+STATUS_FIELDS = ('status', 'cpu_usage', 'cpu_cores', 'mem_usage', 'mem_total', 'disk_usage', 'disk_total',
+                 'net_speed_in', 'net_speed_out', 'net_total_in', 'net_total_out', 'uptime')
+
+
+class StatusBroadcaster:
+    """全局只有一个 tick：每轮为探针机器算一次状态快照，与上一轮 diff，
+    只把变化的字段推给所有订阅页面 (回调参数 {url: {字段: 新值}})"""
+
+    def __init__(self, interval=STATUS_TICK_INTERVAL):
+        self.interval = interval
+        self.snapshot = {}   # url -> {字段: 值}，只含状态里实际存在的字段
+        self._subs = {}      # token -> callback
+        self._next_token = 0
+        self._task = None
+
+    def current(self, url):
+        """某台机器的最新完整快照 (新渲染的卡片用它初始化)"""
+        return self.snapshot.get(url)
+
+    def subscribe(self, callback):
+        if self._task is None or self._task.done():
+            # tick 没在跑时快照可能过期，先同步刷新一次 (此时没有其他订阅者，无需广播)
+            self._compute()
+            self._task = asyncio.create_task(self._run())
+        self._next_token += 1
+        self._subs[self._next_token] = callback
+        return self._next_token
+
+    def unsubscribe(self, token):
+        self._subs.pop(token, None)
+
+    def _compute(self):
+        """刷新快照，返回变化部分"""
+        changes = {}
+        fresh = {}
+        now = time.time()
+        for s in state.SERVERS_CACHE:
+            if not s.get('probe_installed'): continue
+            url = s.get('url')
+            cache = state.PROBE_DATA_CACHE.get(url)
+            # 与 get_server_status 的探针分支一致
+            if cache and now - cache.get('last_updated', 0) < 20:
+                st = {k: cache[k] for k in STATUS_FIELDS if k in cache}
+            elif cache:
+                st = {'status': 'offline'}
+            else:
+                st = self._api_status(s)
+            old = self.snapshot.get(url)
+            if old != st:
+                old = old or {}
+                changes[url] = {k: st.get(k) for k in old.keys() | st.keys() if old.get(k) != st.get(k)}
+            fresh[url] = st
+        self.snapshot = fresh
+        return changes
+
+    @staticmethod
+    def _api_status(s):
+        if s.get('user') and s.get('_status') == 'online':
+            return {'status': 'online', 'cpu_usage': 0, 'mem_usage': 0, 'uptime': 'API 托管中'}
+        return {'status': 'offline'}
+
+    async def _run(self):
+        while self._subs:
+            await asyncio.sleep(self.interval)
+            try:
+                changes = self._compute()
+            except Exception as e:
+                logger.error(f"状态快照计算失败: {e}")
+                continue
+            if not changes: continue
+            for token, callback in list(self._subs.items()):
+                try:
+                    callback(changes)
+                except Exception as e:
+                    # 只记录，不退订：页面关闭时由 on_disconnect 退订
+                    logger.warning(f"状态推送回调失败: {e}")
+
+
+STATUS_BROADCASTER = StatusBroadcaster()
+
+
 async def send_telegram_message(text):
     """发送 TG 消息"""
     token = state.ADMIN_CONFIG.get('tg_bot_token')
@@ -588,7 +1319,7 @@ async def job_check_geo_ip():
                 if not re.match(r"^\d+\.\d+\.\d+\.\d+$", host):
                     host = await run_in_bg_executor(socket.gethostbyname, host)
                 
-                flag = await run_in_bg_executor(utils.get_flag_from_ip, host)
+                flag = await lookup_ip_flag(host)
                 if flag and flag != "🏳️":
                     new_name = f"{flag} {new_name}"
             except: pass
@@ -597,6 +1328,7 @@ async def job_check_geo_ip():
             s['name'] = new_name
             # 自动分组
             s['group'] = detect_country_group(new_name, s)
+            state.SERVER_REGISTRY.reindex(s)
             changed = True
             
     if changed:
@@ -616,6 +1348,7 @@ async def fetch_inbounds_safe(server_conf, force_refresh=False, sync_name=False)
         if new_name != server_conf.get('name'):
             server_conf['name'] = new_name
             server_conf['group'] = detect_country_group(new_name, server_conf)
+            state.SERVER_REGISTRY.reindex(server_conf)
             await save_servers()
 
     # 探针模式：直接读缓存 (守门员逻辑)
@@ -637,11 +1370,12 @@ async def fetch_inbounds_safe(server_conf, force_refresh=False, sync_name=False)
         if hasattr(mgr, 'get_inbounds'):
             nodes = await run_in_bg_executor(mgr.get_inbounds)
             if nodes is not None:
-                state.NODES_DATA[url] = nodes
+                store_nodes(url, nodes)
                 server_conf['_status'] = 'online'
                 return nodes
     except Exception as e:
         server_conf['_status'] = 'offline'
+        DASHBOARD.mark_dirty(url)
     
     return state.NODES_DATA.get(url, [])
 
@@ -661,8 +1395,93 @@ def get_manager(server_conf):
 
 # ================= 5. 探针/SSH 操作 =================
 
-async def install_probe_on_server(server_conf):
-    """单台安装探针 (完整脚本逻辑)"""
+# ---------------- 批量 SSH 执行引擎 ----------------
+BATCH_SSH_CONCURRENCY = 10    # 默认并发数
+BATCH_SSH_MAX_CONCURRENCY = 32  # 与 state.SSH_EXECUTOR 线程数一致
+BATCH_SSH_TIMEOUT = 120       # 单机命令最长耗时 (秒)
+PROBE_INSTALL_TIMEOUT = 300   # 安装脚本含 apt/yum，放宽
+
+
+class BatchSSHRun:
+    """
+    并发批量执行 SSH 命令
+    - cmd 可以是字符串，或 callable(server) -> 命令 (每台不同)
+    - on_output(server, stream, line)：按行实时回调 (事件循环线程内)
+    - on_result(result)：单台结束时回调
+    - cancel()：正在执行的命令被中止，未开始的直接记为 cancelled
+    """
+
+    def __init__(self, servers, cmd, concurrency=BATCH_SSH_CONCURRENCY, timeout=BATCH_SSH_TIMEOUT,
+                 on_output=None, on_result=None):
+        self.servers = list(servers)
+        self.cmd = cmd
+        self.concurrency = max(1, min(int(concurrency or 1), BATCH_SSH_MAX_CONCURRENCY))
+        self.timeout = timeout
+        self.on_output = on_output
+        self.on_result = on_result
+        self.results = []
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _line_sink(self, loop, srv):
+        """把线程里收到的分块输出切成整行，投递回事件循环"""
+        buffers = {'stdout': '', 'stderr': ''}
+
+        def deliver(stream, line):
+            if self.on_output: loop.call_soon_threadsafe(self.on_output, srv, stream, line)
+
+        def on_chunk(stream, text):
+            lines = (buffers[stream] + text).split('\n')
+            buffers[stream] = lines.pop()
+            for line in lines: deliver(stream, line.rstrip('\r'))
+
+        def flush():
+            for stream, rest in buffers.items():
+                if rest: deliver(stream, rest.rstrip('\r'))
+                buffers[stream] = ''
+
+        return on_chunk, flush
+
+    async def _run_one(self, sema, srv):
+        async with sema:
+            start = time.time()
+            if self.cancelled:
+                status, output = 'cancelled', ''
+            else:
+                cmd = self.cmd(srv) if callable(self.cmd) else self.cmd
+                on_chunk, flush = self._line_sink(asyncio.get_running_loop(), srv)
+                try:
+                    status, output = await run_in_ssh_executor(
+                        utils.SSH_POOL.exec_stream, srv, cmd, on_chunk, self.timeout, self._cancel)
+                except Exception as e:
+                    status, output = 'failed', str(e)
+                flush()
+            result = {'server': srv, 'name': srv.get('name', srv.get('url')), 'status': status,
+                      'duration': round(time.time() - start, 1), 'output': output}
+            self.results.append(result)
+            if self.on_result:
+                try: self.on_result(result)
+                except Exception: pass
+            return result
+
+    async def run(self):
+        sema = asyncio.Semaphore(self.concurrency)
+        return list(await asyncio.gather(*(self._run_one(sema, s) for s in self.servers)))
+
+    @staticmethod
+    def summarize(results):
+        counts = Counter(r['status'] for r in results)
+        return {k: counts.get(k, 0) for k in ('ok', 'failed', 'timeout', 'cancelled')}
+
+
+def _probe_install_script(server_conf):
+    """生成单台机器的探针安装脚本"""
     # 获取本机IP作为默认回调
     my_ip = "127.0.0.1"
     try:
@@ -671,15 +1490,25 @@ async def install_probe_on_server(server_conf):
     except: pass
 
     base_url = state.ADMIN_CONFIG.get('manager_base_url', f"http://{my_ip}:8080")
-    
-    script = config.PROBE_INSTALL_SCRIPT \
+    # 中继模式：子探针推送到同机房的中继节点 (probe_relay_url)，中继节点自身开放 probe_relay_port 汇聚转发
+    base_url = (server_conf.get('probe_relay_url') or '').strip().rstrip('/') or base_url
+    relay_port = str(server_conf.get('probe_relay_port') or '')
+
+    return config.PROBE_INSTALL_SCRIPT \
         .replace("__MANAGER_URL__", base_url) \
+        .replace("__RELAY_PORT__", relay_port) \
+        .replace("__PROBE_COMPACT__", "1" if state.ADMIN_CONFIG.get('probe_compact') else "0") \
         .replace("__TOKEN__", state.ADMIN_CONFIG.get('probe_token', 'default_token')) \
         .replace("__SERVER_URL__", server_conf['url']) \
         .replace("__PING_CT__", state.ADMIN_CONFIG.get('ping_target_ct', '202.102.192.68')) \
         .replace("__PING_CU__", state.ADMIN_CONFIG.get('ping_target_cu', '112.122.10.26')) \
         .replace("__PING_CM__", state.ADMIN_CONFIG.get('ping_target_cm', '211.138.180.2'))
 
+
+async def install_probe_on_server(server_conf):
+    """单台安装探针 (完整脚本逻辑)"""
+    script = _probe_install_script(server_conf)
+
     utils.safe_notify(f"正在安装探针: {server_conf['name']}...", "ongoing")
     success, output = await run_in_bg_executor(utils._ssh_exec_wrapper, server_conf, script)
     
@@ -689,25 +1518,25 @@ async def install_probe_on_server(server_conf):
         utils.safe_notify(f"✅ {server_conf['name']} 探针安装成功", "positive")
     else:
         utils.safe_notify(f"❌ 安装失败: {output}", "negative")
+    return success
 
 
 async def batch_install_all_probes():
-    """批量安装"""
+    """批量安装 (复用批量 SSH 执行引擎)"""
     utils.safe_notify("开始批量更新探针...", "ongoing")
-    tasks = []
-    # 限制并发
-    sema = asyncio.Semaphore(10)
-    
-    async def _worker(s):
-        async with sema:
-            await install_probe_on_server(s)
+    targets = [s for s in state.SERVERS_CACHE if s.get('ssh_host')]
+    if not targets: return utils.safe_notify("批量任务结束", "positive")
 
-    for s in state.SERVERS_CACHE:
-        if s.get('ssh_host'):
-            tasks.append(_worker(s))
-            
-    if tasks: await asyncio.gather(*tasks)
-    utils.safe_notify("批量任务结束", "positive")
+    results = await BatchSSHRun(targets, _probe_install_script, timeout=PROBE_INSTALL_TIMEOUT).run()
+    for r in results:
+        if r['status'] == 'ok':
+            r['server']['probe_installed'] = True
+        else:
+            logger.warning(f"探针安装失败 [{r['name']}] {r['status']}: {r['output'][-200:]}")
+    if any(r['status'] == 'ok' for r in results): await save_servers()
+
+    c = BatchSSHRun.summarize(results)
+    utils.safe_notify(f"批量任务结束: 成功 {c['ok']} / 失败 {c['failed']} / 超时 {c['timeout']}", "positive")
 
 
 async def force_geoip_naming_task(server_conf):
@@ -718,43 +1547,110 @@ async def force_geoip_naming_task(server_conf):
     if new_name != server_conf.get('name'):
         server_conf['name'] = new_name
         server_conf['group'] = detect_country_group(new_name, server_conf)
+        state.SERVER_REGISTRY.reindex(server_conf)
         await save_servers()
         if state.render_sidebar_content_func: state.render_sidebar_content_func.refresh()
 
 
+SSH_USER_CANDIDATES = ['root', 'ubuntu', 'debian', 'opc', 'ec2-user', 'admin']
+SSH_DETECT_STAGGER = 0.5  # 候选用户依次错峰发起，靠前的 (历史命中) 通常无需等后面的
+
+
+def _ssh_banner(host, port, timeout=5):
+    """读取 sshd 版本串 (如 SSH-2.0-OpenSSH_9.2p1 Debian-2+deb12u2)，用于推断系统镜像"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            return sock.recv(256).split(b'\n')[0].decode('ascii', 'ignore').strip()
+    except Exception:
+        return ""
+
+
+def _ssh_user_hint_keys(host, banner):
+    """探测结果的记忆维度：IP 段 (近似服务商) + sshd 版本串里的发行版"""
+    keys = []
+    parts = host.split('.')
+    if len(parts) == 4 and all(p.isdigit() for p in parts):
+        keys.append('net:' + '.'.join(parts[:2]))
+    m = re.search(r'OpenSSH_\S+\s+([A-Za-z]+)', banner)
+    if m: keys.append('os:' + m.group(1).lower())
+    return keys
+
+
+def _ordered_ssh_candidates(hint_keys):
+    hints = state.ADMIN_CONFIG.get('ssh_user_hints', {})
+    preferred = [hints[k] for k in hint_keys if hints.get(k)]
+    return list(dict.fromkeys(preferred + SSH_USER_CANDIDATES))
+
+
+def _connect_if_undecided(conf, decided, claim_lock):
+    """在线程中握手：第一个成功的连接认领胜出，晚到的成功连接在线程里直接关闭"""
+    client, msg = utils.get_ssh_client_sync(conf)
+    if not client: return None
+    with claim_lock:
+        if not decided.is_set():
+            decided.set()
+            return client
+    try: client.close()
+    except: pass
+    return None
+
+
+async def _race_ssh_users(server_conf, candidates):
+    """
+    按顺序错峰并发尝试各用户名，第一个成功即胜出：
+    未开始的候选直接取消；已在握手的候选由线程自行判断，晚到的成功连接在线程里关闭
+    (取消 asyncio 包装并不会停止线程)
+    """
+    winner = asyncio.get_running_loop().create_future()
+    decided, claim_lock = threading.Event(), threading.Lock()
+
+    async def _try(idx, user):
+        await asyncio.sleep(idx * SSH_DETECT_STAGGER)
+        if decided.is_set(): return
+        conf = dict(server_conf, ssh_user=user)
+        client = await run_in_ssh_executor(_connect_if_undecided, conf, decided, claim_lock)
+        if client: winner.set_result((user, client))
+
+    tasks = [asyncio.create_task(_try(i, u)) for i, u in enumerate(candidates)]
+    all_done = asyncio.ensure_future(asyncio.gather(*tasks, return_exceptions=True))
+    await asyncio.wait([winner, all_done], return_when=asyncio.FIRST_COMPLETED)
+    for t in tasks:
+        if not t.done(): t.cancel()
+    return winner.result() if winner.done() else (None, None)
+
+
 async def smart_detect_ssh_user_task(server_conf):
-    """智能探测 SSH 用户名 (完整轮询逻辑)"""
-    candidates = ['root', 'ubuntu', 'debian', 'opc', 'ec2-user', 'admin']
-    ip = server_conf.get('ssh_host') or server_conf.get('url').split('://')[-1].split(':')[0]
-    
-    logger.info(f"🕵️‍♂️ 正在探测 SSH 用户: {ip}")
-    
-    found = None
-    original_user = server_conf.get('ssh_user')
-
-    for user in candidates:
-        server_conf['ssh_user'] = user
-        # 尝试连接
-        client, msg = await run_in_bg_executor(utils.get_ssh_client_sync, server_conf)
-        if client:
-            client.close()
-            found = user
-            logger.info(f"✅ 探测成功: {user}@{ip}")
-            break
-            
+    """智能探测 SSH 用户名 (错峰竞速 + 按服务商/镜像记忆上次命中的用户)"""
+    host, port = utils._ssh_target(server_conf)[:2]
+    logger.info(f"🕵️‍♂️ 正在探测 SSH 用户: {host}")
+
+    banner = await run_in_ssh_executor(_ssh_banner, host, port)
+    hint_keys = _ssh_user_hint_keys(host, banner)
+    found, client = await _race_ssh_users(server_conf, _ordered_ssh_candidates(hint_keys))
+
     if found:
+        logger.info(f"✅ 探测成功: {found}@{host}")
         server_conf['ssh_user'] = found
-        await save_servers()
-        # 探测成功后自动安装探针
-        if state.ADMIN_CONFIG.get('probe_enabled', False):
-            await asyncio.sleep(1)
-            await install_probe_on_server(server_conf)
+        # 获胜连接留在池里，后续安装探针直接复用
+        utils.SSH_POOL.adopt(server_conf, client)
+        hints = state.ADMIN_CONFIG.setdefault('ssh_user_hints', {})
+        if any(hints.get(k) != found for k in hint_keys):
+            hints.update({k: found for k in hint_keys})
+            ADMIN_WRITER.mark_dirty()
+        # 探测成功后自动安装探针 (安装成功时会顺带保存)
+        if state.ADMIN_CONFIG.get('probe_enabled', False) and await install_probe_on_server(server_conf):
+            return
     else:
-        logger.warning(f"❌ 探测失败: {ip}")
+        logger.warning(f"❌ 探测失败: {host}")
         # 恢复默认
-        if original_user: server_conf['ssh_user'] = original_user
-        else: server_conf['ssh_user'] = 'root'
-        await save_servers()
+        original_user = server_conf.get('ssh_user')
+        if not original_user or original_user == 'detecting...': server_conf['ssh_user'] = 'root'
+    await save_servers()
+
+
+def _log_ping_write_error(fut):
+    if not fut.cancelled() and fut.exception():
+        logger.warning(f"Ping 记录写入失败: {fut.exception()}")
 
 
 def record_ping_history(url, pings):
@@ -775,6 +1671,8 @@ def record_ping_history(url, pings):
         'cm': pings.get('移动', -1)
     }
     state.PING_TREND_CACHE[url].append(rec)
+    if storage.STORE:
+        state.BG_EXECUTOR.submit(storage.STORE.append_ping, url, rec).add_done_callback(_log_ping_write_error)
     if len(state.PING_TREND_CACHE[url]) > 1440: # 24h
         state.PING_TREND_CACHE[url] = state.PING_TREND_CACHE[url][-1440:]
 
@@ -783,12 +1681,24 @@ def record_ping_history(url, pings):
 async def create_backup_zip():
     if not os.path.exists('backup'): os.makedirs('backup')
     name = f"backup/backup_{int(time.time())}.zip"
-    return await run_in_bg_executor(_zip_backup_sync, config.DATA_DIR, name)
+    if storage.STORE: await run_in_bg_executor(storage.STORE.checkpoint)
+    return await run_in_process_pool(_zip_backup_sync, config.DATA_DIR, name)
 
 
 async def restore_backup_zip(content):
-    res = await run_in_bg_executor(_unzip_backup_sync, content, config.DATA_DIR)
-    if res: init_data()
+    # 先落盘并暂停合并写入器，避免替换目录期间有写入落进新目录
+    writers = (SERVERS_WRITER, NODES_WRITER, GEO_WRITER, ADMIN_WRITER)
+    for w in writers: await w.pause()
+    res = False
+    try:
+        storage.close_store()  # 数据目录会被整体替换，先关闭数据库，init_data 时重新打开
+        res = await run_in_process_pool(_unzip_backup_sync, content, config.DATA_DIR)
+        if res:
+            init_data()
+            await run_in_bg_executor(geoip.reload_db)  # 备份里可能带了不同的离线库
+        else: storage.open_store()
+    finally:
+        for w in writers: w.resume(discard=bool(res))
     return res
 
 
@@ -835,7 +1745,7 @@ async def fast_resolve_single_server(s):
                 host = await run_in_bg_executor(socket.gethostbyname, host)
         except: pass
 
-        flag = await run_in_bg_executor(utils.get_flag_from_ip, host)
+        flag = await lookup_ip_flag(host)
         
         if flag and flag != "🏳️":
             # 重置坐标让地图重新获取
@@ -856,6 +1766,7 @@ async def fast_resolve_single_server(s):
             target_group = detect_country_group(s['name'], s)
             if s.get('group') in ['默认分组', '自动注册', '未分组'] and target_group != '🏳️ 其他地区':
                 s['group'] = target_group
+                state.SERVER_REGISTRY.reindex(s)
                 data_changed = True
 
         # --- 步骤 4: 保存变更 ---
@@ -10,6 +10,8 @@ from fastapi import Request # ✨✨✨ 必须导入这个 ✨✨✨
 import config
 import state
 import logic
+import utils
+import storage
 import routes
 import ui_layout
 
@@ -19,11 +21,13 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(me
 logger = logging.getLogger("XUI_Manager")
 
 # 初始化数据
-logic.init_data()
+logic.init_data(lazy_nodes=True)
 
 # 注册 API 路由
 # 注意：routes 中的函数必须也有 type hint，已经在之前的 routes.py 中处理好了
 app.add_api_route('/api/probe/push', routes.probe_push_data, methods=['POST'])
+app.add_api_route('/api/probe/push_batch', routes.probe_push_batch, methods=['POST'])
+app.add_api_route('/api/probe/stream', routes.probe_push_stream, methods=['POST'])
 app.add_api_route('/sub/{token}', routes.sub_handler, methods=['GET'])
 app.add_api_route('/sub/group/{group_b64}', routes.group_sub_handler, methods=['GET'])
 app.add_api_route('/get/group/{target}/{group_b64}', routes.short_group_handler, methods=['GET'])
@@ -58,14 +62,20 @@ async def startup_sequence():
     scheduler = AsyncIOScheduler()
     scheduler.add_job(logic.job_sync_all_traffic, 'interval', hours=24, id='traffic_sync', replace_existing=True)
     scheduler.add_job(logic.job_monitor_status, 'interval', seconds=120, id='status_monitor', replace_existing=True)
+    scheduler.add_job(logic.job_log_executor_metrics, 'interval', minutes=10, id='executor_metrics', replace_existing=True)
     scheduler.start()
     logger.info("🕒 定时任务已启动")
 
+    asyncio.create_task(logic.load_nodes_cache_background())
     asyncio.create_task(logic.job_sync_all_traffic())
     asyncio.create_task(logic.job_check_geo_ip())
 
 app.on_startup(startup_sequence)
+app.on_shutdown(logic.flush_pending_saves)
+app.on_shutdown(storage.close_store)
 app.on_shutdown(lambda: state.PROCESS_POOL.shutdown(wait=False) if state.PROCESS_POOL else None)
+app.on_shutdown(logic.close_converter_client)
+app.on_shutdown(utils.SSH_POOL.close_all)
 
 if __name__ in {"__main__", "__mp_main__"}:
     ui.run(
@@ -1,12 +1,17 @@
 # routes.py
 import json
 import asyncio
+import hashlib
+import base64
+import io
+import zlib
+import struct
 import socket
 import re
 import time
-import requests
 import logging
 from urllib.parse import urlparse, quote
+from email.utils import formatdate, parsedate_to_datetime
 from fastapi import Request, Response
 
 import config
@@ -14,265 +19,562 @@ import state
 import logic
 import utils
 
+try:
+    import zstandard as zstd  # 可选依赖：支持 zstd 压缩的探针推送
+except ImportError:
+    zstd = None
+
+try:
+    import msgpack  # 可选依赖：支持 msgpack 编码的探针推送
+except ImportError:
+    msgpack = None
+
 logger = logging.getLogger("XUI_Manager")
 
 
 # ================= 探针数据被动接收接口 (最终修复版：防双重国旗) =================
+# 推送协议 v2：
+#   全量帧 -> 携带 static / xui_data 以及对应的 static_rev / xui_rev
+#   增量帧 -> 仅携带 static_rev / xui_rev 引用上次全量内容，附带 xui_traffic 流量计数
+# 面板侧版本对不上 (如面板重启) 时返回 409 RESYNC，探针下一帧改发全量
+# 参与指纹计算的配置字段 (up/down/total 为流量计数，每次推送都会变化，单独处理)
+_XUI_REV_FIELDS = ('id', 'remark', 'enable', 'protocol', 'port', 'settings', 'streamSettings', 'expiryTime', 'listen')
+_XUI_TRAFFIC_FIELDS = ('up', 'down', 'total')
+
+
+def _xui_signature(raw_nodes):
+    """计算 X-UI 节点配置指纹 (settings 为原始字符串，无需 json.loads)"""
+    rows = [[n.get(k) for k in _XUI_REV_FIELDS] for n in raw_nodes]
+    return hashlib.md5(json.dumps(rows, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+# 紧凑二进制指标帧 (字段 mb)：版本号 + 定长指标 + 三网延迟，与探针脚本 pack_metrics 保持一致
+_METRICS_FMT = '<BfHfffffffqqqqIhhh'
+_METRICS_KEYS = ('cpu_usage', 'cpu_cores', 'load_1', 'mem_total', 'mem_usage', 'swap_total', 'swap_free',
+                 'disk_total', 'disk_usage', 'net_speed_in', 'net_speed_out', 'net_total_in', 'net_total_out',
+                 'uptime_s')
+_PING_KEYS = ('电信', '联通', '移动')
+
+
+PROBE_BODY_LIMIT = 8 * 1024 * 1024  # 探针请求体 (解压后) 上限，防解压炸弹
+
+
+class ProbeBodyTooLarge(ValueError):
+    pass
+
+
+def _too_large_response():
+    return Response("Payload Too Large", 413)
+
+
+async def _read_limited(request):
+    """读取原始请求体，超过上限立即中止"""
+    length = request.headers.get('content-length')
+    if length and length.isdigit() and int(length) > PROBE_BODY_LIMIT: raise ProbeBodyTooLarge()
+    parts, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > PROBE_BODY_LIMIT: raise ProbeBodyTooLarge()
+        parts.append(chunk)
+    return b''.join(parts)
+
+
+def _decompress_limited(body, encoding):
+    """流式解压，输出超过 PROBE_BODY_LIMIT 即中止 (不会先整体解压到内存)"""
+    if encoding == 'gzip':
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = d.decompress(body, PROBE_BODY_LIMIT + 1)
+        if len(out) > PROBE_BODY_LIMIT or d.unconsumed_tail: raise ProbeBodyTooLarge()
+        return out
+    if encoding == 'zstd':
+        if zstd is None: raise ValueError("zstd not supported")
+        reader = zstd.ZstdDecompressor().stream_reader(io.BytesIO(body))
+        parts, size = [], 0
+        while True:
+            chunk = reader.read(65536)
+            if not chunk: break
+            size += len(chunk)
+            if size > PROBE_BODY_LIMIT: raise ProbeBodyTooLarge()
+            parts.append(chunk)
+        return b''.join(parts)
+    return body
+
+
+async def _read_probe_body(request: Request):
+    """读取探针请求体：支持 gzip / zstd 压缩与 JSON / msgpack 编码；超过上限抛 ProbeBodyTooLarge"""
+    body = await _read_limited(request)
+    body = _decompress_limited(body, (request.headers.get('content-encoding') or '').lower())
+
+    if 'msgpack' in (request.headers.get('content-type') or ''):
+        if msgpack is None: raise ValueError("msgpack not supported")
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def _unpack_metrics(data):
+    """将 mb 二进制指标还原为普通帧字段"""
+    vals = struct.unpack(_METRICS_FMT, base64.b64decode(data.pop('mb')))
+    if vals[0] != 1: return
+    n = len(_METRICS_KEYS)
+    for k, v in zip(_METRICS_KEYS, vals[1:1 + n]):
+        data[k] = round(v, 2) if isinstance(v, float) else v
+    u = data['uptime_s']
+    data['uptime'] = "%d天 %d时 %d分" % (u // 86400, (u % 86400) // 3600, (u % 3600) // 60)
+    data['pings'] = dict(zip(_PING_KEYS, vals[1 + n:]))
+
+
+def _patch_xui_traffic(cached_nodes, traffic_by_id):
+    """原地刷新缓存节点的流量计数 traffic_by_id: {id: (up, down, total)}"""
+    for n in cached_nodes:
+        fresh = traffic_by_id.get(n.get('id'))
+        if fresh:
+            for k, v in zip(_XUI_TRAFFIC_FIELDS, fresh):
+                if v is not None: n[k] = v
+            utils.node_model(n).set_traffic(n)
+
+
+async def _ingest_probe_frame(data):
+    """处理单个探针推送帧，返回 (状态码, 文本)；单推与批量接口共用"""
+    if not isinstance(data, dict): return 400, "Bad Frame"
+    token = data.get('token')
+    server_url = data.get('server_url')
+
+    # 1. 校验 Token
+    correct_token = state.ADMIN_CONFIG.get('probe_token')
+    if not token or token != correct_token:
+        return 403, "Invalid Token"
+
+    if data.get('mb'):
+        try:
+            _unpack_metrics(data)
+        except Exception:
+            return 400, "Bad Metrics"
+
+    # 2. 查找服务器 (精准匹配 -> IP匹配，均走索引)
+    target_server = state.SERVER_REGISTRY.find(server_url)
+
+    if target_server:
+        srv_url = target_server['url']
+        prev = state.PROBE_DATA_CACHE.get(srv_url) or {}
+
+        # 2.1 增量帧校验：引用的版本必须与面板记录一致，否则要求全量重发
+        if 'static' in data:
+            state.PROBE_STATIC_REVS[srv_url] = data.get('static_rev')
+        elif data.get('static_rev'):
+            if not prev.get('static') or state.PROBE_STATIC_REVS.get(srv_url) != data['static_rev']:
+                return 409, "RESYNC"
+            data['static'] = prev['static']
+
+        raw_nodes = data.pop('xui_data', None)
+        xui_rev = data.get('xui_rev')
+        if raw_nodes is None and xui_rev:
+            if state.NODES_DATA.get(srv_url) is None or state.PROBE_XUI_REVS.get(srv_url) != xui_rev:
+                return 409, "RESYNC"
+
+        # 激活探针状态
+        if not target_server.get('probe_installed'):
+            target_server['probe_installed'] = True
+
+        # 3. 写入基础监控数据缓存
+        data['status'] = 'online'
+        data['last_updated'] = time.time()
+        state.PROBE_DATA_CACHE[srv_url] = data
+        logic.DASHBOARD.mark_dirty(srv_url)
+
+        # ✨✨✨ 核心逻辑：处理 X-UI 数据 & 自动命名 ✨✨✨
+        if raw_nodes is None and xui_rev:
+            # 增量帧：节点配置未变，仅更新流量
+            traffic = {row[0]: row[1:] for row in data.pop('xui_traffic', []) or [] if row}
+            _patch_xui_traffic(state.NODES_DATA[srv_url], traffic)
+            target_server['_status'] = 'online'
+
+        elif isinstance(raw_nodes, list):
+            # ⚡ 快速路径：节点配置未变化 (优先信任探针上报的 xui_rev)
+            xui_rev = xui_rev or _xui_signature(raw_nodes)
+            cached_nodes = state.NODES_DATA.get(srv_url)
+            if cached_nodes is not None and state.PROBE_XUI_REVS.get(srv_url) == xui_rev:
+                # 仅原地刷新流量计数，不重新解析、不替换缓存、不跑改名逻辑
+                traffic = {n.get('id'): tuple(n.get(k) for k in _XUI_TRAFFIC_FIELDS) for n in raw_nodes}
+                _patch_xui_traffic(cached_nodes, traffic)
+                target_server['_status'] = 'online'
+                logic.record_ping_history(srv_url, data.get('pings', {}))
+                return 200, "OK"
+
+            state.PROBE_XUI_REVS[srv_url] = xui_rev
+
+            # 更新节点缓存 (入库时统一解析 settings / streamSettings)
+            parsed_nodes = raw_nodes
+            logic.store_nodes(target_server['url'], parsed_nodes)
+            target_server['_status'] = 'online'
+
+            # 🟢 [新增补充]：自动同步名称逻辑 (当端口不通时依赖此逻辑)
+            # 只有当有节点，且当前名字看起来像默认IP时，才尝试修改
+            if parsed_nodes:
+                first_remark = parsed_nodes[0].get('remark', '').strip()
+                current_name = target_server.get('name', '').strip()
+
+                # 简单的判断：如果名字里没有这个备注
+                if first_remark and (first_remark not in current_name):
+
+                    # ✨✨✨ [修复]：先检查备注里是否自带了国旗 ✨✨✨
+                    has_own_flag = False
+                    # 遍历全局配置中的所有已知国旗
+                    for v in config.AUTO_COUNTRY_MAP.values():
+                        known_flag = v.split(' ')[0]  # 提取 "🇺🇸"
+                        if known_flag in first_remark:
+                            has_own_flag = True
+                            break
+
+                    if has_own_flag:
+                        # 情况 A：备注自带国旗 (如 "Oracle|🇺🇸凤凰城") -> 直接用，不加前缀
+                        new_name_candidate = first_remark
+                    else:
+                        # 情况 B：备注没国旗 -> 尝试继承旧国旗或查询 GeoIP 加上
+                        flag = "🏳️"
+                        # 1. 尝试沿用当前名字里的国旗
+                        if ' ' in current_name:
+                            parts = current_name.split(' ', 1)
+                            if len(parts[0]) < 10:
+                                flag = parts[0]
+                        else:
+                            # 2. 尝试重新获取国旗 (GeoIP)
+                            try:
+                                ip_key = target_server['url'].split('://')[-1].split(':')[0]
+                                geo_info = state.IP_GEO_CACHE.get(ip_key)
+                                if geo_info:
+                                    flag = utils.get_flag_for_country(geo_info[2]).split(' ')[0]
+                            except:
+                                pass
+
+                        new_name_candidate = f"{flag} {first_remark}"
+
+                    # 执行改名并保存
+                    if target_server['name'] != new_name_candidate:
+                        target_server['name'] = new_name_candidate
+                        asyncio.create_task(logic.save_servers())
+                        logger.info(f"🏷️ [探针同步] 根据节点备注自动改名: {new_name_candidate}")
+
+        # 记录历史
+        logic.record_ping_history(target_server['url'], data.get('pings', {}))
+
+    return 200, "OK"
+
+
 async def probe_push_data(request: Request):
     try:
-        data = await request.json()
-        token = data.get('token')
-        server_url = data.get('server_url')
+        try:
+            data = await _read_probe_body(request)
+        except ProbeBodyTooLarge:
+            return _too_large_response()
+        except Exception:
+            return Response("Unsupported Payload", 415)
+        if not isinstance(data, dict) or not data.get('token'): return Response("Invalid Token", 403)
+        code, msg = await _ingest_probe_frame(data)
+        return Response(msg, code)
+    except Exception:
+        return Response("Error", 500)
 
-        # 1. 校验 Token
-        correct_token = state.ADMIN_CONFIG.get('probe_token')
-        if not token or token != correct_token:
-            return Response("Invalid Token", 403)
 
-        # 2. 查找服务器 (精准匹配 -> IP匹配)
-        target_server = next((s for s in state.SERVERS_CACHE if s['url'] == server_url), None)
-        if not target_server:
-            try:
-                push_ip = server_url.split('://')[-1].split(':')[0]
-                for s in state.SERVERS_CACHE:
-                    cache_ip = s['url'].split('://')[-1].split(':')[0]
-                    if cache_ip == push_ip:
-                        target_server = s
-                        break
-            except:
-                pass
+# ================= 探针流式推送接口 (单条长连接持续上报) =================
+async def probe_push_stream(request: Request):
+    """
+    请求体为持续发送的 NDJSON 帧 (每行一帧，chunked 传输)，逐帧入库
+    任一帧需要全量重发或校验失败时提前结束并返回对应状态码
+    """
+    buf = b''
+    count = 0
+    try:
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) > PROBE_BODY_LIMIT and b'\n' not in buf: return _too_large_response()
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                if not line.strip(): continue
+                code, msg = await _ingest_probe_frame(json.loads(line))
+                if code != 200: return Response(msg, code)
+                count += 1
+        if buf.strip():
+            code, msg = await _ingest_probe_frame(json.loads(buf))
+            if code != 200: return Response(msg, code)
+            count += 1
+        return Response(f"OK {count}", 200)
+    except Exception:
+        return Response("Error", 500)
 
-        if target_server:
-            # 激活探针状态
-            if not target_server.get('probe_installed'):
-                target_server['probe_installed'] = True
 
-            # 3. 写入基础监控数据缓存
-            data['status'] = 'online'
-            data['last_updated'] = time.time()
-            state.PROBE_DATA_CACHE[target_server['url']] = data
-
-            # ✨✨✨ 核心逻辑：处理 X-UI 数据 & 自动命名 ✨✨✨
-            if 'xui_data' in data and isinstance(data['xui_data'], list):
-                # 解析节点
-                raw_nodes = data['xui_data']
-                parsed_nodes = []
-                for n in raw_nodes:
-                    try:
-                        if isinstance(n.get('settings'), str):
-                            n['settings'] = json.loads(n['settings'])
-                        if isinstance(n.get('streamSettings'), str):
-                            n['streamSettings'] = json.loads(n['streamSettings'])
-                        parsed_nodes.append(n)
-                    except:
-                        parsed_nodes.append(n)
-
-                # 更新节点缓存
-                state.NODES_DATA[target_server['url']] = parsed_nodes
-                target_server['_status'] = 'online'
+# ================= 探针批量推送接口 (中继/汇聚节点使用) =================
+async def probe_push_batch(request: Request):
+    """
+    一次请求携带多台服务器的推送帧: {"token": "...", "frames": [frame, ...]}
+    每帧走与 /api/probe/push 相同的处理逻辑 (各帧必须自带 token，不继承外层 token)，按顺序返回各帧结果
+    """
+    try:
+        try:
+            body = await _read_probe_body(request)
+        except ProbeBodyTooLarge:
+            return _too_large_response()
+        except Exception:
+            return Response("Unsupported Payload", 415)
+        frames = body if isinstance(body, list) else (body.get('frames', []) or [])
+
+        results = []
+        for frame in frames:
+            try:
+                code, msg = await _ingest_probe_frame(frame)
+            except Exception:
+                msg = "Error"
+            results.append(msg)
 
-                # 🟢 [新增补充]：自动同步名称逻辑 (当端口不通时依赖此逻辑)
-                # 只有当有节点，且当前名字看起来像默认IP时，才尝试修改
-                if parsed_nodes:
-                    first_remark = parsed_nodes[0].get('remark', '').strip()
-                    current_name = target_server.get('name', '').strip()
-
-                    # 简单的判断：如果名字里没有这个备注
-                    if first_remark and (first_remark not in current_name):
-
-                        # ✨✨✨ [修复]：先检查备注里是否自带了国旗 ✨✨✨
-                        has_own_flag = False
-                        # 遍历全局配置中的所有已知国旗
-                        for v in config.AUTO_COUNTRY_MAP.values():
-                            known_flag = v.split(' ')[0]  # 提取 "🇺🇸"
-                            if known_flag in first_remark:
-                                has_own_flag = True
-                                break
-
-                        if has_own_flag:
-                            # 情况 A：备注自带国旗 (如 "Oracle|🇺🇸凤凰城") -> 直接用，不加前缀
-                            new_name_candidate = first_remark
-                        else:
-                            # 情况 B：备注没国旗 -> 尝试继承旧国旗或查询 GeoIP 加上
-                            flag = "🏳️"
-                            # 1. 尝试沿用当前名字里的国旗
-                            if ' ' in current_name:
-                                parts = current_name.split(' ', 1)
-                                if len(parts[0]) < 10:
-                                    flag = parts[0]
-                            else:
-                                # 2. 尝试重新获取国旗 (GeoIP)
-                                try:
-                                    ip_key = target_server['url'].split('://')[-1].split(':')[0]
-                                    geo_info = state.IP_GEO_CACHE.get(ip_key)
-                                    if geo_info:
-                                        flag = utils.get_flag_for_country(geo_info[2]).split(' ')[0]
-                                except:
-                                    pass
-
-                            new_name_candidate = f"{flag} {first_remark}"
-
-                        # 执行改名并保存
-                        if target_server['name'] != new_name_candidate:
-                            target_server['name'] = new_name_candidate
-                            asyncio.create_task(logic.save_servers())
-                            logger.info(f"🏷️ [探针同步] 根据节点备注自动改名: {new_name_candidate}")
-
-            # 记录历史
-            logic.record_ping_history(target_server['url'], data.get('pings', {}))
-
-        return Response("OK", 200)
-    except Exception as e:
+        return Response(json.dumps({"results": results}), status_code=200, media_type="application/json")
+    except Exception:
         return Response("Error", 500)
 
 
+# ================= 订阅节点收集 (供各订阅接口共用) =================
+def _link_host(raw_url):
+    """从服务器 url 中取出用于生成链接的 Host"""
+    try:
+        if '://' not in raw_url: raw_url = f'http://{raw_url}'
+        parsed = urlparse(raw_url)
+        return parsed.hostname or raw_url.split('://')[-1].split(':')[0]
+    except:
+        return raw_url
+
+
+def _collect_sub_nodes(sub):
+    """按订阅中保存的顺序取出 (节点, Host)，同时返回所依赖的服务器 url"""
+    lookups = {}
+    items = []
+    for key in sub.get('nodes', []):
+        url = key.rsplit('|', 1)[0]
+        if url not in lookups:
+            node_map = {}
+            # 格式: { 'url|id': node }；url 重复时按列表顺序后者覆盖前者，自定义节点覆盖同 id 面板节点
+            for srv in state.SERVER_REGISTRY.get_all_by_url(url):
+                for n in (state.NODES_DATA.get(url, []) or []) + (srv.get('custom_nodes', []) or []):
+                    node_map[f"{url}|{n['id']}"] = n
+            lookups[url] = (node_map, _link_host(url))
+        node_map, host = lookups[url]
+        if key in node_map:
+            items.append((node_map[key], host))
+    return items, list(lookups.keys())
+
+
+def _sub_fingerprint(sub):
+    """订阅自身的版本：节点顺序 + 选项 (只影响这一条订阅的缓存)"""
+    return id(sub), tuple(sub.get('nodes', [])), repr(sorted((sub.get('options') or {}).items()))
+
+
+def _group_fingerprint(group_name):
+    return state.SERVER_REGISTRY.member_rev(group_name)
+
+
+def _collect_group_nodes(group_name):
+    """分组 (主分组或 Tag) 下所有启用的节点"""
+    items = []
+    urls = []
+    for srv in state.SERVER_REGISTRY.in_group_or_tag(group_name):
+        urls.append(srv['url'])
+        all_nodes = (state.NODES_DATA.get(srv['url'], []) or []) + (srv.get('custom_nodes', []) or [])
+        if not all_nodes: continue
+        host = _link_host(srv['url'])
+        for n in all_nodes:
+            if n.get('enable'): items.append((n, host))
+    return items, urls
+
+
+def _node_share_link(node, host):
+    # A. 优先使用原始链接  B. 生成标准链接
+    return node.get('_raw_link') or utils.generate_node_link(node, host)
+
+
+def _native_flag(name):
+    """按节点名识别国家，返回国旗；识别不出返回空串"""
+    if name and 0x1F1E6 <= ord(name[0]) <= 0x1F1FF: return ''
+    flag = logic.detect_country_group(name).split(' ')[0]
+    return '' if flag == '🏳️' else flag
+
+
+def _sub_include_regex(opt):
+    """订阅选项中的 include 正则 + 地区筛选，合成一个正则"""
+    includes = []
+    if opt.get('include_regex'): includes.append(opt['include_regex'])
+    regions = opt.get('regions', [])
+    if regions:
+        region_keywords = []
+        for r in regions:
+            parts = r.split(' ');
+            k = parts[1] if len(parts) > 1 else r
+            region_keywords.append(k)
+            for c, v in config.AUTO_COUNTRY_MAP.items():
+                if v == r and len(c) == 2: region_keywords.append(c)
+        if region_keywords: includes.append(f"({'|'.join(region_keywords)})")
+    return "|".join(includes)
+
+
+def _apply_sub_options(proxies, opt):
+    """include / exclude 过滤 -> 正则重命名 -> 国旗前缀 (与 SubConverter 的处理顺序一致)"""
+    include = _sub_include_regex(opt)
+    exclude = opt.get('exclude_regex', '')
+    ren_pat = opt.get('rename_pattern', '')
+    emoji = opt.get('emoji', True)
+
+    result = []
+    for p in proxies:
+        name = p['name']
+        try:
+            if include and not re.search(include, name): continue
+            if exclude and re.search(exclude, name): continue
+            if ren_pat: name = re.sub(ren_pat, opt.get('rename_replacement', ''), name)
+        except re.error:
+            pass
+        if emoji:
+            flag = _native_flag(name)
+            if flag: name = f"{flag} {name}"
+        result.append(dict(p, name=name))
+    return _dedupe_proxy_names(result)
+
+
+def _dedupe_proxy_names(proxies):
+    """客户端按名字引用节点，重名时依次追加 ' 2' / ' 3' ..."""
+    used = {p['name'] for p in proxies}
+    seen = set()
+    for p in proxies:
+        name = p['name']
+        if name in seen:
+            i = 2
+            while f"{name} {i}" in used: i += 1
+            p['name'] = f"{name} {i}"
+            used.add(p['name'])
+        seen.add(p['name'])
+    return proxies
+
+
+# 分组订阅原先走 SubConverter 时只带 udp=true / scv=true，不加国旗
+_GROUP_NATIVE_OPTIONS = {'emoji': False, 'udp': True, 'skip_cert': True}
+
+
+def _native_entry(cache_key, collect, target, opt, extra=()):
+    """进程内直接渲染 Clash / Surge / sing-box 配置，省去 SubConverter 往返"""
+    cached = logic.get_cached_sub(cache_key, extra)
+    if not cached:
+        items, urls = collect()
+        proxies = [p for p in (utils.node_to_proxy(n, h) for n, h in items) if p]
+        proxies = _apply_sub_options(proxies, opt)
+        body = utils.NATIVE_RENDERERS[target](
+            proxies, udp=bool(opt.get('udp', True)), tfo=bool(opt.get('tfo', False)),
+            skip_cert=bool(opt.get('skip_cert', True)))
+        cached = logic.put_cached_sub(cache_key, urls, body, extra)
+    return cached
+
+
+def _native_media_type(target):
+    if target in ('singbox', 'sing-box'): return "application/json; charset=utf-8"
+    return "text/plain; charset=utf-8"
+
+
+def _sub_response(request, entry, media_type="text/plain; charset=utf-8"):
+    """带 ETag / Last-Modified 的订阅响应，客户端缓存未过期时返回 304"""
+    headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache'}
+    if entry.get('ts'): headers['Last-Modified'] = formatdate(entry['ts'], usegmt=True)
+
+    req_headers = request.headers if request is not None else {}
+    if_none_match = req_headers.get('if-none-match')
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        tags = [t[2:] if t.startswith('W/') else t for t in tags]
+        if '*' in tags or entry['etag'] in tags:
+            return Response(status_code=304, headers=headers)
+    elif entry.get('ts') and req_headers.get('if-modified-since'):
+        try:
+            since = parsedate_to_datetime(req_headers['if-modified-since']).timestamp()
+            if int(entry['ts']) <= since:
+                return Response(status_code=304, headers=headers)
+        except Exception:
+            pass
+
+    return Response(entry['body'], media_type=media_type, headers=headers)
+
+
 # =================  订阅接口：严格遵循自定义顺序 =================
-async def sub_handler(token: str, request: Request):
-    sub = next((s for s in state.SUBS_CACHE if s['token'] == token), None)
-    if not sub: return Response("Invalid Token", 404)
+def _get_sub_entry(token, sub):
+    cache_key = ('sub', token)
+    extra = _sub_fingerprint(sub)
+    cached = logic.get_cached_sub(cache_key, extra)
+    if not cached:
+        items, urls = _collect_sub_nodes(sub)
+        links = [l for l in (_node_share_link(n, h) for n, h in items) if l]
+        cached = logic.put_cached_sub(cache_key, urls, utils.safe_base64("\n".join(links)), extra)
+    return cached
 
-    links = []
 
-    # 1. 构建快速查找字典 (Map)
-    # 格式: { 'url|id': (node_data, server_host) }
-    node_lookup = {}
+NODES_READY_TIMEOUT = 15  # 启动时节点缓存仍在后台加载，订阅请求最多等待的秒数
 
-    for srv in state.SERVERS_CACHE:
-        # 获取 Host
-        raw_url = srv['url']
-        try:
-            if '://' not in raw_url: raw_url = f'http://{raw_url}'
-            parsed = urlparse(raw_url)
-            host = parsed.hostname or raw_url.split('://')[-1].split(':')[0]
-        except:
-            host = raw_url
-
-        # 收集面板节点
-        panel_nodes = state.NODES_DATA.get(srv['url'], []) or []
-        for n in panel_nodes:
-            key = f"{srv['url']}|{n['id']}"
-            node_lookup[key] = (n, host)
-
-        # 收集自定义节点
-        custom_nodes = srv.get('custom_nodes', []) or []
-        for n in custom_nodes:
-            key = f"{srv['url']}|{n['id']}"
-            node_lookup[key] = (n, host)
-
-    # 2. 按照订阅中保存的顺序生成链接
-    ordered_ids = sub.get('nodes', [])
-
-    for key in ordered_ids:
-        if key in node_lookup:
-            node, host = node_lookup[key]
-
-            # A. 优先使用原始链接
-            if node.get('_raw_link'):
-                links.append(node['_raw_link'])
-            # B. 生成标准链接
-            else:
-                l = utils.generate_node_link(node, host)
-                if l: links.append(l)
-
-    return Response(utils.safe_base64("\n".join(links)), media_type="text/plain; charset=utf-8")
 
+async def _wait_nodes_ready():
+    """等节点缓存加载完成再渲染订阅，避免启动瞬间输出 (并缓存) 缺节点的内容"""
+    deadline = time.monotonic() + NODES_READY_TIMEOUT
+    while not state.NODES_CACHE_READY.is_set():
+        if time.monotonic() >= deadline: return False
+        await asyncio.sleep(0.1)
+    return True
 
-# ================= 分组订阅接口：支持 Tag 和 主分组 =================
-async def group_sub_handler(group_b64: str, request: Request):
-    group_name = utils.decode_base64_safe(group_b64)
-    if not group_name: return Response("Invalid Group Name", 400)
 
-    links = []
+def _loading_response():
+    return Response("Node cache is loading, retry later", status_code=503, headers={'Retry-After': '5'})
 
-    # 筛选符合分组的服务器
-    target_servers = [
-        s for s in state.SERVERS_CACHE
-        if s.get('group', '默认分组') == group_name or group_name in s.get('tags', [])
-    ]
 
-    logger.info(f"正在生成分组订阅: [{group_name}]，匹配到 {len(target_servers)} 个服务器")
+async def sub_handler(token: str, request: Request):
+    if not await _wait_nodes_ready(): return _loading_response()
+    sub = next((s for s in state.SUBS_CACHE if s['token'] == token), None)
+    if not sub: return Response("Invalid Token", 404)
 
-    for srv in target_servers:
-        # 1. 获取面板节点
-        panel_nodes = state.NODES_DATA.get(srv['url'], []) or []
-        # 2. 获取自定义节点
-        custom_nodes = srv.get('custom_nodes', []) or []
-        # === 合并 ===
-        all_nodes = panel_nodes + custom_nodes
+    return _sub_response(request, _get_sub_entry(token, sub))
 
-        if not all_nodes: continue
 
-        raw_url = srv['url']
-        try:
-            if '://' not in raw_url: raw_url = f'http://{raw_url}'
-            parsed = urlparse(raw_url);
-            host = parsed.hostname or raw_url.split('://')[-1].split(':')[0]
-        except:
-            host = raw_url
+# ================= 分组订阅接口：支持 Tag 和 主分组 =================
+def _get_group_entry(group_name):
+    cache_key = ('group', group_name)
+    extra = _group_fingerprint(group_name)
+    cached = logic.get_cached_sub(cache_key, extra)
+    if not cached:
+        items, urls = _collect_group_nodes(group_name)
+        logger.info(f"正在生成分组订阅: [{group_name}]，匹配到 {len(urls)} 个服务器")
+        links = [l for l in (_node_share_link(n, h) for n, h in items) if l]
+        if links:
+            body = utils.safe_base64("\n".join(links))
+        else:
+            body = f"// Group [{group_name}] is empty or not found"
+        cached = logic.put_cached_sub(cache_key, urls, body, extra)
+    return cached
 
-        for n in all_nodes:
-            if n.get('enable'):
-                # A. 优先使用原始链接
-                if n.get('_raw_link'):
-                    links.append(n['_raw_link'])
-                # B. 生成面板节点链接
-                else:
-                    l = utils.generate_node_link(n, host)
-                    if l: links.append(l)
 
-    if not links:
-        return Response(f"// Group [{group_name}] is empty or not found", media_type="text/plain; charset=utf-8")
+async def group_sub_handler(group_b64: str, request: Request):
+    if not await _wait_nodes_ready(): return _loading_response()
+    group_name = utils.decode_base64_safe(group_b64)
+    if not group_name: return Response("Invalid Group Name", 400)
 
-    return Response(utils.safe_base64("\n".join(links)), media_type="text/plain; charset=utf-8")
+    return _sub_response(request, _get_group_entry(group_name))
 
 
 # ================= 短链接接口：分组 (完美混合版) =================
 async def short_group_handler(target: str, group_b64: str, request: Request):
+    if not await _wait_nodes_ready(): return _loading_response()
     try:
         group_name = utils.decode_base64_safe(group_b64)
         if not group_name: return Response("Invalid Group Name", 400)
 
         # -------------------------------------------------------------
-        # 策略 A: 针对 Surge / Loon -> 使用 Python 原生生成 (解决 Hy2 无法转换 + VMess 格式问题)
+        # 策略 A: Clash / Surge / sing-box -> Python 原生生成
         # -------------------------------------------------------------
-        if target == 'surge':
-            links = []
-
-            # 1. 筛选服务器
-            target_servers = [
-                s for s in state.SERVERS_CACHE
-                if s.get('group', '默认分组') == group_name or group_name in s.get('tags', [])
-            ]
-
-            # 2. 遍历服务器生成配置
-            for srv in target_servers:
-                panel_nodes = state.NODES_DATA.get(srv['url'], []) or []
-                custom_nodes = srv.get('custom_nodes', []) or []
-
-                # 获取干净的 Host
-                raw_url = srv['url']
-                try:
-                    if '://' not in raw_url: raw_url = f'http://{raw_url}'
-                    parsed = urlparse(raw_url)
-                    host = parsed.hostname or raw_url.split('://')[-1].split(':')[0]
-                except:
-                    host = raw_url
-
-                # 合并处理面板节点和自定义节点
-                for n in (panel_nodes + custom_nodes):
-                    if n.get('enable'):
-                        # 调用我们修复后的 generate_detail_config
-                        line = utils.generate_detail_config(n, host)
-                        if line and not line.startswith('//') and not line.startswith('None'):
-                            links.append(line)
-
-            if not links:
-                return Response(f"// Group [{group_name}] is empty", media_type="text/plain; charset=utf-8")
-
-            return Response("\n".join(links), media_type="text/plain; charset=utf-8")
+        if target in utils.NATIVE_RENDERERS:
+            entry = _native_entry(('native', target, 'group', group_name),
+                                  lambda: _collect_group_nodes(group_name), target, _GROUP_NATIVE_OPTIONS,
+                                  _group_fingerprint(group_name))
+            return _sub_response(request, entry, _native_media_type(target))
 
         # -------------------------------------------------------------
-        # 策略 B: 针对 Clash / 其他 -> 继续使用 SubConverter
+        # 策略 B: 其他客户端 -> 继续使用 SubConverter
         # -------------------------------------------------------------
         custom_base = state.ADMIN_CONFIG.get('manager_base_url', '').strip().rstrip('/')
         if custom_base:
@@ -295,19 +597,13 @@ async def short_group_handler(target: str, group_b64: str, request: Request):
             "scv": "true"
         }
 
-        converter_api = "http://subconverter:25500/sub"
-
-        def _fetch_sync():
-            try:
-                return requests.get(converter_api, params=params, timeout=10)
-            except:
-                return None
-
-        response = await logic.run_in_bg_executor(_fetch_sync)
-        if response and response.status_code == 200:
-            return Response(content=response.content, media_type="text/plain; charset=utf-8")
+        # 源订阅内容的 ETag 作为版本号：内容不变则直接复用上次的转换结果
+        source_rev = _get_group_entry(group_name)['etag']
+        entry, status = await logic.fetch_subconverter(params, source_rev)
+        if entry:
+            return _sub_response(request, entry)
         else:
-            return Response(f"SubConverter Error (Code: {getattr(response, 'status_code', 'Unk')})", status_code=502)
+            return Response(f"SubConverter Error (Code: {status or 'Unk'})", status_code=502)
 
     except Exception as e:
         return Response(f"Error: {str(e)}", status_code=500)
@@ -315,49 +611,23 @@ async def short_group_handler(target: str, group_b64: str, request: Request):
 
 # ================= 短链接接口：严格遵循自定义顺序 =================
 async def short_sub_handler(target: str, token: str, request: Request):
+    if not await _wait_nodes_ready(): return _loading_response()
     try:
         sub_obj = next((s for s in state.SUBS_CACHE if s['token'] == token), None)
         if not sub_obj: return Response("Subscription Not Found", 404)
+        opt = sub_obj.get('options', {})
 
         # -------------------------------------------------------------
-        # 策略 A: 针对 Surge -> Python 原生生成 (严格顺序版)
+        # 策略 A: Clash / Surge / sing-box -> Python 原生生成 (严格顺序版)
         # -------------------------------------------------------------
-        if target == 'surge':
-            links = []
-
-            # 1. 构建查找字典
-            node_lookup = {}
-            for srv in state.SERVERS_CACHE:
-                # 解析 Host
-                raw_url = srv['url']
-                try:
-                    if '://' not in raw_url: raw_url = f'http://{raw_url}'
-                    parsed = urlparse(raw_url)
-                    host = parsed.hostname or raw_url.split('://')[-1].split(':')[0]
-                except:
-                    host = raw_url
-
-                # 收集所有节点
-                all_nodes = (state.NODES_DATA.get(srv['url'], []) or []) + srv.get('custom_nodes', [])
-                for n in all_nodes:
-                    key = f"{srv['url']}|{n['id']}"
-                    node_lookup[key] = (n, host)
-
-            # 2. 按顺序生成配置
-            ordered_ids = sub_obj.get('nodes', [])
-
-            for key in ordered_ids:
-                if key in node_lookup:
-                    node, host = node_lookup[key]
-                    # 生成 Surge 配置行
-                    line = utils.generate_detail_config(node, host)
-                    if line and not line.startswith('//') and not line.startswith('None'):
-                        links.append(line)
-
-            return Response("\n".join(links), media_type="text/plain; charset=utf-8")
+        if target in utils.NATIVE_RENDERERS:
+            entry = _native_entry(('native', target, 'sub', token),
+                                  lambda: _collect_sub_nodes(sub_obj), target, opt,
+                                  _sub_fingerprint(sub_obj))
+            return _sub_response(request, entry, _native_media_type(target))
 
         # -------------------------------------------------------------
-        # 策略 B: Clash / 其他 -> SubConverter
+        # 策略 B: 其他客户端 -> SubConverter
         # -------------------------------------------------------------
 
         custom_base = state.ADMIN_CONFIG.get('manager_base_url', '').strip().rstrip('/')
@@ -369,7 +639,6 @@ async def short_sub_handler(target: str, token: str, request: Request):
             base_url = f"{scheme}://{host}"
 
         internal_api = f"{base_url}/sub/{token}"
-        opt = sub_obj.get('options', {})
 
         params = {
             "target": target, "url": internal_api,
@@ -383,38 +652,19 @@ async def short_sub_handler(target: str, token: str, request: Request):
         }
 
         # 处理正则过滤 (保持原样)
-        regions = opt.get('regions', [])
-        includes = []
-        if opt.get('include_regex'): includes.append(opt['include_regex'])
-        if regions:
-            region_keywords = []
-            for r in regions:
-                parts = r.split(' ');
-                k = parts[1] if len(parts) > 1 else r
-                region_keywords.append(k)
-                for c, v in config.AUTO_COUNTRY_MAP.items():
-                    if v == r and len(c) == 2: region_keywords.append(c)
-            if region_keywords: includes.append(f"({'|'.join(region_keywords)})")
-
-        if includes: params['include'] = "|".join(includes)
+        include = _sub_include_regex(opt)
+        if include: params['include'] = include
         if opt.get('exclude_regex'): params['exclude'] = opt['exclude_regex']
 
         ren_pat = opt.get('rename_pattern', '')
         if ren_pat: params['rename'] = f"{ren_pat}@{opt.get('rename_replacement', '')}"
 
-        converter_api = "http://subconverter:25500/sub"
-
-        def _fetch_sync():
-            try:
-                return requests.get(converter_api, params=params, timeout=10)
-            except:
-                return None
-
-        response = await logic.run_in_bg_executor(_fetch_sync)
-        if response and response.status_code == 200:
-            return Response(content=response.content, media_type="text/plain; charset=utf-8")
+        source_rev = _get_sub_entry(token, sub_obj)['etag']
+        entry, status = await logic.fetch_subconverter(params, source_rev)
+        if entry:
+            return _sub_response(request, entry)
         else:
-            return Response(f"SubConverter Error (Code: {getattr(response, 'status_code', 'Unk')})", status_code=502)
+            return Response(f"SubConverter Error (Code: {status or 'Unk'})", status_code=502)
 
     except Exception as e:
         return Response(f"Error: {str(e)}", status_code=500)
@@ -438,11 +688,8 @@ async def probe_register(request: Request):
         # 3. ✨✨✨ 智能查重逻辑 (核心修改) ✨✨✨
         target_server = None
 
-        # 策略 A: 直接字符串匹配 (命中纯 IP 注册的情况)
-        for s in state.SERVERS_CACHE:
-            if client_ip in s['url']:
-                target_server = s
-                break
+        # 策略 A: IP 索引匹配 (命中纯 IP 注册的情况)
+        target_server = state.SERVER_REGISTRY.get_by_host(client_ip) or state.SERVER_REGISTRY.get_by_ssh_host(client_ip)
 
         # 策略 B: 如果没找到，尝试 DNS 反向解析 (命中域名注册的情况)
         if not target_server:
@@ -488,7 +735,7 @@ async def probe_register(request: Request):
                 'probe_installed': True,
                 '_status': 'online'
             }
-            state.SERVERS_CACHE.append(new_server)
+            state.SERVER_REGISTRY.add(new_server)
             await logic.save_servers()
 
             # 触发强制重命名
@@ -550,27 +797,21 @@ async def auto_register_node(request: Request):
             'probe_installed': False
         }
 
-        # 5. 查重与更新逻辑
-        existing_index = -1
-        # 标准化 URL 进行比对
-        for idx, srv in enumerate(state.SERVERS_CACHE):
-            cache_url = srv['url'].replace('http://', '').replace('https://', '')
-            new_url_clean = target_url.replace('http://', '').replace('https://', '')
-            if cache_url == new_url_clean:
-                existing_index = idx
-                break
+        # 5. 查重与更新逻辑 (忽略协议头的 URL 索引)
+        existing = state.SERVER_REGISTRY.get_by_addr(target_url)
 
         action_msg = ""
         target_server_ref = None
 
-        if existing_index != -1:
+        if existing is not None:
             # 更新现有节点
-            state.SERVERS_CACHE[existing_index].update(new_server_config)
-            target_server_ref = state.SERVERS_CACHE[existing_index]
+            existing.update(new_server_config)
+            state.SERVER_REGISTRY.reindex(existing)
+            target_server_ref = existing
             action_msg = f"🔄 更新节点: {alias}"
         else:
             # 新增节点
-            state.SERVERS_CACHE.append(new_server_config)
+            state.SERVER_REGISTRY.add(new_server_config)
             target_server_ref = new_server_config
             action_msg = f"✅ 新增节点: {alias}"
 
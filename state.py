@@ -1,16 +1,27 @@
 # state.py
 import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # 全局变量初始化
 SERVERS_CACHE = []
 SUBS_CACHE = []
 NODES_DATA = {}
+NODES_CACHE_READY = threading.Event()  # 节点缓存 (后台) 加载完成
+NODE_MODELS = {}  # id(node) -> NodeModel，节点入库时预解析 (不持有节点本身)
+NODE_MODEL_KEYS = {}  # url -> [id(node), ...]，替换节点列表时清理旧模型
 ADMIN_CONFIG = {}
 IP_GEO_CACHE = {}
 DNS_CACHE = {}
 DNS_WAITING_LABELS = {}
 PROBE_DATA_CACHE = {}
+PROBE_XUI_REVS = {}  # url -> 探针上报 X-UI 节点配置的内容指纹 (未变化时跳过解析)
+PROBE_STATIC_REVS = {}  # url -> 探针静态信息版本 (增量帧引用校验)
+
+# 订阅渲染缓存 & 依赖版本号
+NODES_REV = {}  # url -> 节点列表版本号 (节点配置变化时递增)
+DATA_REV = {'servers': 0, 'subs': 0, 'nodes': 0}  # 整体保存时递增
+SUB_RENDER_CACHE = {}
 PING_TREND_CACHE = {}
 PING_CACHE = {}
 RENDERED_CARDS = {}
@@ -18,6 +29,204 @@ LAST_SYNC_MAP = {}
 REFRESH_LOCKS = set()
 EXPANDED_GROUPS = set()
 
+
+
+def url_host(url):
+    """提取 URL 中的主机部分 (与各处 split('://')[-1].split(':')[0] 写法保持一致)"""
+    if not url: return ''
+    return url.split('://')[-1].split(':')[0].split('/')[0]
+
+
+class ServerRegistry:
+    """服务器索引表：在 SERVERS_CACHE 之上维护二级索引，热点路径 O(1) 查找"""
+
+    def __init__(self):
+        self._list_id = None
+        self._list_len = -1
+        self.by_url = {}
+        self.by_addr = {}      # 去掉协议头的 url (ip:port)
+        self.by_host = {}      # url 中的 host / IP
+        self.by_ssh_host = {}
+        self.by_group = {}     # group -> {id(s): s}，dict 保持插入顺序
+        self.by_tag = {}
+        # 唯一键的全部持有者：键名 -> {键值: {id(s): s}}；by_xxx 取其中列表顺序最靠前的一台
+        self._buckets = {name: {} for name in self._UNIQUE_KEYS}
+        self.by_url_all = self._buckets['url']  # url -> {id(s): s}，url 重复时保留全部
+        self.member_revs = {}  # 分组 / Tag -> 成员变动次数 (分组订阅缓存依赖)
+        self._keys = {}        # id(s) -> 上次入索引时的键，用于增量更新
+        self._seq = 0          # 入索引顺序，用于合并结果时还原列表顺序
+
+    # ---------- 维护 ----------
+    def _ensure(self):
+        """SERVERS_CACHE 被整体替换 (init_data) 或被外部直接增删时，自动重建"""
+        if self._list_id != id(SERVERS_CACHE) or self._list_len != len(SERVERS_CACHE):
+            self.rebuild()
+
+    def rebuild(self):
+        self.by_url.clear(); self.by_addr.clear(); self.by_host.clear(); self.by_ssh_host.clear()
+        self.by_group.clear(); self.by_tag.clear(); self._keys.clear()
+        for bucket in self._buckets.values(): bucket.clear()
+        for name in self.member_revs: self.member_revs[name] += 1
+        self._seq = 0
+        for s in SERVERS_CACHE: self._index(s)
+        self._list_id = id(SERVERS_CACHE)
+        self._list_len = len(SERVERS_CACHE)
+
+    def _index(self, s, seq=None):
+        url = s.get('url') or ''
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        keys = {
+            'seq': seq,
+            'url': url,
+            'addr': url.split('://')[-1],
+            'host': url_host(url),
+            'ssh_host': s.get('ssh_host') or '',
+            'group': s.get('group', '默认分组'),
+            'tags': tuple(s.get('tags', []) or []),
+        }
+        self._keys[id(s)] = keys
+        for name in self._UNIQUE_KEYS:
+            k = keys[name]
+            if not k: continue
+            self._buckets[name].setdefault(k, {})[id(s)] = s
+            # 同键多台时按列表顺序取第一台 (与原先 next() 遍历列表的语义一致)
+            idx = self._unique_index(name)
+            cur = idx.get(k)
+            if cur is None or seq < self._keys[id(cur)]['seq']: idx[k] = s
+        self.by_group.setdefault(keys['group'], {})[id(s)] = s
+        for t in keys['tags']: self.by_tag.setdefault(t, {})[id(s)] = s
+        self._bump_members(keys)
+
+    def _bump_members(self, keys):
+        for name in (keys['group'],) + keys['tags']:
+            self.member_revs[name] = self.member_revs.get(name, 0) + 1
+
+    _UNIQUE_KEYS = ('url', 'addr', 'host', 'ssh_host')
+
+    def _unique_index(self, key):
+        return {'url': self.by_url, 'addr': self.by_addr, 'host': self.by_host, 'ssh_host': self.by_ssh_host}[key]
+
+    def _unindex(self, s):
+        keys = self._keys.pop(id(s), None)
+        if not keys: return
+        for name in self._UNIQUE_KEYS:
+            k = keys[name]
+            if not k: continue
+            buckets, idx = self._buckets[name], self._unique_index(name)
+            bucket = buckets.get(k)
+            if bucket is not None:
+                bucket.pop(id(s), None)
+                if not bucket: del buckets[k]
+            if idx.get(k) is s:
+                # 同键的其他服务器顶上：只在同键的桶内找列表顺序最靠前的一台
+                if bucket:
+                    idx[k] = min(bucket.values(), key=lambda o: self._keys[id(o)]['seq'])
+                else:
+                    del idx[k]
+        self._bump_members(keys)
+        bucket = self.by_group.get(keys['group'])
+        if bucket is not None:
+            bucket.pop(id(s), None)
+            if not bucket: del self.by_group[keys['group']]
+        for t in keys['tags']:
+            bucket = self.by_tag.get(t)
+            if bucket is not None:
+                bucket.pop(id(s), None)
+                if not bucket: del self.by_tag[t]
+
+    def add(self, s):
+        """追加新服务器 (同时写入 SERVERS_CACHE)"""
+        self._ensure()
+        SERVERS_CACHE.append(s)
+        self._index(s)
+        self._list_len = len(SERVERS_CACHE)
+
+    def remove(self, s):
+        """删除服务器 (同时从 SERVERS_CACHE 移除)"""
+        self._ensure()
+        for i, item in enumerate(SERVERS_CACHE):
+            if item is s:
+                SERVERS_CACHE.pop(i)
+                break
+        else:
+            return
+        self._unindex(s)
+        self._list_len = len(SERVERS_CACHE)
+
+    def replace(self, old, new):
+        """原位替换 (编辑对话框整体覆盖配置时使用)"""
+        self._ensure()
+        for i, item in enumerate(SERVERS_CACHE):
+            if item is old:
+                seq = self._keys.get(id(old), {}).get('seq')
+                self._unindex(old)
+                SERVERS_CACHE[i] = new
+                self._index(new, seq)
+                return
+        self.add(new)
+
+    def reindex(self, s):
+        """服务器的 url / ssh_host / group / tags 被修改后调用"""
+        self._ensure()
+        keys = self._keys.get(id(s))
+        if not keys: return
+        self._unindex(s)
+        self._index(s, keys['seq'])
+
+    # ---------- 查询 ----------
+    def get_by_url(self, url):
+        self._ensure()
+        return self.by_url.get(url)
+
+    def get_all_by_url(self, url):
+        """同一 url 的全部服务器 (按列表顺序)"""
+        self._ensure()
+        return sorted(self.by_url_all.get(url, {}).values(), key=lambda s: self._keys[id(s)]['seq'])
+
+    def member_rev(self, name):
+        self._ensure()
+        return self.member_revs.get(name, 0)
+
+    def get_by_addr(self, url):
+        """忽略 http/https 协议头的 url 匹配"""
+        self._ensure()
+        return self.by_addr.get((url or '').split('://')[-1])
+
+    def get_by_host(self, host):
+        self._ensure()
+        return self.by_host.get(host)
+
+    def get_by_ssh_host(self, host):
+        self._ensure()
+        return self.by_ssh_host.get(host)
+
+    def find(self, url):
+        """精准匹配 url，失败后按 IP/Host 匹配 (探针推送使用)"""
+        self._ensure()
+        s = self.by_url.get(url)
+        if s is None and url: s = self.by_host.get(url_host(url))
+        return s
+
+    def in_group(self, group):
+        self._ensure()
+        return list(self.by_group.get(group, {}).values())
+
+    def with_tag(self, tag):
+        self._ensure()
+        return list(self.by_tag.get(tag, {}).values())
+
+    def in_group_or_tag(self, name):
+        """主分组或 Tag 命中 (保持 SERVERS_CACHE 中的原始顺序)"""
+        self._ensure()
+        hits = dict(self.by_group.get(name, {}))
+        hits.update(self.by_tag.get(name, {}))
+        return sorted(hits.values(), key=lambda s: self._keys[id(s)]['seq'])
+
+
+SERVER_REGISTRY = ServerRegistry()
+
 # UI 引用容器
 DASHBOARD_REFS = {
     'servers': None, 'nodes': None, 'traffic': None, 'subs': None,
@@ -29,7 +238,9 @@ CURRENT_VIEW_STATE = {'scope': 'DASHBOARD', 'data': None, 'page': 1}
 
 # 线程/进程池
 BG_EXECUTOR = ThreadPoolExecutor(max_workers=20)
+SSH_EXECUTOR = ThreadPoolExecutor(max_workers=32)  # 批量 SSH 专用，长命令不占用通用 I/O 线程
 PROCESS_POOL = None # 在 main.py 启动时初始化
+EXECUTOR_METRICS = {}  # (pool, 函数名) -> 排队 / 执行耗时累计
 SYNC_SEMAPHORE = asyncio.Semaphore(50)
 FILE_LOCK = asyncio.Lock()
 
@@ -0,0 +1,323 @@
+# storage.py
+"""
+可选的 SQLite (WAL) 存储后端
+- 开启方式：环境变量 XUI_STORAGE=sqlite
+- 与 JSON 文件一一对应：servers / nodes / subs / admin_config，外加 Ping 历史
+- 保存时只 upsert 内容有变化的行，改一台服务器只写一行
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import config
+
+logger = logging.getLogger("XUI_Storage")
+
+PING_HISTORY_KEEP = 86400  # Ping 历史保留 24h
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    sid  INTEGER PRIMARY KEY,  -- 代理主键：url 可能为空 (纯 SSH 服务器) 或重复
+    pos  INTEGER NOT NULL,     -- 列表顺序
+    url  TEXT,
+    grp  TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_servers_pos ON servers(pos);
+CREATE INDEX IF NOT EXISTS idx_servers_url ON servers(url);
+CREATE INDEX IF NOT EXISTS idx_servers_grp ON servers(grp);
+
+CREATE TABLE IF NOT EXISTS server_tags (
+    sid INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (sid, tag)
+);
+CREATE INDEX IF NOT EXISTS idx_server_tags_tag ON server_tags(tag);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    url  TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subs (
+    token TEXT PRIMARY KEY,
+    seq   INTEGER NOT NULL,
+    data  TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS kv (
+    key  TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ping_history (
+    url  TEXT NOT NULL,
+    ts   REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ping_history_url_ts ON ping_history(url, ts);
+"""
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+class SQLiteStore:
+    """单连接 + 锁：写入来自线程池，读取只在启动时发生"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_schema()
+        # 每张表上次写入的行 {key: (json, 索引列)}，用于只写有变化的行
+        self._rows = {'servers': {}, 'nodes': {}, 'subs': {}}
+        # 服务器对象 -> 行主键 sid：id(s) -> (sid, s)，持有对象本身防止 id 复用
+        self._server_sids = {}
+        self._next_sid = 1
+        self._last_prune = 0
+
+    def _init_schema(self):
+        """建表；旧版 servers 表以 url 为主键 (空 url / 重复 url 会丢行)，迁移为 sid 代理主键"""
+        cols = [r[1] for r in self.conn.execute("PRAGMA table_info(servers)").fetchall()]
+        if cols and 'sid' not in cols:
+            self.conn.executescript("DROP INDEX IF EXISTS idx_servers_seq; DROP INDEX IF EXISTS idx_servers_grp;"
+                                    "ALTER TABLE servers RENAME TO servers_v1; DROP TABLE IF EXISTS server_tags;")
+        self.conn.executescript(_SCHEMA)
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'servers_v1'").fetchone():
+            return
+        rows = self.conn.execute("SELECT data FROM servers_v1 ORDER BY seq").fetchall()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("DELETE FROM servers")
+            self.conn.execute("DELETE FROM server_tags")
+            for sid, (data,) in enumerate(rows, 1):
+                s = json.loads(data)
+                self.conn.execute("INSERT INTO servers (sid, pos, url, grp, data) VALUES (?, ?, ?, ?, ?)",
+                                  (sid, sid - 1, s.get('url'), s.get('group'), data))
+                self.conn.executemany("INSERT OR IGNORE INTO server_tags (sid, tag) VALUES (?, ?)",
+                                      [(sid, t) for t in s.get('tags') or []])
+            self.conn.execute("DROP TABLE servers_v1")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        logger.info(f"✅ servers 表已迁移为 sid 主键 ({len(rows)} 行)")
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error:
+                pass
+            self.conn.close()
+
+    def checkpoint(self):
+        """备份前把 WAL 合并回主库，保证 zip 里的 .db 是完整的"""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def is_empty(self):
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()
+        return not row[0]
+
+    # ---------------- 行格式 ----------------
+    # 每行: (主键, JSON 内容, 索引列)；内容与索引列都没变的行保存时跳过
+    def _server_rows(self, servers):
+        """每台服务器一行，主键为 sid (按对象分配，与 url 无关)；新对象分配新 sid"""
+        known, sids, rows = self._server_sids, {}, []
+        for pos, s in enumerate(servers):
+            hit = known.get(id(s))
+            if hit and hit[1] is s:
+                sid = hit[0]
+            else:
+                sid = self._next_sid
+                self._next_sid += 1
+            sids[id(s)] = (sid, s)
+            rows.append((sid, _dumps(s), (pos, s.get('url'), s.get('group'), tuple(s.get('tags') or []))))
+        self._server_sids = sids
+        return rows
+
+    @staticmethod
+    def _node_rows(nodes_data):
+        return [(url, _dumps(nodes), ()) for url, nodes in list(nodes_data.items())]
+
+    @staticmethod
+    def _sub_rows(subs):
+        return [(s['token'], _dumps(s), (seq,)) for seq, s in enumerate(subs) if s.get('token')]
+
+    def _remember(self, table, rows):
+        self._rows[table] = {key: (data, extra) for key, data, extra in rows}
+
+    # ---------------- 读取 ----------------
+    def load_servers(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT sid, data FROM servers ORDER BY pos, sid").fetchall()
+            max_sid = self.conn.execute("SELECT COALESCE(MAX(sid), 0) FROM servers").fetchone()[0]
+        servers = [json.loads(data) for _, data in rows]
+        self._server_sids = {id(s): (sid, s) for (sid, _), s in zip(rows, servers)}
+        self._next_sid = max_sid + 1
+        self._remember('servers', self._server_rows(servers))
+        return servers
+
+    def load_nodes(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT url, data FROM nodes").fetchall()
+        self._rows['nodes'] = {url: (data, ()) for url, data in rows}
+        return {url: json.loads(data) for url, data in rows}
+
+    def load_subs(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM subs ORDER BY seq").fetchall()
+        subs = [json.loads(data) for data, in rows]
+        self._remember('subs', self._sub_rows(subs))
+        return subs
+
+    def load_kv(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def load_ping_history(self):
+        since = time.time() - PING_HISTORY_KEEP
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT url, data FROM ping_history WHERE ts >= ? ORDER BY ts", (since,)).fetchall()
+        history = {}
+        for url, data in rows:
+            history.setdefault(url, []).append(json.loads(data))
+        return history
+
+    # ---------------- 写入 (按行 diff) ----------------
+    def _sync_rows(self, table, rows, write_row, delete_row):
+        """只写新增/变化的行，删除已不存在的行，整体在一个事务里"""
+        last = self._rows[table]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                seen = set()
+                for key, data, extra in rows:
+                    seen.add(key)
+                    if last.get(key) != (data, extra):
+                        write_row(key, data, extra)
+                for key in last.keys() - seen:
+                    delete_row(key)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        self._remember(table, rows)
+
+    def save_servers(self, servers):
+        def write_row(sid, data, extra):
+            pos, url, grp, tags = extra
+            self.conn.execute(
+                "INSERT INTO servers (sid, pos, url, grp, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(sid) DO UPDATE SET pos = excluded.pos, url = excluded.url, "
+                "grp = excluded.grp, data = excluded.data",
+                (sid, pos, url, grp, data))
+            self.conn.execute("DELETE FROM server_tags WHERE sid = ?", (sid,))
+            self.conn.executemany("INSERT OR IGNORE INTO server_tags (sid, tag) VALUES (?, ?)",
+                                  [(sid, t) for t in tags])
+
+        def delete_row(sid):
+            self.conn.execute("DELETE FROM servers WHERE sid = ?", (sid,))
+            self.conn.execute("DELETE FROM server_tags WHERE sid = ?", (sid,))
+
+        self._sync_rows('servers', self._server_rows(servers), write_row, delete_row)
+        return True
+
+    def save_nodes(self, nodes_data):
+        def write_row(url, data, extra):
+            self.conn.execute(
+                "INSERT INTO nodes (url, data) VALUES (?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET data = excluded.data", (url, data))
+
+        def delete_row(url):
+            self.conn.execute("DELETE FROM nodes WHERE url = ?", (url,))
+
+        self._sync_rows('nodes', self._node_rows(nodes_data), write_row, delete_row)
+        return True
+
+    def save_subs(self, subs):
+        def write_row(token, data, extra):
+            self.conn.execute(
+                "INSERT INTO subs (token, seq, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(token) DO UPDATE SET seq = excluded.seq, data = excluded.data",
+                (token, extra[0], data))
+
+        def delete_row(token):
+            self.conn.execute("DELETE FROM subs WHERE token = ?", (token,))
+
+        self._sync_rows('subs', self._sub_rows(subs), write_row, delete_row)
+        return True
+
+    def save_kv(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO kv (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, _dumps(value)))
+        return True
+
+    def append_ping(self, url, rec):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT INTO ping_history (url, ts, data) VALUES (?, ?, ?)",
+                              (url, rec['ts'], _dumps(rec)))
+            # 每小时清理一次过期记录
+            if now - self._last_prune > 3600:
+                self._last_prune = now
+                self.conn.execute("DELETE FROM ping_history WHERE ts < ?", (now - PING_HISTORY_KEEP,))
+
+    # ---------------- 迁移 ----------------
+    def migrate_from_json(self):
+        """首次启用时从 data/*.json 一次性导入 (JSON 文件保留不动)"""
+        def _load(path, default):
+            if not os.path.isfile(path): return default
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.error(f"迁移时读取 {path} 失败: {e}")
+                return default
+
+        servers = _load(config.CONFIG_FILE, [])
+        nodes = _load(config.NODES_CACHE_FILE, {})
+        subs = _load(config.SUBS_FILE, [])
+        admin = _load(config.ADMIN_CONFIG_FILE, {})
+
+        self.save_servers(servers)
+        self.save_nodes(nodes)
+        self.save_subs(subs)
+        self.save_kv('admin_config', admin)
+        self.save_kv('schema_version', 1)
+        logger.info(f"✅ 已从 JSON 迁移到 SQLite: 服务器 {len(servers)} 台, 订阅 {len(subs)} 个")
+
+
+STORE = None
+
+
+def open_store():
+    """按配置打开 SQLite 后端；未启用时返回 None (继续使用 JSON 文件)"""
+    global STORE
+    if config.STORAGE_BACKEND != 'sqlite':
+        return None
+    if STORE is None:
+        STORE = SQLiteStore(config.DB_FILE)
+        if STORE.is_empty():
+            STORE.migrate_from_json()
+    return STORE
+
+
+def close_store():
+    global STORE
+    if STORE is not None:
+        STORE.close()
+        STORE = None
@@ -7,6 +7,7 @@ import uuid
 import base64
 import io
 import re
+import copy
 from urllib.parse import urlparse, quote, parse_qs
 import qrcode
 import pyotp
@@ -81,7 +82,7 @@ async def generate_smart_name(data):
     if not target: return "New Server"
 
     # 2. 调用后台解析 GeoIP
-    flag = await logic.run_in_bg_executor(utils.get_flag_from_ip, target)
+    flag = await logic.lookup_ip_flag(target)
     if flag == "🏳️": return f"Server {target}"
 
     # 3. 尝试获取国家名映射
@@ -136,6 +137,7 @@ class WebSSH:
                 ui.run_javascript(init_js)
                 ui.on(f'term_input_{self.term_id}', lambda e: self._write_to_ssh(e.args))
 
+                # 终端独占一条连接：长时间打开的 shell 不受连接池空闲回收影响
                 self.client, msg = await run.io_bound(utils.get_ssh_client_sync, self.server_data)
 
                 if not self.client:
@@ -334,6 +336,7 @@ async def open_deploy_xhttp_dialog(server_conf, callback):
                             if node_data:
                                 if 'custom_nodes' not in server_conf: server_conf['custom_nodes'] = []
                                 server_conf['custom_nodes'].append(node_data)
+                                logic.bump_nodes_rev(server_conf['url'])
                                 await logic.save_servers()
                                 safe_notify(f"✅ 节点已添加", "positive");
                                 await asyncio.sleep(1);
@@ -457,6 +460,7 @@ async def open_deploy_hysteria_dialog(server_conf, callback):
                                         "_is_custom": True, "_raw_link": final_link}
                             if 'custom_nodes' not in server_conf: server_conf['custom_nodes'] = []
                             server_conf['custom_nodes'].append(new_node)
+                            logic.bump_nodes_rev(server_conf['url'])
                             await logic.save_servers()
                             safe_notify(f"✅ 节点 {node_name} 已添加", "positive");
                             await asyncio.sleep(1);
@@ -509,6 +513,12 @@ def open_probe_settings_dialog():
                                            value=state.ADMIN_CONFIG.get('ping_target_cm', '211.138.180.2')).props(
                             'outlined dense')
 
+                with ui.column().classes('w-full'):
+                    ui.label('📦 推送格式').classes('text-sm font-bold text-gray-700')
+                    ui.label('开启后探针使用 gzip 压缩 + 二进制指标帧推送，需“更新探针”后生效。').classes(
+                        'text-xs text-gray-400 mb-2')
+                    compact_switch = ui.switch('压缩推送', value=bool(state.ADMIN_CONFIG.get('probe_compact', False)))
+
                 with ui.column().classes('w-full'):
                     ui.label('🤖 Telegram 通知 ').classes('text-sm font-bold text-gray-700')
                     with ui.grid().classes('w-full grid-cols-1 sm:grid-cols-2 gap-3'):
@@ -523,6 +533,7 @@ def open_probe_settings_dialog():
             state.ADMIN_CONFIG['ping_target_ct'] = ping_ct.value.strip()
             state.ADMIN_CONFIG['ping_target_cu'] = ping_cu.value.strip()
             state.ADMIN_CONFIG['ping_target_cm'] = ping_cm.value.strip()
+            state.ADMIN_CONFIG['probe_compact'] = bool(compact_switch.value)
             state.ADMIN_CONFIG['tg_bot_token'] = tg_token.value.strip()
             state.ADMIN_CONFIG['tg_chat_id'] = tg_id.value.strip()
             await logic.save_admin_config()
@@ -540,6 +551,7 @@ class InboundEditor:
         self.mgr = mgr;
         self.cb = on_success;
         self.is_edit = data is not None
+        self.orig = data
         if not data:
             random_port = random.randint(10000, 65000)
             self.d = {"enable": True, "remark": "", "port": random_port, "protocol": "vmess",
@@ -548,7 +560,8 @@ class InboundEditor:
                       "streamSettings": {"network": "tcp", "security": "none"},
                       "sniffing": {"enabled": True, "destOverride": ["http", "tls"]}}
         else:
-            self.d = data.copy()
+            # 深拷贝：编辑中不改动缓存里的节点，保存成功后再写回并重建模型
+            self.d = copy.deepcopy(data)
 
         for k in ['settings', 'streamSettings']:
             if isinstance(self.d.get(k), str):
@@ -675,6 +688,9 @@ class InboundEditor:
 
             if success:
                 safe_notify(f"✅ {msg}", "positive");
+                if self.is_edit:
+                    self.orig.update(self.d)
+                    utils.refresh_node_model(self.orig)
                 dlg.close()
                 if self.cb:
                     res = self.cb();
@@ -705,7 +721,6 @@ async def delete_inbound_with_confirm(mgr, inbound_id, inbound_remark, callback)
 # ================= 订阅编辑器 =================
 class AdvancedSubEditor:
     def __init__(self, sub_data=None):
-        import copy
         if sub_data:
             self.sub = copy.deepcopy(sub_data)
         else:
@@ -867,14 +882,15 @@ class AdvancedSubEditor:
                                     key = f"{srv['url']}|{n['id']}";
                                     is_checked = key in self.selected_ids
                                     self.server_items[g_name].append(key)
+                                    m = utils.node_model(n)
                                     with ui.row().classes(
                                             'w-full items-center pl-2 py-1 hover:bg-blue-50 rounded cursor-pointer transition border border-transparent') as row:
                                         chk = ui.checkbox(value=is_checked).props('dense size=xs');
                                         chk.disable()
                                         row.on('click', lambda _, k=key: self.toggle_node_from_left(k))
-                                        ui.label(n.get('remark', '未命名')).classes(
+                                        ui.label(m.remark or '未命名').classes(
                                             'text-xs text-gray-700 truncate flex-grow')
-                                        full_text = f"{search_key} {n.get('remark', '')} {n.get('protocol', '')}".lower()
+                                        full_text = f"{search_key} {m.remark or ''} {m.protocol or ''}".lower()
                                         self.ui_groups[key] = {'row': row, 'chk': chk, 'text': full_text,
                                                                'group_name': g_name, 'header': server_header,
                                                                'container': container}
@@ -914,7 +930,7 @@ class AdvancedSubEditor:
                 for idx, key in enumerate(self.selected_ids):
                     node = self.all_nodes_map.get(key)
                     if not node: continue
-                    orig_name = node.get('remark', 'Unknown');
+                    orig_name = utils.node_model(node).remark or 'Unknown';
                     final_name = orig_name
                     if pat:
                         try:
@@ -940,7 +956,7 @@ class AdvancedSubEditor:
         objs = []
         for k in self.selected_ids:
             n = self.all_nodes_map.get(k)
-            if n: objs.append({'key': k, 'name': n.get('remark', '').lower()})
+            if n: objs.append({'key': k, 'name': (utils.node_model(n).remark or '').lower()})
         if mode == 'name_asc':
             objs.sort(key=lambda x: x['name'])
         elif mode == 'name_desc':
@@ -1063,6 +1079,7 @@ def open_quick_group_create_dialog(callback=None):
                     if 'tags' not in s: s['tags'] = []
                     if new_name not in s['tags']: s['tags'].append(new_name); count += 1
                     if s.get('group') == new_name: s['group'] = logic.detect_country_group(s['name'], None)
+                    state.SERVER_REGISTRY.reindex(s)
             if count > 0: await logic.save_servers()
             render_sidebar_content.refresh()
             safe_notify(f'✅ 分组创建成功', 'positive');
@@ -1276,6 +1293,7 @@ def open_unified_group_manager(mode='manage'):
                 if new not in s['tags']: s['tags'].append(new)
             else:
                 if new in s['tags']: s['tags'].remove(new)
+            state.SERVER_REGISTRY.reindex(s)
 
         state.ADMIN_CONFIG['probe_custom_groups'] = groups
         await logic.save_admin_config();
@@ -1294,7 +1312,9 @@ def open_unified_group_manager(mode='manage'):
             state.ADMIN_CONFIG['probe_custom_groups'].remove(target);
             await logic.save_admin_config()
         for s in state.SERVERS_CACHE:
-            if 'tags' in s and target in s['tags']: s['tags'].remove(target)
+            if 'tags' in s and target in s['tags']:
+                s['tags'].remove(target)
+                state.SERVER_REGISTRY.reindex(s)
         await logic.save_servers();
         safe_notify("🗑️ 已删除", "positive");
         load_group(None)
@@ -1565,180 +1585,6 @@ async def load_subs_view():
                         'flat dense round size=xs text-color=grey-7')
 
 
-def prepare_map_data():
-    try:
-        city_points_map = {}
-        flag_points_map = {}
-        unique_deployed_countries = set()
-        region_stats = {}
-        active_regions_for_highlight = set()
-
-        FLAG_TO_MAP_NAME = {
-            '🇨🇳': 'China', '🇭🇰': 'China', '🇲🇴': 'China', '🇹🇼': 'China',
-            '🇺🇸': 'United States', '🇨🇦': 'Canada', '🇲🇽': 'Mexico',
-            '🇬🇧': 'United Kingdom', '🇩🇪': 'Germany', '🇫🇷': 'France', '🇳🇱': 'Netherlands',
-            '🇷🇺': 'Russia', '🇯🇵': 'Japan', '🇰🇷': 'South Korea', '🇸🇬': 'Singapore',
-            '🇮🇳': 'India', '🇦🇺': 'Australia', '🇧🇷': 'Brazil', '🇦🇷': 'Argentina',
-            '🇹🇷': 'Turkey', '🇮🇹': 'Italy', '🇪🇸': 'Spain', '🇵🇹': 'Portugal',
-            '🇨🇭': 'Switzerland', '🇸🇪': 'Sweden', '🇳🇴': 'Norway', '🇫🇮': 'Finland',
-            '🇵🇱': 'Poland', '🇺🇦': 'Ukraine', '🇮🇪': 'Ireland', '🇦🇹': 'Austria',
-            '🇧🇪': 'Belgium', '🇩🇰': 'Denmark', '🇨🇿': 'Czech Republic', '🇬🇷': 'Greece',
-            '🇿🇦': 'South Africa', '🇪🇬': 'Egypt', '🇸🇦': 'Saudi Arabia', '🇦🇪': 'United Arab Emirates',
-            '🇮🇱': 'Israel', '🇮🇷': 'Iran', '🇮🇩': 'Indonesia', '🇲🇾': 'Malaysia',
-            '🇹🇭': 'Thailand', '🇻🇳': 'Vietnam', '🇵🇭': 'Philippines', '🇨🇱': 'Chile',
-            '🇨🇴': 'Colombia', '🇵🇪': 'Peru'
-        }
-
-        MAP_NAME_ALIASES = {
-            'United States': ['United States of America', 'USA'],
-            'United Kingdom': ['United Kingdom', 'UK', 'Great Britain'],
-            'China': ['People\'s Republic of China'],
-            'Russia': ['Russian Federation'],
-            'South Korea': ['Korea', 'Republic of Korea'],
-            'Vietnam': ['Viet Nam']
-        }
-
-        COUNTRY_CENTROIDS = {
-            'China': [104.19, 35.86], 'United States': [-95.71, 37.09], 'United Kingdom': [-3.43, 55.37],
-            'Germany': [10.45, 51.16], 'France': [2.21, 46.22], 'Netherlands': [5.29, 52.13],
-            'Russia': [105.31, 61.52], 'Canada': [-106.34, 56.13], 'Brazil': [-51.92, -14.23],
-            'Australia': [133.77, -25.27], 'India': [78.96, 20.59], 'Japan': [138.25, 36.20],
-            'South Korea': [127.76, 35.90], 'Singapore': [103.81, 1.35], 'Turkey': [35.24, 38.96]
-        }
-
-        CITY_COORDS_FIX = {
-            'Dubai': (25.20, 55.27), 'Frankfurt': (50.11, 8.68), 'Amsterdam': (52.36, 4.90),
-            'San Jose': (37.33, -121.88), 'Phoenix': (33.44, -112.07), 'Tokyo': (35.68, 139.76),
-            'Seoul': (37.56, 126.97), 'London': (51.50, -0.12), 'Singapore': (1.35, 103.81)
-        }
-
-        from collections import Counter
-        country_counter = Counter()
-        snapshot = list(state.SERVERS_CACHE)
-        now_ts = time.time()
-
-        temp_stats_storage = {}
-
-        for s in snapshot:
-            s_name = s.get('name', '')
-
-            flag_icon = "📍"
-            map_name_standard = None
-
-            for f, m_name in FLAG_TO_MAP_NAME.items():
-                if f in s_name:
-                    flag_icon = f
-                    map_name_standard = m_name
-                    break
-
-            if not map_name_standard:
-                try:
-                    group_str = logic.detect_country_group(s_name, s)
-                    if group_str:
-                        flag_part = group_str.split(' ')[0]
-                        if flag_part in FLAG_TO_MAP_NAME:
-                            flag_icon = flag_part
-                            map_name_standard = FLAG_TO_MAP_NAME[flag_part]
-                except:
-                    pass
-
-            try:
-                country_counter[logic.detect_country_group(s_name, s)] += 1
-            except:
-                pass
-
-            lat, lon = None, None
-            for city_key, (c_lat, c_lon) in CITY_COORDS_FIX.items():
-                if city_key.lower() in s_name.lower(): lat, lon = c_lat, c_lon; break
-            if not lat:
-                if 'lat' in s and 'lon' in s:
-                    lat, lon = s['lat'], s['lon']
-                else:
-                    coords = utils.get_coords_from_name(s_name)
-                    if coords: lat, lon = coords[0], coords[1]
-
-            if lat and lon and map_name_standard:
-                coord_key = f"{lat},{lon}"
-                if coord_key not in city_points_map:
-                    city_points_map[coord_key] = {'name': s_name, 'value': [lon, lat], 'country_key': map_name_standard}
-
-                if flag_icon != "📍" and flag_icon not in flag_points_map:
-                    flag_points_map[flag_icon] = {'name': flag_icon, 'value': [lon, lat],
-                                                  'country_key': map_name_standard}
-
-            if map_name_standard:
-                unique_deployed_countries.add(map_name_standard)
-
-                if map_name_standard not in temp_stats_storage:
-                    cn_name = map_name_standard
-                    try:
-                        full_g = logic.detect_country_group(s_name, s)
-                        if full_g and ' ' in full_g: cn_name = full_g.split(' ')[1]
-                    except:
-                        pass
-
-                    temp_stats_storage[map_name_standard] = {
-                        'flag': flag_icon, 'cn': cn_name,
-                        'total': 0, 'online': 0, 'servers': []
-                    }
-
-                rs = temp_stats_storage[map_name_standard]
-                rs['total'] += 1
-
-                is_on = False
-                probe_cache = state.PROBE_DATA_CACHE.get(s['url'])
-                if probe_cache:
-                    if now_ts - probe_cache.get('last_updated', 0) < 20:
-                        is_on = True
-
-                if not is_on and s.get('_status') == 'online':
-                    is_on = True
-
-                if is_on: rs['online'] += 1
-
-                rs['servers'].append({
-                    'name': s_name,
-                    'status': 'online' if is_on else 'offline'
-                })
-
-                if map_name_standard not in COUNTRY_CENTROIDS and lat and lon:
-                    COUNTRY_CENTROIDS[map_name_standard] = [lon, lat]
-
-        for std_name, stats in temp_stats_storage.items():
-            stats['servers'].sort(key=lambda x: 0 if x['status'] == 'online' else 1)
-            region_stats[std_name] = stats
-            active_regions_for_highlight.add(std_name)
-
-            if std_name in MAP_NAME_ALIASES:
-                for alias in MAP_NAME_ALIASES[std_name]:
-                    region_stats[alias] = stats
-                    active_regions_for_highlight.add(alias)
-
-        pie_data = []
-        if country_counter:
-            sorted_counts = country_counter.most_common(5)
-            for k, v in sorted_counts: pie_data.append({'name': f"{k} ({v})", 'value': v})
-            others = sum(country_counter.values()) - sum(x[1] for x in sorted_counts)
-            if others > 0: pie_data.append({'name': f"🏳️ 其他 ({others})", 'value': others})
-        else:
-            pie_data.append({'name': '暂无数据', 'value': 0})
-
-        city_list = list(city_points_map.values())
-        flag_list = list(flag_points_map.values())
-
-        return (
-            json.dumps({'cities': city_list, 'flags': flag_list, 'regions': list(active_regions_for_highlight)},
-                       ensure_ascii=False),
-            pie_data,
-            len(unique_deployed_countries),
-            json.dumps(region_stats, ensure_ascii=False),
-            json.dumps(COUNTRY_CENTROIDS, ensure_ascii=False)
-        )
-    except Exception as e:
-        print(f"[ERROR] prepare_map_data failed: {e}")
-        return (json.dumps({'cities': [], 'flags': [], 'regions': []}), [], 0, "{}", "{}")
-
-
 async def refresh_dashboard_ui():
     try:
         if not state.DASHBOARD_REFS.get('servers'): return
@@ -1808,7 +1654,7 @@ async def load_dashboard_stats():
         }
 
     try:
-        chart_data, pie_data, region_count, region_stats_json, centroids_json = prepare_map_data()
+        chart_data, pie_data, region_count, region_stats_json, centroids_json = logic.prepare_map_data()
     except:
         chart_data = '{"cities": [], "flags": [], "regions": []}'
         pie_data = []
@@ -1935,7 +1781,7 @@ async def render_single_server_view(server_conf, force_refresh=False):
                         mgr.get_inbounds) else await mgr.get_inbounds()
 
                     if new_inbounds is not None:
-                        state.NODES_DATA[server_conf['url']] = new_inbounds
+                        logic.store_nodes(server_conf['url'], new_inbounds)
                         server_conf['_status'] = 'online'
                         await logic.save_nodes_cache()
                 except Exception as e:
@@ -2015,6 +1861,7 @@ async def render_single_server_view(server_conf, force_refresh=False):
 
                     if 'custom_nodes' in server_conf and node_data in server_conf['custom_nodes']:
                         server_conf['custom_nodes'].remove(node_data)
+                        logic.bump_nodes_rev(server_conf['url'])
                         await logic.save_servers()
                     await reload_and_refresh_ui()
 
@@ -2099,8 +1946,9 @@ async def render_single_server_view(server_conf, force_refresh=False):
                                     server_conf.get('probe_installed') and server_conf.get('ssh_host'))
                         row_3d_cls = 'grid w-full gap-4 py-3 px-2 mb-2 items-center group bg-white rounded-xl border border-gray-200 border-b-[3px] shadow-sm transition-all duration-150 ease-out hover:shadow-md hover:border-blue-300 hover:-translate-y-[2px] active:border-b active:translate-y-[2px] active:shadow-none cursor-default'
 
+                        m = utils.node_model(n)
                         with ui.element('div').classes(row_3d_cls).style(SINGLE_COLS_NO_PING):
-                            ui.label(n.get('remark', '未命名')).classes(
+                            ui.label(m.remark or '未命名').classes(
                                 'font-bold truncate w-full text-left pl-2 text-slate-700 text-sm')
 
                             if is_custom:
@@ -2113,17 +1961,17 @@ async def render_single_server_view(server_conf, force_refresh=False):
                                 ui.label("API").classes(
                                     'text-[10px] bg-gray-100 text-gray-600 font-bold px-2 py-0.5 rounded-full w-fit mx-auto shadow-sm')
 
-                            traffic = utils.format_bytes(n.get('up', 0) + n.get('down', 0)) if not is_custom else "--"
+                            traffic = utils.format_bytes((m.up or 0) + (m.down or 0)) if not is_custom else "--"
                             ui.label(traffic).classes('text-xs text-gray-500 w-full text-center font-mono font-bold')
 
-                            proto = str(n.get('protocol', 'unk')).upper()
+                            proto = str(m.protocol or 'unk').upper()
                             ui.label(proto).classes(
                                 f'text-[11px] font-extrabold w-full text-center text-slate-500 tracking-wide')
 
-                            ui.label(str(n.get('port', 0))).classes(
+                            ui.label(str(m.port or 0)).classes(
                                 'text-blue-600 font-mono w-full text-center font-bold text-xs')
 
-                            is_enable = n.get('enable', True)
+                            is_enable = m.enable
                             with ui.row().classes('w-full justify-center items-center gap-1'):
                                 color = "green" if is_enable else "red";
                                 text = "启用" if is_enable else "停止"
@@ -2244,7 +2092,7 @@ def render_sidebar_content():
         if tags:
             ui.label('自定义分组').classes('text-xs font-bold text-gray-400 mt-2 px-2 uppercase')
             for t in tags:
-                srvs = [s for s in state.SERVERS_CACHE if t in s.get('tags', []) or s.get('group') == t]
+                srvs = state.SERVER_REGISTRY.in_group_or_tag(t)
                 with ui.expansion(t, icon='folder').classes('w-full border rounded-xl bg-white mb-1 shadow-sm').props(
                         'header-class="font-bold text-slate-700"'):
                     with ui.column().classes('w-full gap-2 p-2 bg-gray-50/50 border-t') as col:
@@ -2425,7 +2273,7 @@ def get_targets_by_scope(scope, data):
         if scope == 'ALL':
             targets = list(state.SERVERS_CACHE)
         elif scope == 'TAG':
-            targets = [s for s in state.SERVERS_CACHE if data in s.get('tags', [])]
+            targets = state.SERVER_REGISTRY.with_tag(data)
         elif scope == 'COUNTRY':
             for s in state.SERVERS_CACHE:
                 saved = s.get('group')
@@ -2695,7 +2543,7 @@ def main_page(request):
         last_data_id = app.storage.user.get('last_view_data', None)
         target_data = last_data_id
         if last_scope == 'SINGLE' and last_data_id:
-            target_data = next((s for s in state.SERVERS_CACHE if s['url'] == last_data_id), None)
+            target_data = state.SERVER_REGISTRY.get_by_url(last_data_id)
             if not target_data: last_scope = 'DASHBOARD'
 
         if last_scope == 'DASHBOARD':
@@ -2979,7 +2827,7 @@ async def render_desktop_status_page():
 
     # 4. 准备初始地图数据
     try:
-        chart_data, pie_data, region_count, region_stats_json, centroids_json = prepare_map_data()
+        chart_data, pie_data, region_count, region_stats_json, centroids_json = logic.prepare_map_data()
     except Exception as e:
         chart_data = '{"cities": [], "flags": [], "regions": []}'
         pie_data = [];
@@ -3083,11 +2931,14 @@ async def render_desktop_status_page():
                     ui.tab(g, label='全部' if g == 'ALL' else g).on('click', lambda _, g=g: apply_filter(g))
                 tabs.set_value(CURRENT_PROBE_TAB)
 
-    # 更新卡片 UI 数据的函数 (解耦逻辑)
-    def update_card_ui(refs, status, static):
-        if not status: return
+    # 更新卡片 UI 数据的函数 (解耦逻辑)：按字段分段，广播只推变化字段时只刷对应元素
+    def fmt_cap(b):
+        return utils.format_bytes(b)
 
-        # 状态图标更新
+    def fmt_s(b):
+        return f"{utils.format_bytes(b)}/s"
+
+    def _ui_status_icon(refs, status):
         is_probe_online = (status.get('status') == 'online')
         if is_probe_online:
             refs['status_icon'].set_name('bolt');
@@ -3105,87 +2956,125 @@ async def render_desktop_status_page():
                                             remove='text-green-500 text-gray-400 text-purple-400')
                 refs['online_dot'].classes(replace='bg-red-500', remove='bg-green-500 bg-orange-500 bg-purple-500')
 
-        # 文本信息更新
-        import re
-        refs['os_info'].set_text(re.sub(r' GNU/Linux', '', static.get('os', 'Linux'), flags=re.I))
+    def _ui_cores(refs, status, static):
         refs['summary_cores'].set_text(f"{status.get('cpu_cores', static.get('cpu_cores'))} C")
+        refs['cpu_sub'].set_text(f"{status.get('cpu_cores', 1)} Cores")
 
-        def fmt_cap(b):
-            return utils.format_bytes(b)
-
-        refs['summary_ram'].set_text(fmt_cap(status.get('mem_total', 0)))
-        refs['summary_disk'].set_text(fmt_cap(status.get('disk_total', 0)))
-
-        refs['traf_up'].set_text(f"↑ {fmt_cap(status.get('net_total_out', 0))}")
-        refs['traf_down'].set_text(f"↓ {fmt_cap(status.get('net_total_in', 0))}")
-
-        # 进度条更新
-        cpu = float(status.get('cpu_usage', 0))
+    def _ui_cpu(refs, status):
+        cpu = float(status.get('cpu_usage') or 0)
         refs['cpu_bar'].style(f'width: {cpu}%');
         refs['cpu_pct'].set_text(f'{cpu:.1f}%')
-        refs['cpu_sub'].set_text(f"{status.get('cpu_cores', 1)} Cores")
 
-        mem = float(status.get('mem_usage', 0))
+    def _ui_mem(refs, status):
+        mem = float(status.get('mem_usage') or 0)
         refs['mem_bar'].style(f'width: {mem}%');
         refs['mem_pct'].set_text(f'{mem:.1f}%')
-        mem_t = float(status.get('mem_total', 0))
+        mem_t = float(status.get('mem_total') or 0)
+        refs['summary_ram'].set_text(fmt_cap(mem_t))
         refs['mem_sub'].set_text(f"{fmt_cap(mem_t * (mem / 100.0))} / {fmt_cap(mem_t)}")
 
-        disk = float(status.get('disk_usage', 0))
+    def _ui_disk(refs, status):
+        disk = float(status.get('disk_usage') or 0)
         refs['disk_bar'].style(f'width: {disk}%');
         refs['disk_pct'].set_text(f'{disk:.1f}%')
-        disk_t = float(status.get('disk_total', 0))
+        disk_t = float(status.get('disk_total') or 0)
+        refs['summary_disk'].set_text(fmt_cap(disk_t))
         refs['disk_sub'].set_text(f"{fmt_cap(disk_t * (disk / 100.0))} / {fmt_cap(disk_t)}")
 
-        def fmt_s(b):
-            return f"{utils.format_bytes(b)}/s"
-
-        refs['net_up'].set_text(f"↑ {fmt_s(status.get('net_speed_out', 0))}")
-        refs['net_down'].set_text(f"↓ {fmt_s(status.get('net_speed_in', 0))}")
-
+    def _ui_uptime(refs, status):
         up = str(status.get('uptime', '-'))
         refs['uptime'].set_content(
             re.sub(r'(\d+)(\s*(?:days?|天))', r'<span class="text-green-500 font-bold text-sm">\1</span>\2', up,
                    flags=re.IGNORECASE))
 
-    # 卡片自动更新循环
-    async def card_autoupdate_loop(url):
-        current_server = next((s for s in state.SERVERS_CACHE if s['url'] == url), None)
-        # 仅探针机器开启轮询，节省资源
-        if not current_server or not current_server.get('probe_installed', False): return
-
-        await asyncio.sleep(random.uniform(0.5, 3.0))  # 错峰
-        while True:
-            if url not in RENDERED_CARDS: break
-            item = RENDERED_CARDS.get(url)
-            # 省流：如果卡片不可见，暂缓刷新
-            if not item or not item['card'].visible: await asyncio.sleep(5.0); continue
-
-            res = None
-            try:
-                # 获取数据
-                res = await asyncio.wait_for(
-                    logic.get_server_status(next((s for s in state.SERVERS_CACHE if s['url'] == url), None)),
-                    timeout=5.0)
-            except:
-                pass
-
-            if res:
-                static = state.PROBE_DATA_CACHE.get(url, {}).get('static', {})
-                update_card_ui(item['refs'], res, static)
-                if res.get('status') == 'online':
-                    item['card'].classes(remove='offline-card')
-                else:
-                    item['card'].classes(add='offline-card')
-
-            await asyncio.sleep(random.uniform(2.0, 3.0))
+    # 字段 -> 需要刷新的卡片片段
+    CARD_FIELD_UPDATERS = {
+        'status': lambda refs, st, sta: _ui_status_icon(refs, st),
+        'cpu_usage': lambda refs, st, sta: (_ui_status_icon(refs, st), _ui_cpu(refs, st)),
+        'cpu_cores': _ui_cores,
+        'mem_usage': lambda refs, st, sta: _ui_mem(refs, st),
+        'mem_total': lambda refs, st, sta: _ui_mem(refs, st),
+        'disk_usage': lambda refs, st, sta: _ui_disk(refs, st),
+        'disk_total': lambda refs, st, sta: _ui_disk(refs, st),
+        'net_total_out': lambda refs, st, sta: refs['traf_up'].set_text(f"↑ {fmt_cap(st.get('net_total_out') or 0)}"),
+        'net_total_in': lambda refs, st, sta: refs['traf_down'].set_text(f"↓ {fmt_cap(st.get('net_total_in') or 0)}"),
+        'net_speed_out': lambda refs, st, sta: refs['net_up'].set_text(f"↑ {fmt_s(st.get('net_speed_out') or 0)}"),
+        'net_speed_in': lambda refs, st, sta: refs['net_down'].set_text(f"↓ {fmt_s(st.get('net_speed_in') or 0)}"),
+        'uptime': lambda refs, st, sta: _ui_uptime(refs, st),
+    }
+
+    def update_card_ui(refs, status, static, fields=None):
+        """fields 为 None 时整卡刷新；否则只刷新这些字段对应的元素 (同一片段只刷一次)"""
+        if not status: return
+        if fields is None:
+            refs['os_info'].set_text(re.sub(r' GNU/Linux', '', static.get('os', 'Linux'), flags=re.I))
+            fields = CARD_FIELD_UPDATERS.keys()
+        done = set()
+        for f in fields:
+            updater = CARD_FIELD_UPDATERS.get(f)
+            if updater is None: continue
+            # mem_usage / mem_total 等共用一个片段，避免重复刷新
+            tag = {'mem_total': 'mem_usage', 'disk_total': 'disk_usage'}.get(f, f)
+            if tag in done: continue
+            done.add(tag)
+            updater(refs, status, static)
+
+    # 应用单张卡片的状态
+    def apply_card_status(item, url, status, fields=None):
+        static = state.PROBE_DATA_CACHE.get(url, {}).get('static', {})
+        update_card_ui(item['refs'], status, static, fields)
+        if fields is None or 'status' in fields:
+            if status.get('status') == 'online':
+                item['card'].classes(remove='offline-card')
+            else:
+                item['card'].classes(add='offline-card')
+
+    # 订阅全局状态广播：只处理本页已渲染且发生变化的卡片
+    page_client = ui.context.client
+    pending = {}  # url -> 待刷字段集合 (None = 整卡)；变化时卡片不可见，等可见后再补刷
+
+    def on_status_changes(changes):
+        with page_client:
+            for url, diff in changes.items():
+                fields = None if diff is None else set(diff)
+                if url in pending:
+                    old = pending[url]
+                    fields = None if old is None or fields is None else old | fields
+                pending[url] = fields
+            for url in list(pending):
+                item = RENDERED_CARDS.get(url)
+                if not item: pending.pop(url, None); continue
+                # 省流：如果卡片不可见，暂缓刷新
+                if not item['card'].visible: continue
+                fields = pending.pop(url)
+                status = logic.STATUS_BROADCASTER.current(url)
+                # 只刷新 diff 中变化的字段对应的元素
+                if status: apply_card_status(item, url, status, fields)
+
+    sub_token = {'id': None}
+
+    def subscribe_status():
+        if sub_token['id'] is not None: return
+        sub_token['id'] = logic.STATUS_BROADCASTER.subscribe(on_status_changes)
+        # (重)连接期间可能错过了变化，整页补刷一次
+        on_status_changes({url: None for url in RENDERED_CARDS})
+
+    def unsubscribe_status():
+        if sub_token['id'] is not None:
+            logic.STATUS_BROADCASTER.unsubscribe(sub_token['id'])
+            sub_token['id'] = None
+
+    page_client.on_connect(subscribe_status)
+    page_client.on_disconnect(unsubscribe_status)
 
     # 创建单个服务器卡片
     def create_server_card(s):
         url = s['url'];
         refs = {}
-        # 尝试读取初始缓存，避免白屏
-        initial_status = state.PROBE_DATA_CACHE.get(url, {}).copy() if url in state.PROBE_DATA_CACHE else None
+        # 优先用广播快照 (已按心跳判定在线)，其次读取原始缓存，避免白屏
+        initial_status = logic.STATUS_BROADCASTER.current(url)
+        if initial_status is None and url in state.PROBE_DATA_CACHE:
+            initial_status = state.PROBE_DATA_CACHE[url].copy()
 
         with grid_container:
             with ui.card().classes(
@@ -3284,8 +3173,6 @@ async def render_desktop_status_page():
                 card.classes(add='offline-card')
 
         RENDERED_CARDS[url] = {'card': card, 'refs': refs, 'data': s}
-        # 启动该卡片的独立刷新循环
-        asyncio.create_task(card_autoupdate_loop(url))
 
     def apply_filter(group_name):
         global CURRENT_PROBE_TAB;
@@ -3348,7 +3235,7 @@ async def render_desktop_status_page():
                 render_tabs();
                 render_grid_page()
                 try:
-                    new_map, _, new_cnt, new_stats, new_centroids = prepare_map_data()
+                    new_map, _, new_cnt, new_stats, new_centroids = logic.prepare_map_data()
                 except:
                     new_map = "{}"; new_cnt = 0; new_stats = "{}"; new_centroids = "{}"
                 if header_refs.get('region_count'): header_refs['region_count'].set_text(f'分布区域: {new_cnt}')
@@ -3433,38 +3320,72 @@ class BatchSSH:
                     ui.label(f'已选 {len(self.selected_urls)} 台服务器').classes('font-bold text-gray-600')
                     cmd_input = ui.textarea(placeholder='请输入 Shell 命令...').classes(
                         'w-full flex-grow font-mono text-sm').props('outlined')
+                    with ui.row().classes('w-full gap-2 no-wrap'):
+                        concurrency_input = ui.number('并发数', value=logic.BATCH_SSH_CONCURRENCY, min=1,
+                                                      max=logic.BATCH_SSH_MAX_CONCURRENCY, precision=0).props(
+                            'outlined dense').classes('flex-1')
+                        timeout_input = ui.number('单机超时(秒)', value=logic.BATCH_SSH_TIMEOUT, min=5,
+                                                  precision=0).props('outlined dense').classes('flex-1')
+
+                    running = {'job': None}
+
+                    def on_output(srv, stream, line):
+                        mark = '!' if stream == 'stderr' else '>'
+                        log_area.push(f"[{srv['name']}] {mark} {line}")
+
+                    def on_result(r):
+                        icon = {'ok': '✅', 'failed': '❌', 'timeout': '⏱️', 'cancelled': '⛔'}.get(r['status'], '❔')
+                        log_area.push(f"{icon} [{r['name']}] {r['status']} ({r['duration']}s)")
+
+                    def render_summary(results):
+                        summary_box.clear()
+                        c = logic.BatchSSHRun.summarize(results)
+                        with summary_box:
+                            ui.label(f"成功 {c['ok']} · 失败 {c['failed']} · 超时 {c['timeout']} · 取消 {c['cancelled']}").classes(
+                                'text-xs font-bold text-gray-300')
+                            rows = [{'name': r['name'], 'status': r['status'], 'duration': r['duration']}
+                                    for r in sorted(results, key=lambda r: (r['status'] == 'ok', r['name']))]
+                            ui.table(columns=[
+                                {'name': 'name', 'label': '服务器', 'field': 'name', 'align': 'left', 'sortable': True},
+                                {'name': 'status', 'label': '结果', 'field': 'status', 'sortable': True},
+                                {'name': 'duration', 'label': '耗时(s)', 'field': 'duration', 'sortable': True},
+                            ], rows=rows, row_key='name').props('dense flat dark').classes('w-full')
 
                     async def run_cmd():
                         user_cmd = cmd_input.value.strip()
                         if not user_cmd: return safe_notify('命令不能为空', 'warning')
-
-                        log_area.push(f"\n======== 开始批量执行 (命令: {user_cmd}) ========\n")
-
-                        for url in self.selected_urls:
-                            srv = next((s for s in state.SERVERS_CACHE if s['url'] == url), None)
-                            if not srv: continue
-
-                            log_area.push(f"🚀 [{srv['name']}] 执行中...")
-                            try:
-                                success, output = await logic.run_in_bg_executor(
-                                    lambda: utils._ssh_exec_wrapper(srv, user_cmd))
-                                if success:
-                                    log_area.push(f"✅ [{srv['name']}] 成功:\n{output}\n")
-                                else:
-                                    log_area.push(f"❌ [{srv['name']}] 失败:\n{output}\n")
-                            except Exception as e:
-                                log_area.push(f"❌ [{srv['name']}] 异常: {str(e)}\n")
-                            log_area.push("-" * 50)
-
+                        if running['job']: return safe_notify('已有任务在执行', 'warning')
+
+                        servers = [s for s in (state.SERVER_REGISTRY.get_by_url(u) for u in self.selected_urls) if s]
+                        job = logic.BatchSSHRun(servers, user_cmd, concurrency=concurrency_input.value or 1,
+                                                timeout=timeout_input.value or logic.BATCH_SSH_TIMEOUT,
+                                                on_output=on_output, on_result=on_result)
+                        running['job'] = job
+                        run_btn.disable(); stop_btn.enable(); summary_box.clear()
+                        log_area.push(f"\n======== 开始批量执行 (命令: {user_cmd}, 并发 {job.concurrency}) ========\n")
+                        try:
+                            results = await job.run()
+                        finally:
+                            running['job'] = None
+                            run_btn.enable(); stop_btn.disable()
                         log_area.push("\n======== 执行结束 ========\n")
+                        render_summary(results)
 
-                    ui.button('立即执行', icon='play_arrow', on_click=run_cmd).classes('w-full bg-green-600 text-white')
+                    def stop_cmd():
+                        if running['job']:
+                            running['job'].cancel()
+                            log_area.push("⛔ 正在取消...")
+
+                    run_btn = ui.button('立即执行', icon='play_arrow', on_click=run_cmd).classes('w-full bg-green-600 text-white')
+                    stop_btn = ui.button('停止', icon='stop', on_click=stop_cmd).props('outline color=red').classes('w-full')
+                    stop_btn.disable()
                     ui.button('返回选择', on_click=self.render_selection_view).props('flat color=grey').classes(
                         'w-full')
 
                 # 右侧日志区
-                with ui.column().classes('w-2/3 h-full bg-black'):
-                    log_area = ui.log().classes('w-full h-full p-4 text-xs font-mono text-green-400')
+                with ui.column().classes('w-2/3 h-full bg-black no-wrap'):
+                    log_area = ui.log(max_lines=5000).classes('w-full flex-grow p-4 text-xs font-mono text-green-400')
+                    summary_box = ui.column().classes('w-full max-h-[40%] overflow-auto px-4 pb-2 gap-1')
 
 
 batch_ssh_manager = BatchSSH()
@@ -3576,6 +3497,7 @@ class BulkEditor:
                                 for s in state.SERVERS_CACHE:
                                     if s['url'] in self.selected_urls:
                                         s['group'] = target_group
+                                        state.SERVER_REGISTRY.reindex(s)
                                         count += 1
 
                                 if 'custom_groups' not in state.ADMIN_CONFIG: state.ADMIN_CONFIG['custom_groups'] = []
@@ -3636,6 +3558,7 @@ class BulkEditor:
 
                                 for s in state.SERVERS_CACHE:
                                     if s['url'] in self.selected_urls:
+                                        if target_user or target_auth != '不修改': utils.SSH_POOL.discard(s)
                                         changed = False
                                         if target_user: s['ssh_user'] = target_user; changed = True
                                         if target_auth != '不修改':
@@ -3644,6 +3567,7 @@ class BulkEditor:
                                             if target_auth == '独立密码':
                                                 s['ssh_password'] = pwd_input.value
                                             elif target_auth == '独立密钥':
+                                                if s.get('ssh_key') != key_input.value: utils.forget_private_key(s.get('ssh_key'))
                                                 s['ssh_key'] = key_input.value
                                         if changed: count += 1
 
@@ -3671,8 +3595,9 @@ class BulkEditor:
                                 ui.button('取消', on_click=sub_d.close).props('flat')
 
                                 async def confirm_del():
-                                    state.SERVERS_CACHE[:] = [s for s in state.SERVERS_CACHE if
-                                                              s['url'] not in self.selected_urls]
+                                    for s in [s for s in state.SERVERS_CACHE if s['url'] in self.selected_urls]:
+                                        utils.SSH_POOL.discard(s)
+                                        state.SERVER_REGISTRY.remove(s)
                                     await logic.save_servers()
                                     sub_d.close();
                                     d.close()
@@ -3819,6 +3744,7 @@ async def open_server_dialog(idx=None):
 
             state.SERVERS_CACHE[idx]['name'] = new_name
             state.SERVERS_CACHE[idx]['group'] = new_group
+            state.SERVER_REGISTRY.reindex(state.SERVERS_CACHE[idx])
 
             await logic.save_servers()
             render_sidebar_content.refresh()
@@ -3878,13 +3804,16 @@ async def open_server_dialog(idx=None):
                 s_host = inputs['ssh_host'].value.strip()
                 if not s_host: safe_notify("SSH 主机 IP 不能为空", "negative"); return
 
+                new_key = inputs['ssh_key'].value if inputs['ssh_key'] else ''
+                if data.get('ssh_key') and data.get('ssh_key') != new_key: utils.forget_private_key(data['ssh_key'])
+
                 new_server_data.update({
                     'ssh_host': s_host,
                     'ssh_port': int(inputs['ssh_port'].value),
                     'ssh_user': inputs['ssh_user'].value.strip(),
                     'ssh_auth_type': inputs['auth_type'].value,
                     'ssh_password': inputs['ssh_pwd'].value if inputs['ssh_pwd'] else '',
-                    'ssh_key': inputs['ssh_key'].value if inputs['ssh_key'] else '',
+                    'ssh_key': new_key,
                     'probe_installed': True
                 })
 
@@ -3965,9 +3894,10 @@ async def open_server_dialog(idx=None):
 
             # 4. 执行保存
             if is_edit:
-                state.SERVERS_CACHE[idx] = new_server_data
+                utils.SSH_POOL.discard(state.SERVERS_CACHE[idx])
+                state.SERVER_REGISTRY.replace(state.SERVERS_CACHE[idx], new_server_data)
             else:
-                state.SERVERS_CACHE.append(new_server_data)
+                state.SERVER_REGISTRY.add(new_server_data)
 
             await logic.save_servers()
             render_sidebar_content.refresh()
@@ -4153,13 +4083,15 @@ async def open_server_dialog(idx=None):
                                 finally:
                                     loading_notify.dismiss()
 
+                            if will_delete_ssh: utils.SSH_POOL.discard(target_srv)
                             if not remaining_ssh and not remaining_xui:
-                                state.SERVERS_CACHE.pop(idx)
+                                state.SERVER_REGISTRY.remove(target_srv)
                                 u = target_srv.get('url');
                                 p_u = target_srv.get('ssh_host') or u
                                 for k in [u, p_u]:
                                     if k in state.PROBE_DATA_CACHE: del state.PROBE_DATA_CACHE[k]
                                     if k in state.NODES_DATA: del state.NODES_DATA[k]
+                                    utils.index_nodes(k, [])
                                     if k in state.PING_TREND_CACHE: del state.PING_TREND_CACHE[k]
                                 safe_notify('✅ 服务器已彻底删除', 'positive')
                                 is_full_delete = True
@@ -4177,6 +4109,7 @@ async def open_server_dialog(idx=None):
                                     dialog_state['xui_active'] = False
                                     data['url'] = ''
                                     safe_notify('✅ X-UI 信息已清除', 'positive')
+                                state.SERVER_REGISTRY.reindex(target_srv)
 
                             await logic.save_servers()
                             del_d.close()
@@ -8,13 +8,18 @@ import socket
 import logging
 import uuid
 import io  # 确保导入 io
-from urllib.parse import urlparse, quote, parse_qs
+import codecs
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, quote, unquote, parse_qs
 import paramiko
 import requests
 from nicegui import ui  # ✨✨✨ [修复1] 必须导入 ui，否则 notify 会报错
 
 import config
 import state
+import geoip
 
 logger = logging.getLogger("XUI_Utils")
 
@@ -51,15 +56,9 @@ def decode_base64_safe(s):
 
 
 def get_flag_from_ip(ip):
-    """简单的 IP 转国旗"""
-    try:
-        # 这里使用 ip-api.com 作为示例，实际生产环境建议加缓存
-        resp = requests.get(f"http://ip-api.com/json/{ip}?fields=countryCode", timeout=3)
-        if resp.status_code == 200:
-            cc = resp.json().get('countryCode')
-            return get_flag_for_country(cc)
-    except:
-        pass
+    """IP 转国旗 (离线库 + 缓存，见 geoip.py)"""
+    cc = geoip.lookup_country(ip)
+    if cc: return get_flag_for_country(cc)
     return "🏳️"
 
 
@@ -77,57 +76,142 @@ def get_coords_from_name(name):
 
 
 # ================= SSH 相关工具 =================
+_GLOBAL_KEY_CACHE = {'mtime': None, 'content': ""}
+
+
 def load_global_key():
-    if os.path.exists(config.GLOBAL_SSH_KEY_FILE):
+    """按文件 mtime 缓存全局密钥内容，未修改时不重复读盘"""
+    try:
+        mtime = os.stat(config.GLOBAL_SSH_KEY_FILE).st_mtime_ns
+    except OSError:
+        return ""
+    if _GLOBAL_KEY_CACHE['mtime'] != mtime:
         with open(config.GLOBAL_SSH_KEY_FILE, 'r') as f:
-            return f.read().strip()
-    return ""
+            _GLOBAL_KEY_CACHE['content'] = f.read().strip()
+        _GLOBAL_KEY_CACHE['mtime'] = mtime
+    return _GLOBAL_KEY_CACHE['content']
 
 
 def save_global_key(key_content):
+    forget_private_key(load_global_key())
     with open(config.GLOBAL_SSH_KEY_FILE, 'w') as f:
         f.write(key_content.strip())
+    _GLOBAL_KEY_CACHE['mtime'] = None
 
 
-def get_ssh_client_sync(server_conf):
-    """同步获取 SSH 客户端 (用于 run.io_bound)"""
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
+def _ssh_target(server_conf):
+    """解析 SSH 连接参数: (host, port, user, auth_type, 密钥/密码内容)"""
     host = server_conf.get('ssh_host') or \
            server_conf.get('url', '').replace('http://', '').replace('https://', '').split(':')[0]
     port = int(server_conf.get('ssh_port', 22))
     user = server_conf.get('ssh_user', 'root')
-
+    auth_type = server_conf.get('ssh_auth_type', '全局密钥')
+    if auth_type == '独立密钥':
+        secret = server_conf.get('ssh_key') or ""
+    elif auth_type == '全局密钥':
+        secret = load_global_key()
+    elif auth_type == '独立密码':
+        secret = server_conf.get('ssh_password') or ""
+    else:
+        secret = ""
+    return host, port, user, auth_type, secret
+
+
+# ---------------- 私钥解析缓存 ----------------
+# 纯 Python 解析 RSA 私钥很慢：按内容哈希缓存解析结果 (含失败原因)，批量操作只解析一次
+PKEY_CACHE_SIZE = 64
+_PKEY_CACHE = OrderedDict()
+_PKEY_LOCK = threading.Lock()
+
+# PEM 头直接对应的密钥类型
+_PEM_KEY_TYPES = {
+    'RSA': 'RSAKey',
+    'EC': 'ECDSAKey',
+}
+# OpenSSH 新格式里的公钥类型前缀
+_OPENSSH_KEY_TYPES = (
+    ('ssh-ed25519', 'Ed25519Key'),
+    ('ssh-rsa', 'RSAKey'),
+    ('ecdsa-sha2-', 'ECDSAKey'),
+)
+
+
+def _detect_key_class(key_content):
+    """从 PEM 头 / OpenSSH 头部识别密钥类型，识别不了返回 None"""
+    m = re.search(r'-----BEGIN (\w+ )?PRIVATE KEY-----', key_content)
+    if not m: return None
+    kind = (m.group(1) or '').strip()
+    if kind in _PEM_KEY_TYPES:
+        return getattr(paramiko, _PEM_KEY_TYPES[kind], None)
+    if kind != 'OPENSSH': return None
     try:
-        auth_type = server_conf.get('ssh_auth_type', '全局密钥')
+        body = ''.join(key_content[m.end():].split('-----END')[0].split())
+        blob = base64.b64decode(body)
+        # openssh-key-v1\0 | cipher | kdf | kdfoptions | nkeys(uint32) | pubkey(string(keytype) ...)
+        pos = len(b'openssh-key-v1\0')
+        for _ in range(3):
+            pos += 4 + int.from_bytes(blob[pos:pos + 4], 'big')
+        pos += 4 + 4
+        n = int.from_bytes(blob[pos:pos + 4], 'big')
+        key_type = blob[pos + 4:pos + 4 + n].decode('ascii')
+    except Exception:
+        return None
+    for prefix, cls_name in _OPENSSH_KEY_TYPES:
+        if key_type.startswith(prefix):
+            return getattr(paramiko, cls_name, None)
+    return None
 
+
+def _load_private_key(key_content):
+    """返回 (pkey, 错误信息)；识别出类型时只解析一次，否则依次尝试 RSA / Ed25519 / ECDSA"""
+    detected = _detect_key_class(key_content)
+    candidates = [detected] if detected else []
+    candidates += [getattr(paramiko, n, None) for n in ('RSAKey', 'Ed25519Key', 'ECDSAKey')]
+    err = None
+    for cls in dict.fromkeys(c for c in candidates if c is not None):
+        try:
+            return cls.from_private_key(io.StringIO(key_content)), None
+        except Exception as e:
+            err = e
+    return None, f"无法识别的私钥格式: {err}"
+
+
+def get_private_key(key_content):
+    """按内容哈希取已解析的私钥，返回 (pkey, 错误信息)"""
+    digest = hashlib.sha256(key_content.encode('utf-8')).digest()
+    with _PKEY_LOCK:
+        hit = _PKEY_CACHE.get(digest)
+        if hit is not None:
+            _PKEY_CACHE.move_to_end(digest)
+            return hit
+    result = _load_private_key(key_content)
+    with _PKEY_LOCK:
+        _PKEY_CACHE[digest] = result
+        while len(_PKEY_CACHE) > PKEY_CACHE_SIZE:
+            _PKEY_CACHE.popitem(last=False)
+    return result
+
+
+def forget_private_key(key_content):
+    """密钥被替换时丢弃旧的解析结果"""
+    if not key_content: return
+    with _PKEY_LOCK:
+        _PKEY_CACHE.pop(hashlib.sha256(key_content.encode('utf-8')).digest(), None)
+
+
+def _open_ssh_client(host, port, user, auth_type, secret):
+    """建立一条新的 SSH 连接，返回 (client, msg)"""
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
         pkey = None
         password = None
-        
-        # 获取密钥内容字符串
-        key_content = ""
-        if auth_type == '独立密钥':
-            key_content = server_conf.get('ssh_key')
-        elif auth_type == '全局密钥':
-            key_content = load_global_key()
-        
-        # ✨✨✨ [修复2] 增强密钥解析逻辑 (RSA + Ed25519) ✨✨✨
-        if key_content:
-            key_file = io.StringIO(key_content)
-            try:
-                # 先尝试 RSA
-                pkey = paramiko.RSAKey.from_private_key(key_file)
-            except:
-                # 失败则尝试 Ed25519
-                try:
-                    key_file.seek(0)
-                    pkey = paramiko.Ed25519Key.from_private_key(key_file)
-                except Exception as e:
-                    return None, f"无法识别的私钥格式: {e}"
-
         if auth_type == '独立密码':
-            password = server_conf.get('ssh_password')
+            password = secret
+        elif secret:
+            # ✨✨✨ [修复2] 增强密钥解析逻辑 (RSA + Ed25519 + ECDSA，结果缓存) ✨✨✨
+            pkey, err = get_private_key(secret)
+            if pkey is None: return None, err
 
         # 连接时禁用 agent 和系统配置，防止干扰
         client.connect(host, port, user, pkey=pkey, password=password, timeout=10, banner_timeout=10, look_for_keys=False, allow_agent=False)
@@ -136,19 +220,211 @@ def get_ssh_client_sync(server_conf):
         return None, str(e)
 
 
-def _ssh_exec_wrapper(server_conf, cmd):
-    """SSH 执行包装器"""
-    client, msg = get_ssh_client_sync(server_conf)
-    if not client: return False, f"Connect Error: {msg}"
+def get_ssh_client_sync(server_conf):
+    """同步获取独占的 SSH 客户端 (用于 run.io_bound)，用完需自行 close"""
+    return _open_ssh_client(*_ssh_target(server_conf))
 
-    try:
-        stdin, stdout, stderr = client.exec_command(cmd, timeout=30)
-        out = stdout.read().decode().strip()
-        err = stderr.read().decode().strip()
-        client.close()
-        return True, (out + "\n" + err).strip()
-    except Exception as e:
-        return False, str(e)
+
+# ---------------- SSH 连接池 ----------------
+SSH_POOL_IDLE_TIMEOUT = 300   # 空闲超过此秒数的连接被回收
+SSH_POOL_KEEPALIVE = 30       # transport 心跳间隔
+SSH_POOL_MAX_SESSIONS = 6     # 每条连接同时执行的命令通道上限 (sshd 默认 MaxSessions=10)
+
+
+class _PooledSSH:
+    __slots__ = ('client', 'sessions', 'active', 'last_used', 'connect_lock')
+
+    def __init__(self):
+        self.client = None
+        self.sessions = threading.BoundedSemaphore(SSH_POOL_MAX_SESSIONS)
+        self.active = 0  # 正在执行的命令数，>0 时不回收
+        self.last_used = time.time()
+        self.connect_lock = threading.Lock()
+
+
+class SSHConnectionPool:
+    """按 (host, port, user, 凭据指纹) 复用 SSH transport，命令以多个 exec 通道复用同一连接"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(target):
+        host, port, user, auth_type, secret = target
+        fp = hashlib.sha256(f"{auth_type}\0{secret}".encode('utf-8')).hexdigest()[:16]
+        return host, port, user, fp
+
+    @staticmethod
+    def _alive(client):
+        transport = client.get_transport() if client else None
+        return transport is not None and transport.is_active()
+
+    def _entry(self, key):
+        with self._lock:
+            self._evict_idle_locked()
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _PooledSSH()
+            entry.last_used = time.time()
+            return entry
+
+    def _evict_idle_locked(self):
+        now = time.time()
+        for key, entry in list(self._entries.items()):
+            # 连接失败留下的空条目 (client 为 None) 同样按空闲回收
+            if (not entry.active and not entry.connect_lock.locked()
+                    and now - entry.last_used > SSH_POOL_IDLE_TIMEOUT):
+                self._entries.pop(key, None)
+                if entry.client:
+                    try: entry.client.close()
+                    except: pass
+
+    def _ensure_client(self, entry, target):
+        """健康检查：连接断了就重连；同一 key 的并发请求只握手一次"""
+        with entry.connect_lock:
+            if self._alive(entry.client):
+                return entry.client, "Success"
+            if entry.client:
+                try: entry.client.close()
+                except: pass
+                entry.client = None
+            client, msg = _open_ssh_client(*target)
+            if client:
+                client.get_transport().set_keepalive(SSH_POOL_KEEPALIVE)
+                entry.client = client
+            return client, msg
+
+    def adopt(self, server_conf, client):
+        """把外部已建立的连接放进池 (如用户名探测的获胜连接)；池里已有活连接时关闭传入的"""
+        target = _ssh_target(server_conf)
+        entry = self._entry(self._key(target))
+        with entry.connect_lock:
+            if self._alive(entry.client):
+                try: client.close()
+                except: pass
+                return
+            client.get_transport().set_keepalive(SSH_POOL_KEEPALIVE)
+            entry.client = client
+
+    def discard(self, server_conf):
+        """丢弃某台机器的池化连接 (编辑 / 删除服务器前调用)；键按调用时的配置计算，关闭放到线程池"""
+        key = self._key(_ssh_target(server_conf))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry and entry.client:
+            state.BG_EXECUTOR.submit(entry.client.close)
+
+    def exec(self, server_conf, cmd, timeout=30):
+        target = _ssh_target(server_conf)
+        key = self._key(target)
+        for attempt in range(2):
+            entry = self._entry(key)
+            client, msg = self._ensure_client(entry, target)
+            if not client: return False, f"Connect Error: {msg}"
+            with entry.sessions:
+                with self._lock: entry.active += 1
+                try:
+                    stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+                    out = stdout.read().decode().strip()
+                    err = stderr.read().decode().strip()
+                    return True, (out + "\n" + err).strip()
+                except paramiko.SSHException as e:
+                    # 通道打不开多半是连接已失效：丢掉后重连重试一次
+                    if attempt == 0 and not self._alive(client):
+                        continue
+                    return False, str(e)
+                except Exception as e:
+                    return False, str(e)
+                finally:
+                    with self._lock:
+                        entry.active -= 1
+                        entry.last_used = time.time()
+        return False, "SSH 连接失效"
+
+    def exec_stream(self, server_conf, cmd, on_chunk=None, timeout=120, cancel=None):
+        """
+        流式执行：输出边到边回调 on_chunk(stream, text)，stream 为 stdout / stderr
+        timeout 为整条命令的最长耗时；cancel 为 threading.Event，置位后中止
+        返回 (状态, 完整输出)，状态为 ok / failed / timeout / cancelled
+        """
+        target = _ssh_target(server_conf)
+        key = self._key(target)
+        deadline = time.time() + timeout
+        for attempt in range(2):
+            entry = self._entry(key)
+            client, msg = self._ensure_client(entry, target)
+            if not client: return 'failed', f"Connect Error: {msg}"
+            with entry.sessions:
+                with self._lock: entry.active += 1
+                chan = None
+                try:
+                    try:
+                        chan = client.get_transport().open_session()
+                    except paramiko.SSHException as e:
+                        if attempt == 0 and not self._alive(client): continue
+                        return 'failed', str(e)
+                    chan.exec_command(cmd)
+                    return self._pump(chan, on_chunk, deadline, cancel)
+                except Exception as e:
+                    return 'failed', str(e)
+                finally:
+                    if chan is not None:
+                        try: chan.close()
+                        except: pass
+                    with self._lock:
+                        entry.active -= 1
+                        entry.last_used = time.time()
+        return 'failed', "SSH 连接失效"
+
+    @staticmethod
+    def _pump(chan, on_chunk, deadline, cancel):
+        decoders = {'stdout': codecs.getincrementaldecoder('utf-8')('replace'),
+                    'stderr': codecs.getincrementaldecoder('utf-8')('replace')}
+        parts = []
+
+        def emit(stream, data, final=False):
+            text = decoders[stream].decode(data, final)
+            if not text: return
+            parts.append(text)
+            if on_chunk: on_chunk(stream, text)
+
+        while True:
+            got = False
+            while chan.recv_ready():
+                emit('stdout', chan.recv(4096)); got = True
+            while chan.recv_stderr_ready():
+                emit('stderr', chan.recv_stderr(4096)); got = True
+            if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                break
+            if cancel is not None and cancel.is_set():
+                return 'cancelled', ''.join(parts).strip()
+            if time.time() > deadline:
+                return 'timeout', ''.join(parts).strip()
+            if not got:
+                if cancel is not None: cancel.wait(0.05)
+                else: time.sleep(0.05)
+        emit('stdout', b'', True)
+        emit('stderr', b'', True)
+        code = chan.recv_exit_status()
+        return ('ok' if code == 0 else 'failed'), ''.join(parts).strip()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry.client:
+                try: entry.client.close()
+                except: pass
+
+
+SSH_POOL = SSHConnectionPool()
+
+
+def _ssh_exec_wrapper(server_conf, cmd):
+    """SSH 执行包装器 (走连接池)"""
+    return SSH_POOL.exec(server_conf, cmd)
 
 
 # ================= Cloudflare API =================
@@ -205,83 +481,131 @@ class CloudflareHandler:
             return False, str(e)
 
 
+# ================= 节点模型 (入库时预解析) =================
+def _json_field(v):
+    if isinstance(v, str):
+        try: return json.loads(v)
+        except: return {}
+    return v or {}
+
+
+class NodeModel:
+    """入站节点的预解析视图：settings / streamSettings 只在入库时解析一次"""
+    __slots__ = ('protocol', 'port', 'remark', 'enable', 'uuid', 'flow', 'password', 'method',
+                 'security', 'network', 'sni', 'pbk', 'sid', 'fp', 'path', 'host', 'service_name',
+                 'up', 'down', 'total')
+
+    @classmethod
+    def from_node(cls, node):
+        m = cls()
+        settings = _json_field(node.get('settings'))
+        stream = _json_field(node.get('streamSettings'))
+        client = (settings.get('clients') or [{}])[0] or {}
+
+        m.protocol = node.get('protocol')
+        m.port = node.get('port')
+        m.remark = node.get('remark', 'node')
+        m.enable = node.get('enable', True)
+        m.uuid = client.get('id', '')
+        m.flow = client.get('flow', '')
+        m.password = client.get('password', '') or settings.get('password', '')
+        m.method = settings.get('method', '')
+        m.security = stream.get('security', 'none')
+        m.network = stream.get('network', 'tcp')
+        m.sni = m.pbk = m.sid = m.fp = m.path = m.host = m.service_name = ''
+
+        if m.security == 'reality':
+            r_set = stream.get('realitySettings', {})
+            r_inner = r_set.get('settings', {})
+            m.sni = (r_set.get('serverNames') or [''])[0]
+            m.sid = (r_set.get('shortIds') or [''])[0]
+            m.pbk = r_set.get('publicKey') or r_inner.get('publicKey', '')
+            m.fp = r_inner.get('fingerprint') or 'chrome'
+        elif m.security == 'tls':
+            m.sni = stream.get('tlsSettings', {}).get('serverName', '')
+
+        if m.network == 'ws':
+            ws = stream.get('wsSettings', {})
+            m.path = ws.get('path', '/')
+            m.host = _json_field(ws.get('headers')).get('Host', '') or ws.get('host', '')
+        elif m.network == 'grpc':
+            m.service_name = stream.get('grpcSettings', {}).get('serviceName', '')
+
+        m.set_traffic(node)
+        return m
+
+    def set_traffic(self, node):
+        self.up = node.get('up', 0)
+        self.down = node.get('down', 0)
+        self.total = node.get('total', 0)
+
+
+def index_nodes(url, nodes):
+    """节点入库：原地把 JSON 字符串字段转成 dict，并为每个节点建立 NodeModel"""
+    for key in state.NODE_MODEL_KEYS.pop(url, ()):
+        state.NODE_MODELS.pop(key, None)
+    keys = []
+    for n in nodes or []:
+        for k in ('settings', 'streamSettings'):
+            if isinstance(n.get(k), str): n[k] = _json_field(n[k])
+        if n.get('_raw_link'): continue
+        state.NODE_MODELS[id(n)] = NodeModel.from_node(n)
+        keys.append(id(n))
+    state.NODE_MODEL_KEYS[url] = keys
+
+
+def refresh_node_model(node):
+    """节点被原地修改后重建模型 (未入库的节点忽略)"""
+    if id(node) in state.NODE_MODELS:
+        state.NODE_MODELS[id(node)] = NodeModel.from_node(node)
+
+
+def node_model(node):
+    """取节点的预解析模型；未入库的节点 (如编辑中的临时节点) 现场解析
+    模型只按 id 索引，用协议 / 端口 / 备注校验，防止 id 复用或原地编辑后拿到旧模型"""
+    m = state.NODE_MODELS.get(id(node))
+    if m is not None and m.protocol == node.get('protocol') and m.port == node.get('port') \
+            and m.remark == node.get('remark', 'node'):
+        return m
+    m = NodeModel.from_node(node)
+    if id(node) in state.NODE_MODELS: state.NODE_MODELS[id(node)] = m
+    return m
+
+
 # ================= 节点链接解析与生成 =================
 def generate_node_link(node, host_override=None):
-    """根据节点数据生成 vless/vmess/hy2 链接"""
+    """根据节点数据生成 vless/vmess 链接"""
     if node.get('_raw_link'): return node['_raw_link']
 
-    proto = node.get('protocol')
-    uuid_str = ""
-
-    # 类型检查
-    settings = node.get('settings', {})
-    if isinstance(settings, str):
-        try: settings = json.loads(settings)
-        except: settings = {}
-
-    stream = node.get('streamSettings', {})
-    if isinstance(stream, str):
-        try: stream = json.loads(stream)
-        except: stream = {}
-
-    net = stream.get('network', 'tcp')
-    security = stream.get('security', 'none')
-    port = node.get('port')
-    ps = node.get('remark', 'node')
+    m = node_model(node)
+    net, security, port, ps = m.network, m.security, m.port, m.remark
     add = host_override if host_override else "127.0.0.1"
 
-    if proto == 'vless':
-        try:
-            clients = settings.get('clients', [{}])
-            if clients: uuid_str = clients[0].get('id', '')
-        except: return ""
-
-        link = f"vless://{uuid_str}@{add}:{port}?security={security}&type={net}"
+    if m.protocol == 'vless':
+        link = f"vless://{m.uuid}@{add}:{port}?security={security}&type={net}"
 
         if security == 'reality':
-            r_set = stream.get('realitySettings', {})
-            pbk = r_set.get('publicKey', '')
-            sni = r_set.get('serverNames', [''])[0] if r_set.get('serverNames') else ''
-            link += f"&sni={sni}&pbk={pbk}&fp=chrome"
+            link += f"&sni={m.sni}&pbk={m.pbk}&fp=chrome"
         elif security == 'tls':
-            tls = stream.get('tlsSettings', {})
-            sni = tls.get('serverName', '')
-            link += f"&sni={sni}"
+            link += f"&sni={m.sni}"
 
         if net == 'ws':
-            ws = stream.get('wsSettings', {})
-            path = ws.get('path', '/')
-            headers = ws.get('headers', {})
-            if isinstance(headers, str):
-                try: headers = json.loads(headers)
-                except: headers = {}
-            host_h = headers.get('Host', '')
-            link += f"&path={quote(path)}"
-            if host_h: link += f"&host={host_h}"
+            link += f"&path={quote(m.path)}"
+            if m.host: link += f"&host={m.host}"
 
         link += f"#{quote(ps)}"
         return link
 
-    elif proto == 'vmess':
-        try:
-            clients = settings.get('clients', [{}])
-            if clients: uuid_str = clients[0].get('id', '')
-        except: return ""
-        
+    elif m.protocol == 'vmess':
         v_json = {
-            "v": "2", "ps": ps, "add": add, "port": port, "id": uuid_str, "aid": "0",
+            "v": "2", "ps": ps, "add": add, "port": port, "id": m.uuid, "aid": "0",
             "net": net, "type": "none", "host": "", "path": "", "tls": ""
         }
         if security == 'tls': v_json['tls'] = 'tls'
 
         if net == 'ws':
-            ws = stream.get('wsSettings', {})
-            v_json['path'] = ws.get('path', '/')
-            headers = ws.get('headers', {})
-            if isinstance(headers, str):
-                try: headers = json.loads(headers)
-                except: headers = {}
-            v_json['host'] = headers.get('Host', '')
+            v_json['path'] = m.path
+            v_json['host'] = m.host
 
         return "vmess://" + safe_base64(json.dumps(v_json))
 
@@ -309,9 +633,223 @@ def parse_vless_link_to_node(link, remark_override=None):
 
 
 def generate_detail_config(node, host):
-    """生成 Surge/Clash 样式的明文配置行"""
-    if node.get('_raw_link'): return f"// Custom Node: {node.get('remark')} \n// Link: {node['_raw_link']}"
-    return f"// {node.get('remark')}: Auto-gen not supported"
+    """生成 Surge 样式的明文配置行，不支持的协议返回空串"""
+    proxy = node_to_proxy(node, host)
+    return render_surge_line(proxy) if proxy else ""
+
+
+# ================= 原生订阅渲染 (Clash / Surge / sing-box) =================
+def _qs_first(qs, key, default=''):
+    v = qs.get(key)
+    return v[0] if v else default
+
+
+def _proxy_from_link(link, name):
+    """解析自定义节点的分享链接 (vless/vmess/trojan/ss/hy2)"""
+    try:
+        if link.startswith('vmess://'):
+            v = json.loads(decode_base64_safe(link[8:]))
+            return {
+                'name': name or v.get('ps', 'node'), 'type': 'vmess',
+                'server': v.get('add'), 'port': int(v.get('port', 443)), 'uuid': v.get('id', ''),
+                'network': v.get('net', 'tcp'), 'tls': v.get('tls') == 'tls',
+                'sni': v.get('sni') or v.get('host', ''), 'path': v.get('path', ''), 'host': v.get('host', ''),
+            }
+
+        parsed = urlparse(link)
+        qs = parse_qs(parsed.query)
+        scheme = parsed.scheme.lower()
+        proxy = {
+            'name': name or (parsed.fragment and unquote(parsed.fragment)) or 'node',
+            'server': parsed.hostname, 'port': parsed.port or 443,
+            'network': _qs_first(qs, 'type', 'tcp'),
+            'sni': _qs_first(qs, 'sni') or _qs_first(qs, 'peer'),
+            'path': _qs_first(qs, 'path'), 'host': _qs_first(qs, 'host'),
+            'service_name': _qs_first(qs, 'serviceName'),
+            'insecure': _qs_first(qs, 'insecure') == '1' or _qs_first(qs, 'allowInsecure') == '1',
+        }
+        security = _qs_first(qs, 'security', 'none')
+
+        if scheme == 'vless':
+            proxy.update(type='vless', uuid=unquote(parsed.username or ''),
+                         flow=_qs_first(qs, 'flow'), tls=security in ('tls', 'reality'),
+                         fp=_qs_first(qs, 'fp'))
+            if security == 'reality':
+                proxy['reality'] = {'pbk': _qs_first(qs, 'pbk'), 'sid': _qs_first(qs, 'sid')}
+        elif scheme == 'trojan':
+            proxy.update(type='trojan', password=unquote(parsed.username or ''), tls=True)
+        elif scheme in ('hy2', 'hysteria2'):
+            proxy.update(type='hysteria2', password=unquote(parsed.username or ''), tls=True,
+                         network='udp', obfs=_qs_first(qs, 'obfs'), obfs_password=_qs_first(qs, 'obfs-password'))
+        elif scheme == 'ss':
+            # SIP002: ss://base64(method:password)@host:port#name
+            user = unquote(parsed.username or '')
+            if ':' not in user: user = decode_base64_safe(user)
+            method, _, password = user.partition(':')
+            proxy.update(type='ss', method=method, password=password, tls=False, network='tcp')
+        else:
+            return None
+        return proxy
+    except Exception:
+        return None
+
+
+def node_to_proxy(node, host):
+    """把面板节点 / 自定义节点统一成中间结构，供各客户端格式渲染"""
+    if node.get('_raw_link'):
+        return _proxy_from_link(node['_raw_link'], node.get('remark'))
+
+    m = node_model(node)
+    proxy = {'name': m.remark, 'server': host, 'port': m.port, 'network': m.network,
+             'tls': m.security in ('tls', 'reality'), 'sni': m.sni, 'path': m.path, 'host': m.host,
+             'service_name': m.service_name}
+    if m.security == 'reality':
+        proxy['fp'] = m.fp
+        proxy['reality'] = {'pbk': m.pbk, 'sid': m.sid}
+
+    if m.protocol == 'vless':
+        proxy.update(type='vless', uuid=m.uuid, flow=m.flow)
+    elif m.protocol == 'vmess':
+        proxy.update(type='vmess', uuid=m.uuid)
+    elif m.protocol == 'trojan':
+        proxy.update(type='trojan', password=m.password)
+    elif m.protocol == 'shadowsocks':
+        proxy.update(type='ss', method=m.method, password=m.password)
+    else:
+        return None
+    return proxy
+
+
+def render_clash_proxy(p, udp=True, tfo=False, skip_cert=True):
+    """Clash (Meta) proxies 条目"""
+    c = {'name': p['name'], 'type': p['type'], 'server': p['server'], 'port': p['port'], 'udp': udp}
+    if tfo: c['tfo'] = True
+
+    if p['type'] in ('vless', 'vmess'):
+        c['uuid'] = p['uuid']
+        if p['type'] == 'vmess': c.update({'alterId': 0, 'cipher': 'auto'})
+        if p.get('flow'): c['flow'] = p['flow']
+    elif p['type'] == 'ss':
+        c.update({'cipher': p['method'], 'password': p['password']})
+        return c
+    else:
+        c['password'] = p['password']
+
+    if p['type'] == 'hysteria2':
+        if p.get('obfs'): c.update({'obfs': p['obfs'], 'obfs-password': p.get('obfs_password', '')})
+    elif p['type'] != 'trojan':
+        c['tls'] = bool(p.get('tls'))
+    if p.get('tls'):
+        c['sni' if p['type'] in ('trojan', 'hysteria2') else 'servername'] = p.get('sni', '')
+        c['skip-cert-verify'] = skip_cert or bool(p.get('insecure'))
+    if p.get('reality'):
+        c['reality-opts'] = {'public-key': p['reality']['pbk'], 'short-id': p['reality']['sid']}
+        c['client-fingerprint'] = p.get('fp') or 'chrome'
+
+    if p['network'] == 'ws':
+        c['network'] = 'ws'
+        c['ws-opts'] = {'path': p.get('path') or '/'}
+        if p.get('host'): c['ws-opts']['headers'] = {'Host': p['host']}
+    elif p['network'] == 'grpc':
+        c['network'] = 'grpc'
+        c['grpc-opts'] = {'grpc-service-name': p.get('service_name', '')}
+    return c
+
+
+def render_clash(proxies, **kw):
+    """仅输出 proxies 列表 (等同 SubConverter 的 list=true)；JSON 流式映射即合法 YAML"""
+    lines = ["proxies:"]
+    for p in proxies:
+        lines.append("  - " + json.dumps(render_clash_proxy(p, **kw), ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+
+def render_surge_line(p, udp=True, tfo=False, skip_cert=True):
+    """Surge 代理行，Surge 不支持的协议 (vless) 返回空串"""
+    head = f"{p['name']} = "
+    if p['type'] == 'vmess':
+        parts = [f"vmess, {p['server']}, {p['port']}", f"username={p['uuid']}", "vmess-aead=true"]
+        if p['network'] == 'ws':
+            parts.append("ws=true")
+            parts.append(f"ws-path={p.get('path') or '/'}")
+            if p.get('host'): parts.append(f"ws-headers=Host:{p['host']}")
+        elif p['network'] != 'tcp':
+            return ""
+        if p.get('tls'): parts.append("tls=true")
+    elif p['type'] == 'trojan':
+        parts = [f"trojan, {p['server']}, {p['port']}", f"password={p['password']}"]
+        if p['network'] == 'ws':
+            parts.append("ws=true")
+            parts.append(f"ws-path={p.get('path') or '/'}")
+    elif p['type'] == 'ss':
+        parts = [f"ss, {p['server']}, {p['port']}", f"encrypt-method={p['method']}", f"password={p['password']}"]
+    elif p['type'] == 'hysteria2':
+        parts = [f"hysteria2, {p['server']}, {p['port']}", f"password={p['password']}"]
+    else:
+        return ""
+
+    if p.get('tls'):
+        if p.get('sni'): parts.append(f"sni={p['sni']}")
+        if skip_cert or p.get('insecure'): parts.append("skip-cert-verify=true")
+    if udp and p['type'] != 'hysteria2': parts.append("udp-relay=true")
+    if tfo: parts.append("tfo=true")
+    return head + ", ".join(parts)
+
+
+def render_surge(proxies, **kw):
+    lines, skipped = [], []
+    for p in proxies:
+        line = render_surge_line(p, **kw)
+        if line: lines.append(line)
+        else: skipped.append(p['name'])
+    if skipped:
+        # Surge 不支持 VLESS 等协议，注释说明被跳过的节点，避免静默丢失
+        lines.insert(0, f"# Surge 不支持以下 {len(skipped)} 个节点 (VLESS 等)，已跳过: {', '.join(skipped)}")
+    return "\n".join(lines)
+
+
+def render_singbox_outbound(p, udp=True, tfo=False, skip_cert=True):
+    o = {'type': 'shadowsocks' if p['type'] == 'ss' else p['type'], 'tag': p['name'],
+         'server': p['server'], 'server_port': int(p['port'])}
+    if tfo: o['tcp_fast_open'] = True
+
+    if p['type'] in ('vless', 'vmess'):
+        o['uuid'] = p['uuid']
+        if p['type'] == 'vmess': o.update({'security': 'auto', 'alter_id': 0})
+        if p.get('flow'): o['flow'] = p['flow']
+    elif p['type'] == 'ss':
+        o.update({'method': p['method'], 'password': p['password']})
+        if not udp: o['network'] = 'tcp'
+        return o
+    else:
+        o['password'] = p['password']
+        if p.get('obfs'): o['obfs'] = {'type': p['obfs'], 'password': p.get('obfs_password', '')}
+
+    if p.get('tls'):
+        tls = {'enabled': True, 'server_name': p.get('sni', ''), 'insecure': skip_cert or bool(p.get('insecure'))}
+        if p.get('reality'):
+            tls['reality'] = {'enabled': True, 'public_key': p['reality']['pbk'], 'short_id': p['reality']['sid']}
+            tls['utls'] = {'enabled': True, 'fingerprint': p.get('fp') or 'chrome'}
+        o['tls'] = tls
+
+    if p['network'] == 'ws':
+        o['transport'] = {'type': 'ws', 'path': p.get('path') or '/'}
+        if p.get('host'): o['transport']['headers'] = {'Host': p['host']}
+    elif p['network'] == 'grpc':
+        o['transport'] = {'type': 'grpc', 'service_name': p.get('service_name', '')}
+    return o
+
+
+def render_singbox(proxies, **kw):
+    return json.dumps({'outbounds': [render_singbox_outbound(p, **kw) for p in proxies]},
+                      ensure_ascii=False, indent=2)
+
+
+NATIVE_RENDERERS = {
+    'clash': render_clash, 'clashmeta': render_clash,
+    'surge': render_surge,
+    'singbox': render_singbox, 'sing-box': render_singbox,
+}
 
 
 # ================= 管理器适配器 (Adapter) =================